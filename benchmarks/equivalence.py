@@ -0,0 +1,282 @@
+import os, sys, json, time, random, shutil, sqlite3, argparse, importlib, statistics
+
+ROOT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(os.path.dirname(ROOT_DIR), 'lib'))
+
+import grade
+import database as db
+import generate_data, run_benchmarks
+
+#########################################################################
+##
+##  NOTES:
+##
+##    Checks that a faster way of grading gives exactly the grades the
+##    original code gives. Every engine grades the same randomly sized
+##    synthetic data sets, starting from the same database and gradebooks,
+##    and every (course, student, video) grade is compared with what
+##    legacy_grade.py, a self-contained copy of the baseline grading code,
+##    gave.
+##
+##    Every data set is graded twice, from two databases:
+##
+##      names       - no YuJa identities are known yet, so every view is
+##                    matched to its student by name
+##      identities  - the identities the current code learns from the first
+##                    database are already saved, so the views of confirmed
+##                    identities are matched by sid instead. The legacy code
+##                    still matches everything by name.
+##
+##    The baseline didn't learn identities, so the identities each engine
+##    learns are compared with what the current code learns instead.
+##
+##    Every data set has a few students with the name of a student in another
+##    course on the same playlist (see generate_data.py), whose views match
+##    both of them by name. Their userPIDs must be found to be ambiguous, not
+##    confirmed to either student. The pipeline engine, which grades a course
+##    at a time, is always checked for this as well.
+##
+##    An engine is any function with the signature of
+##    grade.process_video_grades, named as module:function. The current
+##    grade.process_video_grades and the pipeline are always checked. Settings given with --set
+##    are added to the config the engines other than the legacy one see:
+##
+##      python equivalence.py --datasets 10
+##      python equivalence.py --engine my_grade:process_video_grades --set workers=4
+##
+##    Prints the mismatches and each engine's speedup over the legacy code,
+##    and exits with 1 if any grade was different.
+##
+#########################################################################
+
+LEGACY_ENGINE = 'legacy_grade:process_video_grades'
+CURRENT_ENGINE = 'grade:process_video_grades'
+PIPELINE_ENGINE = 'pipeline_grade:process_video_grades'
+
+DATABASES = ['names', 'identities']
+
+# Students in each data set that share a name with one in another course
+TWINS = 3
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Compares grading engines against the original grading code.')
+    parser.add_argument('--engine', action='append', default=[], help='module:function to check, can be repeated')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help='config setting for the engines being checked, VALUE is read as JSON if it can be')
+    parser.add_argument('--scale', choices=generate_data.SCALES.keys(), default='tiny',
+                        help='largest data set to generate, each one is a random size up to this')
+    parser.add_argument('--datasets', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--show', type=int, default=20, help='mismatches to list for each engine')
+    parser.add_argument('--output', help='save the results to this JSON file')
+    args = parser.parse_args()
+
+    engines = [LEGACY_ENGINE, CURRENT_ENGINE, PIPELINE_ENGINE]
+    engines += [e for e in args.engine if e not in engines]
+    overrides = parse_settings(args.set)
+
+    rnd = random.Random(args.seed)
+    results = []
+
+    for i in range(args.datasets):
+        sizes = random_sizes(rnd, generate_data.SCALES[args.scale])
+        seed = rnd.randint(1, 1000000)
+        folder = os.path.join(ROOT_DIR, 'data', 'equivalence', f'dataset_{i}')
+        generate_data.generate(folder, *sizes, seed, TWINS)
+
+        for database in DATABASES:
+            result = compare_engines(folder, engines, overrides, args.repeat, database)
+            result.update(dataset=i, seed=seed, sizes=sizes, database=database)
+            results.append(result)
+
+            print(format_result(result, args.show))
+
+    print(format_summary(results, engines))
+
+    if args.output != None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, default=str)
+
+    if any(len(engine['mismatches']) > 0 for result in results for engine in result['engines'].values()):
+        sys.exit(1)
+
+
+##############################################################################
+##
+##  Reads KEY=VALUE settings, VALUE is JSON where possible ('4', 'true') and
+##    a plain string otherwise
+##
+
+def parse_settings(settings):
+
+    overrides = {}
+    for setting in settings:
+        key, value = setting.split('=', 1)
+        try:
+            overrides[key] = json.loads(value)
+        except json.JSONDecodeError:
+            overrides[key] = value
+
+    return overrides
+
+
+# Students, videos, views and playlists for a data set no larger than scale
+def random_sizes(rnd, scale):
+
+    students, videos, views, playlists = scale
+    playlists = rnd.randint(1, playlists)
+    videos = rnd.randint(playlists, videos)
+    students = rnd.randint(generate_data.STUDENTS_PER_COURSE, students)
+    views = rnd.randint(videos, views)
+
+    return [students, videos, views, playlists]
+
+
+def load_engine(name):
+
+    module, function = name.split(':')
+    return getattr(importlib.import_module(module), function)
+
+
+##############################################################################
+##
+##  Grades one data set with every engine, starting from the named database,
+##    and compares each one's grades with the legacy engine's
+##
+
+def compare_engines(folder, engines, overrides, repeat, database):
+
+    bench = run_benchmarks.Benchmark(folder)
+    if database == 'identities':
+        start_db = make_identities_db(bench)
+    else:
+        start_db = None
+
+    runs = {}
+    for name in engines:
+        config = bench.config if name == LEGACY_ENGINE else dict(bench.config, **overrides)
+        runs[name] = run_engine(bench, config, load_engine(name), repeat, start_db)
+
+    legacy = runs[LEGACY_ENGINE]
+    current = runs[CURRENT_ENGINE]
+    result = { 'cells': len(legacy['cells']), 'engines': {} }
+
+    for name, run in runs.items():
+        result['engines'][name] = {
+            'median': statistics.median(run['times']),
+            'speedup': statistics.median(legacy['times']) / statistics.median(run['times']),
+            'mismatches': diff_cells(legacy['cells'], run['cells']),
+            'identities_match': name == LEGACY_ENGINE or current['identities'] == run['identities']
+        }
+
+    return result
+
+
+# A copy of the loaded database with the identities the current code learns
+#   from it saved, the confirmed ones included
+def make_identities_db(bench):
+
+    path = os.path.join(bench.data_folder, 'identities.db')
+
+    bench.reset()
+    bench.reset_db(True)
+    class_list = grade.load_instructor_gradebooks(bench.config, bench.class_list(), bench.video_data)
+    grade.process_video_grades(bench.config, class_list, bench.video_data)
+    shutil.copy(bench.config['temp_db'], path)
+
+    return path
+
+
+# Grades the data set repeat times from the same starting point, the loaded
+#   database or start_db, returning the times and the grades and identities
+#   of the last run
+def run_engine(bench, config, engine, repeat, start_db=None):
+
+    times = []
+    for i in range(repeat):
+        bench.reset()
+        bench.reset_db(True)
+        if start_db != None:
+            shutil.copy(start_db, bench.config['temp_db'])
+        class_list = grade.load_instructor_gradebooks(bench.config, bench.class_list(), bench.video_data)
+
+        start = time.perf_counter()
+        engine(config, class_list, bench.video_data)
+        times.append(time.perf_counter() - start)
+
+    connection = sqlite3.connect(bench.config['temp_db'])
+    identities = db.get_identities(connection.cursor())
+    connection.close()
+
+    return { 'times': times, 'cells': get_cells(class_list), 'identities': identities }
+
+
+# Every grade in class_list as (course, sid, video): grade
+def get_cells(class_list):
+
+    cells = {}
+    for course in class_list:
+        for student in course.students:
+            if student.username != 'duedates':
+                for video, grade in student.videoswatched.items():
+                    cells[(course.name, student.sid, video)] = grade
+
+    return cells
+
+
+# Returns (course, sid, video, expected, found) for every cell that differs,
+#   a cell missing from either side is None there
+def diff_cells(expected, found):
+
+    mismatches = []
+    for cell in sorted(expected.keys() | found.keys()):
+        if expected.get(cell) != found.get(cell) or (cell in expected) != (cell in found):
+            mismatches.append(cell + (expected.get(cell), found.get(cell)))
+
+    return mismatches
+
+
+##############################################################################
+##
+##  The report, one block per data set and a table of the engines at the end
+##
+
+def format_result(result, show):
+
+    students, videos, views, playlists = result['sizes']
+    msg = f"\nData set {result['dataset']} (seed {result['seed']}, {result['database']} database): {students} students, " \
+          f"{videos} videos, {views} views, {playlists} playlists, {result['cells']} grades\n"
+
+    for name, engine in result['engines'].items():
+        msg += f"  {name:44} {engine['median']:9.4f} s {engine['speedup']:7.2f}x  " \
+               f"{len(engine['mismatches'])} mismatches"
+        msg += '\n' if engine['identities_match'] else ', learned different identities\n'
+
+        for course, sid, video, expected, found in engine['mismatches'][:show]:
+            msg += f'    {course} {sid} {video}: expected {expected}, got {found}\n'
+        if len(engine['mismatches']) > show:
+            msg += f"    ... and {len(engine['mismatches']) - show} more\n"
+
+    return msg
+
+
+def format_summary(results, engines):
+
+    msg = '\nEngine'.ljust(46) + 'Mismatches'.rjust(12) + 'Speedup'.rjust(10) + '\n'
+    for name in engines:
+        mismatches = sum(len(result['engines'][name]['mismatches']) for result in results)
+        speedup = statistics.geometric_mean([result['engines'][name]['speedup'] for result in results])
+        msg += name[:44].ljust(45) + f'{mismatches:12}{speedup:9.2f}x\n'
+
+    return msg
+
+
+##############################################################################
+##                                                                 MAIN PROGRAM
+##############################################################################
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+import os, csv, time, random, shutil, argparse
+
+#########################################################################
+##
+##  NOTES:
+##
+##    Writes a complete set of made up input files for the grader, so that
+##    it can be run and timed without a config.toml, OneDrive or YuJa:
+##
+##      videodata.csv, classes.csv, students.csv, extract.csv
+##      reports/<video>_report.csv      - in the format yuja.py writes
+##      gradebooks/<instructor>.csv     - for a quarter of the courses
+##
+##    With twins set, that many extra students are given the name of a
+##    student in another course on the same playlist and watch nothing, so
+##    the views of the first match both of them by name.
+##
+##    The same scale and seed always give the same files. make_config
+##    returns the config dictionary the lib modules need to read them.
+##
+#########################################################################
+
+# students, videos, views and playlists for each preset
+SCALES = {
+    'tiny':   (300, 24, 10000, 2),
+    'small':  (2000, 100, 100000, 5),
+    'medium': (10000, 500, 1000000, 10),
+    'large':  (50000, 2000, 10000000, 20)
+}
+
+STUDENTS_PER_COURSE = 30
+
+FIRST_NAMES = [a + b for a in ['al', 'be', 'ca', 'da', 'el', 'fa', 'ga', 'ha', 'jo', 'ka', 'li', 'ma']
+                     for b in ['na', 'ron', 'sie', 'vin', 'ria', 'tt', 'den', 'lyn']]
+LAST_NAMES = [a + b for a in ['smi', 'jon', 'bro', 'gar', 'mil', 'dav', 'rod', 'mar', 'her', 'lop',
+                              'gon', 'wil', 'and', 'tho', 'tay', 'moo']
+                    for b in ['th', 'son', 'ez', 'ler', 'is', 'ton', 'man', 'ley', 'ford', 'ins']]
+
+# Views start in the spring 2024 term
+VIEW_START = 1704067200     # 2024-01-01 00:00:00
+VIEW_END = 1719705600       # 2024-06-30 00:00:00
+
+
+#############################################################################
+##
+##  Returns the config the lib modules need to run against a data folder
+##
+
+def make_config(folder):
+
+    return {
+        'rootdir': folder,
+        'homedir': folder,
+        'reports_db': os.path.join(folder, 'reports.db'),
+        'temp_db': os.path.join(folder, 'temp', 'reports.db'),
+        'archive_folder': os.path.join(folder, 'archive'),
+        'run_folder': os.path.join(folder, 'runs'),
+        'report_folder': os.path.join(folder, 'reports'),
+        'gradebook_shared_folder': os.path.join(folder, 'gradebooks'),
+        'suppress_console_output': True,
+        'download_reports': False,
+        'clear_online_data': False,
+        'database': { 'filename': 'reports.db', 'lname_col': 0, 'fname_col': 1, 'playpct_col': 6,
+                      'factor_col': 7, 'totalplaytime_col': 8, 'userpid_col': 9 },
+        'view_data': { 'lname_col': 0, 'fname_col': 1, 'videoname_col': 2, 'videolength_col': 3,
+                       'playlength_col': 4, 'totalplaytime_col': 5, 'starttime_col': 6,
+                       'endtime_col': 7, 'userpid_col': 8 },
+        'video_data': { 'filename': os.path.join(folder, 'videodata.csv'), 'videoset_col': 0,
+                        'videoname_col': 1, 'd2lname_col': 2, 'length_col': 3,
+                        'downloadresults_col': 4, 'directlink_col': 5 },
+        'class_list': { 'filename': os.path.join(folder, 'classes.csv'), 'videoset_col': 0,
+                        'course_col': 1, 'termstart_col': 2, 'termend_col': 3,
+                        'instructor_col': 4, 'email_col': 5 },
+        'student_list': { 'filename': os.path.join(folder, 'students.csv'), 'course_col': 0,
+                          'lname_col': 1, 'fname_col': 2, 'sid_col': 3, 'email_col': 4 },
+        'ir_extract': { 'filename': os.path.join(folder, 'extract.csv'), 'course_col': 0,
+                        'sid_col': 1, 'stufirst_col': 2, 'stulast_col': 3, 'stuemail_col': 4 }
+    }
+
+
+#############################################################################
+##
+##  Writes the data set to folder, replacing anything already there
+##
+
+def generate(folder, students=2000, videos=100, views=100000, playlists=5, seed=1, twins=0):
+
+    rnd = random.Random(seed)
+
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    for subfolder in ['reports', 'gradebooks', 'temp']:
+        os.makedirs(os.path.join(folder, subfolder))
+
+    video_list = write_videos(folder, rnd, videos, playlists)
+    courses = write_classes(folder, rnd, students, playlists)
+    student_list = write_students(folder, rnd, students, courses, twins)
+    write_extract(folder, rnd, student_list)
+    write_reports(folder, rnd, video_list, courses, student_list[:students], views)
+    write_gradebooks(folder, rnd, video_list, courses, student_list)
+
+
+# Returns a list of (playlist, name, d2lname, length)
+def write_videos(folder, rnd, videos, playlists):
+
+    video_list = []
+    for i in range(videos):
+        playlist = f'pl{i % playlists:03d}'
+        number = i // playlists
+        video_list.append((playlist, f'{playlist}_video_{number:04d}', f'{number}.1 Video Points Grade',
+                           rnd.randint(120, 1500)))
+
+    with open(os.path.join(folder, 'videodata.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['videoset', 'video_name', 'd2l_name', 'length', 'download_results', 'direct_link'])
+        for i, (playlist, name, d2lname, length) in enumerate(video_list):
+            writer.writerow([playlist, name, d2lname, length, 'TRUE',
+                             f'https://example.yuja.com/V/Video?v={100000 + i}&node=1'])
+
+    return video_list
+
+
+# Returns a list of (playlist, course, instructor). One course in five has
+#   already ended, so missed videos are graded as zero.
+def write_classes(folder, rnd, students, playlists):
+
+    courses = []
+    for i in range(max(1, students // STUDENTS_PER_COURSE)):
+        courses.append((f'pl{i % playlists:03d}', f'crs-{i:05d}', f'inst_{i:05d}'))
+
+    with open(os.path.join(folder, 'classes.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['videoset', 'course', 'termstart', 'termend', 'instructor', 'email'])
+        for i, (playlist, course, instructor) in enumerate(courses):
+            termend = '6/30/2024' if i % 5 == 0 else '12/31/2099'
+            writer.writerow([playlist, course, '1/1/2024', termend, instructor, f'{instructor}@example.edu'])
+
+    return courses
+
+
+# Returns a list of (course index, lname, fname, sid, email, userpid), with
+#   the twins at the end. A few students share a name, as they do in real
+#   classes.
+def write_students(folder, rnd, students, courses, twins=0):
+
+    student_list = []
+    for i in range(students):
+        student_list.append((i % len(courses), rnd.choice(LAST_NAMES), rnd.choice(FIRST_NAMES),
+                             f'{100000 + i:08d}', f'stu{100000 + i}@example.edu', 5000000 + i))
+
+    # Only students with another course on their playlist can have a twin
+    others = [[j for j in range(len(courses)) if j != i and courses[j][0] == courses[i][0]]
+              for i in range(len(courses))] if twins > 0 else []
+    candidates = [student for student in student_list if len(others[student[0]]) > 0]
+    for i in range(students, students + twins if len(candidates) > 0 else students):
+        course, lname, fname = rnd.choice(candidates)[:3]
+        student_list.append((rnd.choice(others[course]), lname, fname,
+                             f'{100000 + i:08d}', f'stu{100000 + i}@example.edu', 5000000 + i))
+
+    with open(os.path.join(folder, 'students.csv'), 'w', newline='', encoding='ISO-8859-1') as f:
+        writer = csv.writer(f)
+        writer.writerow(['course', 'lastname', 'firstname', 'sid', 'email'])
+        for course, lname, fname, sid, email, userpid in student_list:
+            writer.writerow([courses[course][1], lname, fname, sid, email])
+
+    return student_list
+
+
+# The IR extract drops one student in a hundred and adds one new student
+#   for every hundred
+def write_extract(folder, rnd, student_list):
+
+    with open(os.path.join(folder, 'extract.csv'), 'w', newline='', encoding='ISO-8859-1') as f:
+        writer = csv.writer(f)
+        writer.writerow(['course', 'sid', 'first', 'last', 'email'])
+        for i, (course, lname, fname, sid, email, userpid) in enumerate(student_list):
+            if rnd.random() >= 0.01:
+                writer.writerow([f'crs-{course:05d}', sid, fname, lname, email])
+            if i % 100 == 99:
+                writer.writerow([f'crs-{course:05d}', f'9{sid[1:]}', rnd.choice(FIRST_NAMES),
+                                 rnd.choice(LAST_NAMES), f'new{sid}@example.edu'])
+
+
+# Each video is watched by students from the courses using its playlist,
+#   one to three times each, at a mix of playback speeds
+def write_reports(folder, rnd, video_list, courses, student_list, views):
+
+    students_by_playlist = {}
+    for student in student_list:
+        students_by_playlist.setdefault(courses[student[0]][0], []).append(student)
+
+    views_per_video = max(1, views // len(video_list))
+
+    for playlist, name, d2lname, length in video_list:
+        viewers = students_by_playlist.get(playlist, [])
+        rows = []
+
+        while len(rows) < views_per_video and len(viewers) > 0:
+            course, lname, fname, sid, email, userpid = rnd.choice(viewers)
+            attempts = []
+            for i in range(min(rnd.randint(1, 3), views_per_video - len(rows))):
+                start = rnd.randint(VIEW_START, VIEW_END)
+                playlength = rnd.randint(0, length)
+                speed = rnd.choice([1, 1, 1, 1, 1.25, 1.5, 2, 3, 5])
+                attempts.append((start, playlength, start + int(playlength / speed)))
+
+            total = sum(playlength for start, playlength, end in attempts)
+            initial = ' ' + rnd.choice('ABCDEFGH') if rnd.random() < 0.1 else ''
+            for start, playlength, end in attempts:
+                rows.append([lname.title(), fname.title() + initial, name, length, playlength, total,
+                             time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(start)),
+                             time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(end)), userpid])
+
+        with open(os.path.join(folder, 'reports', f'{name}_report.csv'), 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['lastname', 'firstname', 'videoname', 'videolength', 'playlength',
+                             'totalplaytime', 'starttime', 'endtime', 'userpid'])
+            writer.writerows(rows)
+
+
+# A quarter of the instructors have a gradebook with due dates and a few
+#   grades entered by hand
+def write_gradebooks(folder, rnd, video_list, courses, student_list):
+
+    students_by_course = {}
+    for student in student_list:
+        students_by_course.setdefault(student[0], []).append(student)
+
+    for i, (playlist, course, instructor) in enumerate(courses):
+        if i % 4 != 0:
+            continue
+
+        videos = [video for video in video_list if video[0] == playlist]
+        with open(os.path.join(folder, 'gradebooks', f'{instructor}.csv'), 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['OrgDefinedID', 'Username'] + [video[2] for video in videos] + ['End-Of-Line Indicator'])
+            writer.writerow(['0', 'duedates'] + [rnd.choice(['', '', '3/15/2024', '5/1/2024']) for video in videos] + ['#'])
+            for course_index, lname, fname, sid, email, userpid in students_by_course.get(i, []):
+                grades = [rnd.choice(['', '', '', '', '100', '50', '0']) for video in videos]
+                writer.writerow([sid.lstrip('0'), email.split('@')[0]] + grades + ['#'])
+
+
+##############################################################################
+##                                                                 MAIN PROGRAM
+##############################################################################
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Writes a synthetic data set for the grader.')
+    parser.add_argument('folder', help='folder to write the data set to, it is replaced if it exists')
+    parser.add_argument('--scale', choices=SCALES.keys(), default='small')
+    parser.add_argument('--students', type=int)
+    parser.add_argument('--videos', type=int)
+    parser.add_argument('--views', type=int)
+    parser.add_argument('--playlists', type=int)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--twins', type=int, default=0,
+                        help='students given the name of a student in another course on their playlist')
+    args = parser.parse_args()
+
+    students, videos, views, playlists = SCALES[args.scale]
+    generate(args.folder, args.students or students, args.videos or videos, args.views or views,
+             args.playlists or playlists, args.seed, args.twins)
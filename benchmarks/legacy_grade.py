@@ -0,0 +1,205 @@
+import sqlite3
+from datetime import datetime
+
+#########################################################################
+##
+##  NOTES:
+##
+##    A frozen copy of grade.process_video_grades from the baseline, before
+##    any work was done on the database or on grading, along with the util
+##    helpers it used. It imports nothing from lib, so a change there can't
+##    change it too, and equivalence.py can use it as the oracle every other
+##    engine is compared with. It must not be changed to follow grade.py.
+##
+##    Students are found by the original scan of every view of the video,
+##    comparing last names and first names without the middle initial. The
+##    YuJa identities aren't used or learned.
+##
+##    The only change is to the query. The baseline read view_data, with the
+##    times stored as text and compared with the term dates as datetimes.
+##    That table is now view_data_compat with the times in epoch seconds, so
+##    the query turns them back into the same text and puts the columns in
+##    the baseline order.
+##
+#########################################################################
+
+
+def process_video_grades(config, class_list, video_data):
+
+    msg = ''
+    db_config = config['database']
+    video_config = config['video_data']
+    db = sqlite3.connect(config['temp_db'])
+
+    sql = '''SELECT * FROM (SELECT lname, fname, video, datetime(starttime, 'unixepoch') AS starttime,
+                                   datetime(endtime, 'unixepoch') AS endtime, playlength, playpct, factor,
+                                   totalplaytime
+                            FROM view_data_compat)
+             WHERE video LIKE ? AND starttime >= ? AND starttime <= ?'''
+
+    # traverse through each course
+    for course in class_list:
+
+        msg += f"\nProcessing grades for: {course.name}\n"
+
+        # Get a list of all videos that need to be evaluated for the class
+        videos = get_videos_in_playlist(course.videoset, video_data)
+
+        # Get the term start and term end dates for the class - specified in classes.csv
+        startdate = course.termstart.split('/')
+        termstartdate = datetime(int(startdate[2]), int(startdate[0]), int(startdate[1]), 0, 0, 0)
+
+        enddate = course.termend.split('/')
+        termenddate = datetime(int(enddate[2]), int(enddate[0]), int(enddate[1]), 23, 59, 59)
+
+        # go through each video in the course playlist
+        for video in videos:
+
+            msg += f"Processing video: {video['name']}\n"
+
+            # Get the video's due date if it exists
+            duedates = get_student_by_username(course, 'duedates')
+            if duedates != None:
+                if video['name'] in duedates.videoswatched.keys():
+                    duedate = duedates.videoswatched[video['name']]
+                    date = duedate.split('/')
+                    try:
+                        termenddate = datetime(int(date[2]), int(date[0]), int(date[1]), 23, 59, 59)
+                    except IndexError:
+                        print(f"There is a due-date format error in {course.name}. Please check the d2l gradebook.")
+                        raise SystemExit(-1)
+
+            #### Query all the views for this video within the term dates
+            #### then loop through it and compile grades
+            cursor = db.cursor()
+            cursor.execute(sql, (video['name'], termstartdate, termenddate))
+            view_data = cursor.fetchall()
+
+            # Get the total amount of time each student spent on the video
+            for student in course.students:
+
+                if student.username != 'duedates':
+
+                    # Retrieve all the views pertinent to this particular student
+                    views = get_views_for_student(config, student, view_data)
+
+                    if len(views) > 0:
+
+                        # Get the total video run time
+                        total_video_time = video['length']
+
+                        # Get the total play time reported by Yuja for all attempts
+                        total_play_time = get_max_of_column(views, db_config['totalplaytime_col'])
+                        total_play_pct = round(float(total_play_time) / float(total_video_time) * 100, 0)
+
+                        # Calculate an adjusted play time for this student - which
+                        #   includes penalties for high speed playback
+                        adjusted_play_time = 0
+
+                        for view in views:
+
+                            playtime = 0
+                            playfactor = view[db_config['factor_col']]
+                            playpct = view[db_config['playpct_col']]
+
+                            # Watching videos at less than 1.5 speed is okay
+                            if playfactor <= 1.618:
+                                playtime = playpct
+
+                            # Watching videos between 1.5 and 4 speed incur a penalty
+                            elif playfactor <= 4:
+                                playtime = round(playpct / playfactor, 0)
+
+                            # Watching at greater than 4 speed get no credit
+                            else:
+                                playtime = 0
+
+                            adjusted_play_time += playtime
+
+                        grade = min(adjusted_play_time, total_play_pct)
+
+                        # Get the amount of time reported for this student to have watched already
+                        if student.videoswatched.get(video['name']) != None:
+                            override_play_time = student.videoswatched[video['name']]
+                            grade = max(grade, override_play_time)
+
+                        if grade >= 95:
+                            grade = 100
+
+                        student.videoswatched[video['name']] = int(grade)
+                        msg += f"Student {student.lname[0]}, {student.fname[0].ljust(35,'.')} {grade}%\n"
+
+                    #  If the student hasn't watched the video by the due date assign a grade of zero
+                    elif datetime.now() > termenddate:
+                        if student.videoswatched[video['name']] == None:
+                            student.videoswatched[video['name']] = 0
+
+                        student.videoswatched[video['name']] = max(student.videoswatched[video['name']], 0)
+                        if student.videoswatched[video['name']] == 0:
+                            msg += f"Student {student.lname[0]}, {student.fname[0].ljust(35,'.')} 0% --> Did not watch by the due date\n"
+                        else:
+                            msg += f"Student {student.lname[0]}, {student.fname[0].ljust(35,'.')} {student.videoswatched[video['name']]}%"
+
+    return msg
+
+
+###############################################################################
+##
+##  The util helpers the baseline grading used, as they were then
+##
+
+def get_max_of_column(data, column):
+
+    # assume the max occurs in the first row
+    max = data[0][column]
+    for i in range(0, len(data)):
+        if data[i][column] > max:
+            max = data[i][column]
+
+    return max
+
+
+def get_videos_in_playlist(playlist, video_data):
+
+    return list(filter(lambda x: x['set'] == playlist, video_data))
+
+
+def remove_mid_inital(name):
+
+    names = name.split(' ')
+
+    # Most students only have first name an a single initial for them just
+    #  return the first name
+
+    if len(names) == 1:
+        return names[0]
+
+    else:
+
+        # Otherwise, check to see if the last value provided is one character
+        #  and if it is, remove it. The last statements joins the list elements
+        #  into a string
+
+        mid_initial = names[-1]
+        if len(mid_initial) == 1:
+            return ' '.join(names[0:-1])
+
+
+def get_views_for_student(config, student, view_data):
+
+    db_config = config['database']
+    found_views = []
+    for view in view_data:
+        lname = view[db_config['lname_col']]
+        fname = remove_mid_inital(view[db_config['fname_col']])
+        if (fname in student.fname) and (lname in student.lname):
+            found_views.append(view)
+    return found_views
+
+
+def get_student_by_username(course, username):
+
+    for student in course.students:
+        if student.username == username:
+            return student
+    return None
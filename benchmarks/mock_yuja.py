@@ -0,0 +1,232 @@
+import json, time, random, threading, argparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+#########################################################################
+##
+##  NOTES:
+##
+##    A local stand-in for the parts of YuJa the grader uses, so the download,
+##    video length and delete code can be load tested offline. Point the
+##    grader at it with yuja_url = 'http://localhost:8123' in config.toml.
+##
+##      /Login                                                 - login form
+##      /Dashboard/Analytics/Data/UserVideoPlaybackStatisticsJSON
+##      /Dashboard/Analytics/Data/UserVideoTotalPlayLengthJSON
+##      /P/Data/VideoListJSON
+##      /Dashboard/TMSIKUGCCT/Data/ClassVideoPlaybackStatisticsJSON (POST)
+##      /stats                                                 - request counts
+##
+##    The payloads are made up but always the same for the same videoPID.
+##    Every response is held back by a random latency, and a share of the
+##    requests can be failed with a 500 error page or turned away with a 429
+##    "Too Many Requests" page, the way YuJa does under load.
+##
+#########################################################################
+
+LOGIN_PAGE = '''<html><body>
+<form method="post" action="/Login">
+<input id="loginuserid" name="user"><input id="password" name="password" type="password">
+<button id="loginButton" type="submit">Log In</button>
+</form></body></html>'''
+
+DASHBOARD_PAGE = '<html><body>Dashboard</body></html>'
+ERROR_PAGE = '<html><body>500 Internal Server Error</body></html>'
+THROTTLE_PAGE = '<html><body>429 Too Many Requests</body></html>'
+
+
+#############################################################################
+##
+##  The behaviour of the server, shared by every request
+##
+
+class MockSettings:
+    def __init__(self, views=200, latency=0.05, error_rate=0.0, throttle_rate=0.0, seed=1):
+        self.views = views
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    ## Picks how a request will be answered: 'ok', 'error' or 'throttled'
+    def outcome(self):
+        with self.lock:
+            roll = self.random.random()
+            delay = self.random.uniform(0.5, 1.5) * self.latency
+        time.sleep(delay)
+
+        if roll < self.throttle_rate:
+            return 'throttled'
+        if roll < self.throttle_rate + self.error_rate:
+            return 'error'
+        return 'ok'
+
+
+#############################################################################
+##
+##  Builds the made up views of a video. Each viewer has a userPID, a name
+##    and one to three views, times are in milliseconds as YuJa gives them.
+##
+
+def make_views(video_pid, count, seed):
+
+    rnd = random.Random(f'{seed}-{video_pid}')
+    length = rnd.randint(120, 1500) * 1000
+
+    views = []
+    user_pid = 0
+    while len(views) < count:
+        user_pid += 1
+        for i in range(rnd.randint(1, 3)):
+            start = rnd.randint(1704067200, 1719705600) * 1000
+            played = rnd.randint(0, length // 1000) * 1000
+            views.append({ 'userPID': 7000000 + user_pid, 'firstname': f'First{user_pid}',
+                           'lastname': f'Last{user_pid}', 'totalPlayLength': played,
+                           'firstWatched': start, 'lastWatched': start + played })
+
+    return views[:count], length
+
+
+def make_total_play_lengths(views):
+
+    totals = {}
+    for view in views:
+        totals[view['userPID']] = totals.get(view['userPID'], 0) + view['totalPlayLength']
+
+    return [{ 'userPID': user_pid, 'totalPlayLength': total } for user_pid, total in totals.items()]
+
+
+#############################################################################
+##
+##  Answers the requests
+##
+
+class MockYujaHandler(BaseHTTPRequestHandler):
+    settings = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, body, content_type='application/json'):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_json(self, name, make_payload):
+        settings = self.settings
+        settings.count(name)
+
+        outcome = settings.outcome()
+        if outcome == 'throttled':
+            settings.count('throttled')
+            self.send(429, THROTTLE_PAGE, 'text/html')
+        elif outcome == 'error':
+            settings.count('errors')
+            self.send(500, ERROR_PAGE, 'text/html')
+        else:
+            self.send(200, json.dumps(make_payload()))
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        settings = self.settings
+
+        if url.path == '/Login':
+            settings.count('login')
+            self.send(200, LOGIN_PAGE, 'text/html')
+
+        elif url.path == '/Dashboard':
+            self.send(200, DASHBOARD_PAGE, 'text/html')
+
+        elif url.path == '/Dashboard/Analytics/Data/UserVideoPlaybackStatisticsJSON':
+            video_pid = query.get('videoPID', ['0'])[0]
+            self.send_json('playback', lambda: { 'data': make_views(video_pid, settings.views, settings.seed)[0] })
+
+        elif url.path == '/Dashboard/Analytics/Data/UserVideoTotalPlayLengthJSON':
+            video_pid = query.get('videoPID', ['0'])[0]
+            views = lambda: make_views(video_pid, settings.views, settings.seed)[0]
+            self.send_json('play_length', lambda: { 'data': { 'totalPlayLengths': make_total_play_lengths(views()) } })
+
+        elif url.path == '/P/Data/VideoListJSON':
+            video_pid = query.get('videoID[]', ['0'])[0]
+            length = lambda: make_views(video_pid, 0, settings.seed)[1] // 1000
+            self.send_json('video_list', lambda: { 'data': [{ 'duration': length() }] })
+
+        elif url.path == '/stats':
+            with settings.lock:
+                self.send(200, json.dumps(settings.counts))
+
+        else:
+            self.send(404, '<html><body>404 Not Found</body></html>', 'text/html')
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        if url.path == '/Login':
+            self.send_response(302)
+            self.send_header('Location', '/Dashboard')
+            self.send_header('Set-Cookie', 'session=mock; Path=/')
+            self.end_headers()
+
+        elif url.path == '/Dashboard/TMSIKUGCCT/Data/ClassVideoPlaybackStatisticsJSON':
+            self.send_json('delete', lambda: { 'success': True })
+
+        else:
+            self.send(404, '<html><body>404 Not Found</body></html>', 'text/html')
+
+
+#############################################################################
+##
+##  Starts the server on a background thread and returns it, port 0 picks a
+##    free port. server.server_address has the port it ended up on, and
+##    server.shutdown() stops it.
+##
+
+def start_server(port=0, settings=None):
+
+    handler = type('Handler', (MockYujaHandler,), { 'settings': settings or MockSettings() })
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+
+    thread = threading.Thread(target=server.serve_forever, name='mock_yuja', daemon=True)
+    thread.start()
+
+    return server
+
+
+##############################################################################
+##                                                                 MAIN PROGRAM
+##############################################################################
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Runs a local stand-in for YuJa.')
+    parser.add_argument('--port', type=int, default=8123)
+    parser.add_argument('--views', type=int, default=200, help='views returned for each video')
+    parser.add_argument('--latency', type=float, default=0.05, help='average response time in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests that fail')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of requests turned away')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    settings = MockSettings(args.views, args.latency, args.error_rate, args.throttle_rate, args.seed)
+    server = start_server(args.port, settings)
+    print(f'Mock YuJa running on http://127.0.0.1:{server.server_address[1]}, press Ctrl-C to stop.')
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+        print(json.dumps(settings.counts, indent=2))
@@ -0,0 +1,27 @@
+import os, sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'lib'))
+
+import pipeline
+
+#########################################################################
+##
+##  NOTES:
+##
+##    Grades a data set the way the --pipeline mode does, so equivalence.py
+##    can check it as an engine. Nothing is downloaded and every report is
+##    already in the database, so each playlist is graded as soon as the
+##    load thread has found that, a course at a time, with the identities
+##    learned at the end.
+##
+##    The class list given has its instructor gradebooks loaded already.
+##    The roster thread loads them again, which changes nothing.
+##
+#########################################################################
+
+
+def process_video_grades(config, class_list, video_data):
+
+    error, msg, class_list = pipeline.run_pipeline(dict(config, download_reports=False), video_data,
+                                                   lambda: class_list)
+    return msg
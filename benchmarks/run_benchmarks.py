@@ -0,0 +1,224 @@
+import os, sys, gc, json, time, shutil, sqlite3, platform, statistics, subprocess, argparse
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(os.path.join(ROOT_DIR, 'lib'))
+
+import util, video, student, grade
+import database as db
+import generate_data
+
+#########################################################################
+##
+##  NOTES:
+##
+##    Times the main stages of the grader on a synthetic data set from
+##    generate_data.py, fully offline. Each stage is set up from the same
+##    starting files every time, so stages can be timed on their own and in
+##    any order:
+##
+##      load_views_into_db            - into an empty reports database
+##      verify_student_data
+##      refresh_students
+##      load_instructor_gradebooks
+##      process_video_grades          - against the loaded database
+##      create_instructor_gradebooks
+##
+##    Every stage is run --repeat times and the median and fastest time are
+##    reported. The results can be saved with --output and compared against
+##    another version's results with --compare.
+##
+##      python run_benchmarks.py --scale small --output before.json
+##      python run_benchmarks.py --scale small --compare before.json
+##
+#########################################################################
+
+STAGES = ['load_views_into_db', 'verify_student_data', 'refresh_students',
+          'load_instructor_gradebooks', 'process_video_grades', 'create_instructor_gradebooks']
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Times the grading stages on synthetic data.')
+    parser.add_argument('--scale', choices=generate_data.SCALES.keys(), default='small')
+    parser.add_argument('--data', help='data folder to use, generated there if it is missing '
+                                       '(defaults to benchmarks/data/<scale>)')
+    parser.add_argument('--regenerate', action='store_true', help='write the data set again')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--output', help='save the results to this JSON file')
+    parser.add_argument('--compare', help='compare against results saved with --output')
+    args = parser.parse_args()
+
+    data_folder = args.data or os.path.join(ROOT_DIR, 'benchmarks', 'data', args.scale)
+    if args.regenerate or not os.path.exists(os.path.join(data_folder, 'videodata.csv')):
+        print(f'Generating the {args.scale} data set in {data_folder}...')
+        students, videos, views, playlists = generate_data.SCALES[args.scale]
+        generate_data.generate(data_folder, students, videos, views, playlists, args.seed)
+
+    bench = Benchmark(data_folder)
+
+    results = { 'scale': args.scale, 'environment': get_environment(), 'stages': {} }
+    for stage in args.stages:
+        times = bench.time_stage(stage, args.repeat)
+        results['stages'][stage] = { 'median': statistics.median(times), 'min': min(times),
+                                     'max': max(times), 'times': times }
+        print(f'{stage:32} median {statistics.median(times):9.4f} s   min {min(times):9.4f} s')
+
+    print(format_summary(results, load_results(args.compare)))
+
+    if args.output != None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+##############################################################################
+##
+##  Works on a copy of the data set, so the original files are never changed
+##    by the stages that rewrite them
+##
+
+class Benchmark:
+    def __init__(self, data_folder):
+        self.data_folder = data_folder
+        self.work_folder = os.path.join(data_folder, 'work')
+        self.config = generate_data.make_config(self.work_folder)
+        self.loaded_db = os.path.join(data_folder, 'loaded.db')
+
+        # The loaded database is made again the first time it is needed, as one
+        #   left by another version of the code may not be what this one loads
+        if os.path.exists(self.loaded_db):
+            os.remove(self.loaded_db)
+
+        self.reset()
+        error, msg, self.video_data = video.load_video_data(self.config)
+
+    ## Puts a fresh copy of the input files in the work folder
+    def reset(self):
+        if os.path.exists(self.work_folder):
+            shutil.rmtree(self.work_folder)
+        os.makedirs(os.path.join(self.work_folder, 'temp'))
+
+        for filename in ['videodata.csv', 'classes.csv', 'students.csv', 'extract.csv']:
+            shutil.copy(os.path.join(self.data_folder, filename), self.work_folder)
+        for folder in ['reports', 'gradebooks']:
+            shutil.copytree(os.path.join(self.data_folder, folder), os.path.join(self.work_folder, folder))
+
+    ## An empty reports database, or one with every report already loaded
+    def reset_db(self, loaded):
+        if os.path.exists(self.config['temp_db']):
+            os.remove(self.config['temp_db'])
+
+        if not loaded:
+            db.create_report_db(dict(self.config, reports_db=self.config['temp_db']))
+            return
+
+        if not os.path.exists(self.loaded_db):
+            self.reset_db(False)
+            db.load_views_into_db(self.config)
+            shutil.copy(self.config['temp_db'], self.loaded_db)
+        shutil.copy(self.loaded_db, self.config['temp_db'])
+
+    def class_list(self):
+        error, msg, class_list = student.create_class_list(self.config, self.video_data)
+        return class_list
+
+    ## Sets a stage up and returns the call to be timed
+    def prepare(self, stage):
+        self.reset()
+        config = self.config
+
+        if stage == 'load_views_into_db':
+            self.reset_db(False)
+            return lambda: db.load_views_into_db(config)
+
+        if stage == 'verify_student_data':
+            return lambda: student.verify_student_data(config)
+
+        if stage == 'refresh_students':
+            class_list = self.class_list()
+            return lambda: student.refresh_students(config, class_list)
+
+        if stage == 'load_instructor_gradebooks':
+            class_list = self.class_list()
+            return lambda: grade.load_instructor_gradebooks(config, class_list, self.video_data)
+
+        self.reset_db(True)
+        class_list = grade.load_instructor_gradebooks(config, self.class_list(), self.video_data)
+
+        if stage == 'process_video_grades':
+            return lambda: grade.process_video_grades(config, class_list, self.video_data)
+
+        grade.process_video_grades(config, class_list, self.video_data)
+        return lambda: grade.create_instructor_gradebooks(config, class_list, self.video_data)
+
+    def time_stage(self, stage, repeat):
+        times = []
+        for i in range(repeat):
+            run = self.prepare(stage)
+            gc.collect()
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+        return times
+
+
+##############################################################################
+##
+##  Describes the machine and the version of the code that was timed, so
+##    saved results can be told apart
+##
+
+def get_environment():
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR,
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+
+    return { 'python': platform.python_version(), 'platform': platform.platform(),
+             'sqlite': sqlite3.sqlite_version, 'commit': commit,
+             'time': time.strftime('%Y-%m-%d %H:%M:%S') }
+
+
+def load_results(filename):
+
+    if filename == None:
+        return None
+    with open(filename) as f:
+        return json.load(f)
+
+
+##############################################################################
+##
+##  A table of the median times, with the change from an earlier run
+##
+
+def format_summary(results, baseline=None):
+
+    environment = results['environment']
+    msg = f"\nScale: {results['scale']}, commit {environment['commit']}, Python {environment['python']}, " \
+          f"SQLite {environment['sqlite']}\n\n"
+
+    msg += 'Stage'.ljust(32) + 'Median (s)'.rjust(12) + 'Min (s)'.rjust(12)
+    if baseline != None:
+        msg += 'Before (s)'.rjust(12) + 'Speedup'.rjust(10)
+    msg += '\n'
+
+    for stage, timing in results['stages'].items():
+        msg += stage.ljust(32) + f"{timing['median']:12.4f}{timing['min']:12.4f}"
+        if baseline != None and stage in baseline['stages']:
+            before = baseline['stages'][stage]['median']
+            msg += f"{before:12.4f}{before / timing['median']:9.2f}x"
+        msg += '\n'
+
+    return msg
+
+
+##############################################################################
+##                                                                 MAIN PROGRAM
+##############################################################################
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+import sys, importlib
+
+#########################################################################
+##
+##  NOTES:
+##
+##    Everything that talks to the video host goes through this module. The
+##    module that does the work (yuja.py unless the 'backend' setting names
+##    another one) pulls in selenium, BeautifulSoup and webdriver_manager,
+##    which take a while to import. It is only imported the first time one
+##    of the functions below is called, so runs that don't download or
+##    clear anything never load any of them.
+##
+#########################################################################
+
+
+##############################################################################
+##
+##  Used for testing and debugging purposes for this particular file
+##
+
+def test():
+
+    config = {}
+    print('yuja' in sys.modules)
+    get_backend(config)
+    print('yuja' in sys.modules)
+
+
+##############################################################################
+##
+##  Imports the backend module named in config the first time it is asked for
+##
+
+backends = {}
+
+def get_backend(config):
+
+    name = config.get('backend', 'yuja')
+    if name not in backends:
+        backends[name] = importlib.import_module(name)
+
+    return backends[name]
+
+
+##############################################################################
+##
+##  The functions the rest of the program uses, each handed to the backend
+##
+
+def download_new_reports(config, videodata, on_report=None):
+
+    # Nothing is downloaded, so there's no need to load the backend at all
+    if not config['download_reports']:
+        return 0, ''
+
+    return get_backend(config).download_new_reports(config, videodata, on_report)
+
+
+def delete_view_data_on_yuja(config, videodata):
+
+    return get_backend(config).delete_view_data_on_yuja(config, videodata)
+
+
+def start_web_session(config):
+
+    return get_backend(config).start_web_session(config)
+
+
+def end_web_session(config, driver):
+
+    return get_backend(config).end_web_session(driver)
+
+
+# Closes a session kept open for the next run, if the backend was ever loaded
+def end_kept_web_session(config):
+
+    module = backends.get(config.get('backend', 'yuja'))
+    if module != None:
+        module.end_kept_web_session()
+
+
+def get_video_length(config, driver, id):
+
+    return get_backend(config).get_video_length(config, driver, id)
+
+
+##############################################################################
+##                                                                 MAIN PROGRAM
+##############################################################################
+
+if __name__ == '__main__':
+    test()
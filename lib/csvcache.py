@@ -0,0 +1,167 @@
+import os, io, csv, time, pickle, hashlib, locale, threading
+
+#########################################################################
+##
+##  NOTES:
+##
+##    Keeps the parsed rows of the input CSV files (videodata.csv,
+##    classes.csv, students.csv and the IR extract) so that a file that
+##    hasn't changed isn't read from OneDrive and parsed again:
+##
+##      rows = csvcache.read_csv(config, filename, 'ISO-8859-1')
+##
+##    The rows of each file are pickled to a local folder, 'input_cache_folder'
+##    in config.toml or .videograder_cache in the home folder, along with the
+##    file's size, modification time and SHA-1 hash. A file whose size and
+##    modification time still match is not opened at all. One that OneDrive
+##    has touched without changing is read once to check the hash, and only
+##    parsed again if the hash is different.
+##
+##    Files written with write_csv go into the cache as they are written, so
+##    students.csv, which is rewritten and read again during every run, is
+##    only ever read from disk when something else has changed it. Setting
+##    cache_inputs = false in config.toml reads every file directly.
+##
+##    Rows are handed back as tuples, and the list holding them is a new one
+##    on every call, so callers can change the list but not the cached rows.
+##
+#########################################################################
+
+
+##############################################################################
+##
+##  Used for testing and debugging purposes for this particular file
+##
+
+def test():
+
+    import tempfile
+
+    folder = tempfile.mkdtemp()
+    config = { 'homedir': folder }
+    filename = os.path.join(folder, 'test.csv')
+
+    write_csv(config, filename, [['a', 'b'], [1, None]])
+    entries.clear()
+
+    start = time.perf_counter()
+    print(read_csv(config, filename), f'{time.perf_counter() - start:.6f} seconds')
+
+
+##############################################################################
+##
+##  The entries loaded so far, by the full path of the file they are for
+##
+
+entries = {}
+lock = threading.Lock()
+
+def get_cache_folder(config):
+
+    return config.get('input_cache_folder', os.path.join(config['homedir'], '.videograder_cache'))
+
+
+def get_entry_path(config, path):
+
+    return os.path.join(get_cache_folder(config), hashlib.sha1(path.encode('utf-8')).hexdigest() + '.pickle')
+
+
+def load_entry(config, path):
+
+    with lock:
+        if path in entries:
+            return entries[path]
+
+    try:
+        with open(get_entry_path(config, path), 'rb') as f:
+            entry = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return None
+
+    with lock:
+        entries[path] = entry
+    return entry
+
+
+def save_entry(config, path, entry):
+
+    with lock:
+        entries[path] = entry
+
+    # Written to a temporary file first so a run that is stopped part way
+    #   can't leave a broken entry behind
+    os.makedirs(get_cache_folder(config), exist_ok=True)
+    entry_path = get_entry_path(config, path)
+    with open(entry_path + '.tmp', 'wb') as f:
+        pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(entry_path + '.tmp', entry_path)
+
+
+##############################################################################
+##
+##  Returns every row of a CSV file, the header included
+##
+
+def read_csv(config, filename, encoding=None):
+
+    encoding = encoding or locale.getpreferredencoding(False)
+
+    if not config.get('cache_inputs', True):
+        with open(filename, encoding=encoding) as f:
+            return [tuple(row) for row in csv.reader(f)]
+
+    path = os.path.realpath(filename)
+    stat = os.stat(path)
+    entry = load_entry(config, path)
+
+    if entry != None and entry['encoding'] == encoding:
+        if (entry['size'], entry['mtime']) == (stat.st_size, stat.st_mtime_ns):
+            return list(entry['rows'])
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    digest = hashlib.sha1(data).hexdigest()
+
+    if entry != None and entry['encoding'] == encoding and entry['hash'] == digest:
+        rows = entry['rows']
+    else:
+        rows = [tuple(row) for row in csv.reader(io.StringIO(data.decode(encoding), newline=None))]
+
+    save_entry(config, path, { 'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': digest,
+                               'encoding': encoding, 'rows': rows })
+
+    return list(rows)
+
+
+##############################################################################
+##
+##  Writes rows to a CSV file the way csv.writer does, and keeps them as the
+##    rows that reading the file back would give
+##
+
+def write_csv(config, filename, rows, encoding=None):
+
+    encoding = encoding or locale.getpreferredencoding(False)
+
+    rows = [tuple('' if value == None else str(value) for value in row) for row in rows]
+
+    text = io.StringIO()
+    csv.writer(text).writerows(rows)
+    data = text.getvalue().encode(encoding)
+
+    with open(filename, 'wb') as f:
+        f.write(data)
+
+    if config.get('cache_inputs', True):
+        path = os.path.realpath(filename)
+        stat = os.stat(path)
+        save_entry(config, path, { 'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                                   'hash': hashlib.sha1(data).hexdigest(), 'encoding': encoding, 'rows': rows })
+
+
+##############################################################################
+##                                                                 MAIN PROGRAM
+##############################################################################
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,334 @@
+import os, copy, json, time, socket, datetime, threading, socketserver, traceback
+
+import util, logs
+
+#########################################################################
+##
+##  NOTES:
+##
+##    Keeps the program running between runs, so that the inputs that
+##    haven't changed don't have to be read and checked again every time:
+##
+##      python videograder.py --daemon
+##
+##    The config, the video data and the class list are kept in a Cache and
+##    are only loaded again when one of the files they came from changes.
+##    The YuJa session is kept open as well, a session that has expired is
+##    logged into again by the download's retries. Everything else, the
+##    temporary database and the instructor gradebooks included, is done
+##    fresh on every run as before.
+##
+##    A run starts when the [daemon] section of config.toml says so:
+##
+##      schedule = ['06:00', '12:00', '18:00']   - times of the day to run
+##      interval = 0                             - or every this many minutes
+##      watch = true                             - or when an input changes
+##      poll = 5                                 - seconds between checks
+##      port = 8765                              - of the control socket
+##
+##    or when asked to through the control socket, which only listens on
+##    the local machine. Each request is a line of text and is answered with
+##    a line of JSON:
+##
+##      run      - start a run as soon as the current one finishes
+##      status   - the state of the daemon and its last run
+##      stop     - stop once the current run finishes
+##
+##    python videograder.py --send run sends one of them.
+##
+#########################################################################
+
+DEFAULT_PORT = 8765
+
+
+##############################################################################
+##
+##  Used for testing and debugging purposes for this particular file
+##
+
+def test():
+
+    config = { 'daemon': { 'interval': 0.05, 'poll': 0.5, 'port': 0 },
+               'video_data': { 'filename': 'videodata.csv' }, 'class_list': { 'filename': 'classes.csv' },
+               'student_list': { 'filename': 'students.csv' }, 'ir_extract': { 'filename': 'extract.csv' } }
+
+    def run(config):
+        print('Running with', sorted(config.keys()))
+
+    daemon = Daemon('config.toml', run, lambda path: dict(config))
+    daemon.request_run()
+    threading.Timer(2, lambda: print(send_command('status', daemon.port))).start()
+    threading.Timer(3, lambda: daemon.stop()).start()
+    daemon.serve()
+
+
+##############################################################################
+##
+##  Loaded values kept along with the size and modification time of the files
+##    they came from. A value is handed out as a copy, the runs change the
+##    class list as they grade it.
+##
+
+class Cache:
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, name, filenames, load):
+        found, value = self.lookup(name, filenames)
+        if found:
+            return True, value
+
+        # Stored after loading, as loading the class list rewrites students.csv
+        return False, self.store(name, filenames, load())
+
+    ## Returns whether the value is still current, and a copy of it if it is
+    def lookup(self, name, filenames):
+        with self.lock:
+            entry = self.entries.get(name)
+        if entry != None and entry[0] == get_fingerprint(filenames):
+            return True, copy.deepcopy(entry[1])
+        return False, None
+
+    ## Keeps a copy of value along with the files as they are now
+    def store(self, name, filenames, value):
+        with self.lock:
+            self.entries[name] = (get_fingerprint(filenames), copy.deepcopy(value))
+        return value
+
+    def names(self):
+        with self.lock:
+            return sorted(self.entries.keys())
+
+
+def get_fingerprint(filenames):
+
+    fingerprint = []
+    for filename in filenames:
+        try:
+            stat = os.stat(filename)
+            fingerprint.append((filename, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            fingerprint.append((filename, None, None))
+
+    return fingerprint
+
+
+##############################################################################
+##
+##  Looks a value up in the cache kept in config, and stores one there once it
+##    has been loaded. Without a cache nothing is ever found or kept.
+##
+
+def lookup(config, name, filenames):
+
+    cache = config.get('cache')
+    if cache == None:
+        return False, None
+
+    return cache.lookup(name, filenames)
+
+
+def store(config, name, filenames, value):
+
+    cache = config.get('cache')
+    if cache != None:
+        cache.store(name, filenames, value)
+
+    return value
+
+
+# The input files the video data and the class list are read from
+def get_input_files(config):
+
+    return [config['video_data']['filename'], config['class_list']['filename'],
+            config['student_list']['filename'], config['ir_extract']['filename']]
+
+
+##############################################################################
+##
+##  Runs run(config) on the main thread whenever the schedule, a change to the
+##    inputs or the control socket asks for it, until told to stop
+##
+
+class Daemon:
+    def __init__(self, config_filename, run, load_config=util.load_config):
+        self.config_filename = os.path.realpath(config_filename)
+        self.run = run
+        self.load_config = load_config
+        self.cache = Cache()
+        self.requests = threading.Event()
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.running = False
+        self.runs = 0
+        self.last_run = None
+        self.next_run = None
+        self.watched = None
+        self.port = None
+
+    def get_config(self):
+        from_cache, config = self.cache.get('config', [self.config_filename],
+                                            lambda: self.load_config(self.config_filename))
+        config['cache'] = self.cache
+        config['keep_web_session'] = True
+        return config
+
+    def serve(self):
+        config = self.get_config()
+        settings = config.get('daemon', {})
+
+        server = ControlServer(('127.0.0.1', settings.get('port', DEFAULT_PORT)), self)
+        threading.Thread(target=server.serve_forever, name='control', daemon=True).start()
+        self.port = server.server_address[1]
+        logs.display(f'Listening for commands on port {self.port}')
+
+        self.next_run = self.get_next_run(settings, datetime.datetime.now())
+        self.watched = get_fingerprint(self.get_watched_files(config))
+
+        try:
+            while not self.stopping.is_set():
+                reason = self.get_run_reason(settings)
+                if reason != None:
+                    config = self.run_once(reason)
+                    settings = config.get('daemon', {})
+                    self.next_run = self.get_next_run(settings, datetime.datetime.now())
+                    self.watched = get_fingerprint(self.get_watched_files(config))
+                else:
+                    self.requests.wait(settings.get('poll', 5))
+
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def stop(self):
+        self.stopping.set()
+        self.requests.set()
+
+    def request_run(self):
+        self.requests.set()
+
+    ## Returns why a run should start now, or None if it shouldn't
+    def get_run_reason(self, settings):
+        if self.stopping.is_set():
+            return None
+
+        if self.requests.is_set():
+            self.requests.clear()
+            return 'requested'
+
+        if self.next_run != None and datetime.datetime.now() >= self.next_run:
+            return 'scheduled'
+
+        if settings.get('watch', False):
+            config = self.get_config()
+            if get_fingerprint(self.get_watched_files(config)) != self.watched:
+                return 'inputs changed'
+
+        return None
+
+    def get_watched_files(self, config):
+        return [self.config_filename] + get_input_files(config)
+
+    ## The next time on the schedule, or the next interval, after now
+    def get_next_run(self, settings, now):
+        times = []
+
+        for entry in settings.get('schedule', []):
+            hour, minute = entry.split(':')
+            at = now.replace(hour=int(hour), minute=int(minute), second=0, microsecond=0)
+            if at <= now:
+                at += datetime.timedelta(days=1)
+            times.append(at)
+
+        if settings.get('interval', 0) > 0:
+            times.append(now + datetime.timedelta(minutes=settings['interval']))
+
+        return min(times) if len(times) > 0 else None
+
+    ## Runs the program once, a failed run is logged and the daemon carries on
+    def run_once(self, reason):
+        config = self.get_config()
+
+        with self.lock:
+            self.running = True
+            self.last_run = { 'reason': reason, 'started': time.time(), 'finished': None, 'status': 'running' }
+
+        logs.display(f"\nStarting a run ({reason}) at {time.strftime('%Y-%m-%d %H:%M:%S')}")
+        status = 'completed'
+        try:
+            self.run(config)
+        except SystemExit:
+            status = 'failed'
+        except Exception:
+            status = 'failed'
+            logs.display(traceback.format_exc(), 'error')
+
+        with self.lock:
+            self.running = False
+            self.runs += 1
+            self.last_run.update(finished=time.time(), status=status)
+
+        return config
+
+    def status(self):
+        with self.lock:
+            return { 'running': self.running, 'runs': self.runs, 'last_run': self.last_run,
+                     'next_run': None if self.next_run == None else self.next_run.isoformat(' ', 'seconds'),
+                     'cached': self.cache.names() }
+
+
+##############################################################################
+##
+##  Answers the commands sent to the control socket
+##
+
+class ControlHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        daemon = self.server.owner
+        command = self.rfile.readline().decode('utf-8').strip().lower()
+
+        if command == 'run':
+            daemon.request_run()
+            reply = { 'ok': True, 'msg': 'Run requested.' }
+        elif command == 'status':
+            reply = dict(daemon.status(), ok=True)
+        elif command == 'stop':
+            daemon.stop()
+            reply = { 'ok': True, 'msg': 'Stopping once the current run finishes.' }
+        else:
+            reply = { 'ok': False, 'msg': f'Unknown command "{command}", use run, status or stop.' }
+
+        self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+
+
+class ControlServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, daemon):
+        self.owner = daemon
+        super().__init__(address, ControlHandler)
+
+
+##############################################################################
+##
+##  Sends a command to a running daemon and returns its reply
+##
+
+def send_command(command, port=DEFAULT_PORT):
+
+    with socket.create_connection(('127.0.0.1', port), timeout=10) as connection:
+        connection.sendall((command + '\n').encode('utf-8'))
+        reply = connection.makefile('rb').readline()
+
+    return json.loads(reply)
+
+
+##############################################################################
+##                                                                 MAIN PROGRAM
+##############################################################################
+
+if __name__ == '__main__':
+    test()
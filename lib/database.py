@@ -1,21 +1,213 @@
-import os, sqlite3, csv #pytz
+import os, sqlite3, csv, io, time, hashlib, gzip, shutil #pytz
 from datetime import datetime
 from glob import glob
-import util
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+import util, instrument, logs
+
+#################################################################
+##
+##  The reports database is versioned through SQLite's user_version pragma.
+##    Version 0 is the original single table layout, where the student and
+##    video names were repeated as text on every row. Each migration below
+##    moves the database forward by one version.
+##
+
+SCHEMA_VERSION = 7
+
+# Version 1 - the student and video names are kept once in their own tables
+#   and view_data refers to them by integer id. Times are stored as integer
+#   epoch seconds. The factor is derived from the other columns, so it is
+#   computed by the view_data_compat view rather than stored. view_data_compat
+#   keeps the original column layout that the grading code indexes into.
+
+schema_v1 = '''
+    create table students (
+        student_id       integer primary key,
+        lname            text not null,
+        fname            text not null,
+        UNIQUE (lname, fname)
+    );
+
+    create table videos (
+        video_id         integer primary key,
+        name             text not null UNIQUE
+    );
 
-db_schema = '''
     create table view_data (
-        lname            text,
-        fname            text,
-        video            text,
-        starttime        timestamp,
-        endtime          timestamp,
-        playlength       integer,
-        playpct          integer,
-        factor           real,
-        totalplaytime    integer,
-        UNIQUE (lname, fname, video, starttime, endtime, playlength, playpct, factor)
-    );'''
+        video_id         integer not null references videos,
+        starttime        integer not null,
+        student_id       integer not null references students,
+        endtime          integer not null,
+        playlength       integer not null,
+        playpct          integer not null,
+        totalplaytime    integer not null,
+        PRIMARY KEY (video_id, starttime, student_id, endtime, playlength)
+    ) WITHOUT ROWID;
+
+    create view view_data_compat as
+        select s.lname, s.fname, v.name as video,
+               datetime(d.starttime, 'unixepoch') as starttime,
+               datetime(d.endtime, 'unixepoch') as endtime,
+               d.playlength, d.playpct,
+               case when d.endtime != d.starttime
+                    then d.playlength * 1.0 / (d.endtime - d.starttime)
+                    else 1.0 end as factor,
+               d.totalplaytime
+        from view_data d
+            join students s on s.student_id = d.student_id
+            join videos v on v.video_id = d.video_id;
+'''
+
+# Copies the rows of a version 0 database into the version 1 tables. The
+#   old timestamps were written as 'YYYY-MM-DD HH:MM:SS' text which
+#   strftime('%s') reads as the same wall clock time used for new rows.
+
+migrate_v0_data = '''
+    insert or ignore into students (lname, fname)
+        select distinct lname, fname from view_data_v0;
+
+    insert or ignore into videos (name)
+        select distinct video from view_data_v0;
+
+    insert or replace into view_data
+        select v.video_id, cast(strftime('%s', o.starttime) as integer), s.student_id,
+               cast(strftime('%s', o.endtime) as integer), o.playlength, o.playpct,
+               o.totalplaytime
+        from view_data_v0 o
+            join students s on s.lname = o.lname and s.fname = o.fname
+            join videos v on v.name = o.video;
+
+    drop table view_data_v0;
+'''
+
+# Version 2 - view_data_compat hands back the integer epoch times as they are
+#   stored. Grading compares them against integer term dates, so the video and
+#   time range test is answered straight from the view_data primary key. The
+#   cross join keeps SQLite from picking a full scan of view_data first.
+
+schema_v2 = '''
+    drop view view_data_compat;
+
+    create view view_data_compat as
+        select s.lname, s.fname, v.name as video, d.starttime, d.endtime,
+               d.playlength, d.playpct,
+               case when d.endtime != d.starttime
+                    then d.playlength * 1.0 / (d.endtime - d.starttime)
+                    else 1.0 end as factor,
+               d.totalplaytime
+        from videos v
+            cross join view_data d on d.video_id = v.video_id
+            join students s on s.student_id = d.student_id;
+'''
+
+# Version 3 - report_manifest records each report file that has been loaded so
+#   unchanged reports are not loaded again. mtime is in nanoseconds, ingested
+#   is the epoch time the report was loaded.
+
+schema_v3 = '''
+    create table report_manifest (
+        path             text primary key,
+        size             integer not null,
+        mtime            integer not null,
+        sha256           text not null,
+        ingested         integer not null
+    );
+'''
+
+# Version 4 - download_runs and download_checkpoints keep track of which
+#   videos each download run has finished, so that a run that stopped part
+#   way through can be resumed. Times are epoch seconds and finished is null
+#   until every video in the run has been downloaded.
+
+schema_v4 = '''
+    create table download_runs (
+        run_id           integer primary key,
+        started          integer not null,
+        finished         integer
+    );
+
+    create table download_checkpoints (
+        run_id           integer not null references download_runs,
+        video            text not null,
+        status           text not null,
+        attempts         integer not null,
+        error            text,
+        updated          integer not null,
+        PRIMARY KEY (run_id, video)
+    );
+'''
+
+# Version 5 - user_pid keeps the userPID YuJa gives each viewer, and is null
+#   for views loaded from reports saved before it was kept. identities maps a
+#   userPID to the student it belongs to once grading has matched the two up
+#   by name without any doubt. A userPID that matched more than one student
+#   is marked ambiguous and is left to name matching. view_data_compat adds
+#   user_pid as its last column.
+
+schema_v5 = '''
+    alter table view_data add column user_pid integer;
+
+    drop view view_data_compat;
+
+    create view view_data_compat as
+        select s.lname, s.fname, v.name as video, d.starttime, d.endtime,
+               d.playlength, d.playpct,
+               case when d.endtime != d.starttime
+                    then d.playlength * 1.0 / (d.endtime - d.starttime)
+                    else 1.0 end as factor,
+               d.totalplaytime, d.user_pid
+        from videos v
+            cross join view_data d on d.video_id = v.video_id
+            join students s on s.student_id = d.student_id;
+
+    create table identities (
+        user_pid         integer primary key,
+        sid              text,
+        username         text,
+        status           text not null,
+        updated          integer not null
+    );
+'''
+
+# Version 6 - the timings and counters of every run, written by instrument.py.
+#   Times are epoch seconds, wall and cpu are in seconds and peak_memory is in
+#   bytes, or null when it wasn't measured.
+
+schema_v6 = '''
+    create table run_history (
+        run_id           integer primary key,
+        started          integer not null,
+        finished         integer not null,
+        status           text not null,
+        wall             real not null
+    );
+
+    create table run_stages (
+        run_id           integer not null references run_history,
+        stage            text not null,
+        wall             real not null,
+        cpu              real not null,
+        peak_memory      integer
+    );
+
+    create table run_counters (
+        run_id           integer not null references run_history,
+        name             text not null,
+        value            integer not null,
+        PRIMARY KEY (run_id, name)
+    );
+'''
+
+# Version 7 - archive_state holds the epoch every view starting before it has
+#   been moved to the term archives, so the views from before it in the
+#   nightly reports are left out when they are loaded.
+
+schema_v7 = '''
+    create table archive_state (
+        archived_before  integer not null
+    );
+'''
 
 
 ################################################################
@@ -32,13 +224,20 @@ def test():
 
     util.create_tempdb(config)
     load_views_into_db(config)
+
+    db = open_history_db(config)
+    for video, count in db.execute('''SELECT video, count(*) FROM all_view_data GROUP BY video'''):
+        print(f'{video}: {count} views')
+    db.close()
+
     util.delete_tempdb(config)
 
 
 #################################################################
 ##
 ## Creates a new database to save all the watch data found nightly on yuja.
-##   This just makes a permanent storage location for all the saved watch data
+##   This just makes a permanent storage location for all the saved watch data.
+##   An existing database is upgraded to the current schema version.
 ##
 
 def create_report_db(config):
@@ -46,68 +245,721 @@ def create_report_db(config):
     report_db = config['reports_db']
     db_exists = os.path.exists(report_db)
         
-    if not db_exists:
-        print('Nightly Report Database does not exist, now creating...', end='')
-        conn = sqlite3.connect(report_db)
-        conn.executescript(db_schema)
-        print('[ COMPLETE ]')
-        conn.close()
+    conn = sqlite3.connect(report_db)
+
+    # Shown as one line once it's done, the other setup stages run alongside
+    if get_schema_version(conn) < SCHEMA_VERSION:
+        migrate_report_db(conn)
+        if db_exists:
+            logs.display('Upgrading Nightly Report Database...[ COMPLETE ]')
+        else:
+            logs.display('Nightly Report Database does not exist, now creating...[ COMPLETE ]')
+
+    conn.close()
+
+
+#################################################################
+##
+##  Returns the schema version of an open reports database
+##
+
+def get_schema_version(conn):
+
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+#################################################################
+##
+##  Brings an open reports database up to SCHEMA_VERSION. Each step runs
+##    inside its own transaction along with the user_version update, so an
+##    interrupted upgrade leaves the database at the last completed version.
+##
+
+def migrate_report_db(conn):
+
+    version = get_schema_version(conn)
+    copied_rows = False
+
+    if version < 1:
+        # A version 0 database keeps its rows in the old view_data table,
+        #   move it aside so the rows can be copied into the new layout
+        copied_rows = table_exists(conn, 'view_data')
+        script = schema_v1
+        if copied_rows:
+            script = 'alter table view_data rename to view_data_v0;' + script + migrate_v0_data
+        apply_migration(conn, 1, script)
+
+    if version < 2:
+        apply_migration(conn, 2, schema_v2)
+
+    if version < 3:
+        apply_migration(conn, 3, schema_v3)
+
+    if version < 4:
+        apply_migration(conn, 4, schema_v4)
+
+    if version < 5:
+        apply_migration(conn, 5, schema_v5)
+
+    if version < 6:
+        apply_migration(conn, 6, schema_v6)
+
+    if version < 7:
+        apply_migration(conn, 7, schema_v7)
+
+    # Give the space used by the old layout back to the file system
+    if copied_rows:
+        conn.execute('VACUUM')
+
+
+def apply_migration(conn, version, script):
+
+    conn.executescript(f'BEGIN; {script} PRAGMA user_version = {version}; COMMIT;')
+
+
+def table_exists(conn, name):
+
+    sql = '''SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = ?'''
+    return conn.execute(sql, (name,)).fetchone()[0] > 0
 
 
 ##################################################################
 ##
 ##  Loads the new nightly views from the files saved from yuja's website into
-##    the main database for permanent storage and easy retrieval when grading
+##    the main database for permanent storage and easy retrieval when grading.
+##    Every report that is loaded is recorded in report_manifest, and a report
+##    whose size and modification time, or failing that its contents, match
+##    the manifest has already been loaded and is skipped. A list of report
+##    files can be given to load just those reports.
 ##
 
-def load_views_into_db(config):
+@instrument.hotspot('load_views_into_db')
+def load_views_into_db(config, reportlist=None):
 
-    view_config = config['view_data']
+    # Get a list of all the reports in the report download directory
+    if reportlist == None:
+        folder_path = os.path.join(config['report_folder'], '*_report.csv')
+        reportlist = glob(folder_path)
 
-    insert_sql = '''INSERT OR REPLACE INTO view_data values(?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+    loader = ViewLoader(config)
+    loader.load(reportlist)
+    return loader.close()
 
-    # Get a list of all the reports in the report download directory
-    folder_path = os.path.join(config['report_folder'], '*_report.csv')
-    reportlist = glob(folder_path)
 
-    # Open up the nightly report database for writing
-    db = sqlite3.connect(config['temp_db'], detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
-    cursor = db.cursor()
+##################################################################
+##
+##  Keeps the reports database open, along with the ids of the students and
+##    videos and the manifest, so that reports can be loaded a few at a time,
+##    as the pipeline does when each one is downloaded, without reading them
+##    all again for every report. Each call to load commits the reports it
+##    loaded so they can be graded straight away.
+##
 
-    # Loop through all the files saved from yuja
-    for filename in reportlist:
+class ViewLoader:
+    def __init__(self, config):
+        self.config = config
+        self.view_config = config['view_data']
         
-        fp = open(filename, encoding = 'utf-8')
-        filereader = csv.reader(fp)
-        filedata = list(filereader)
-        filedata = filedata[1:] # skip over column headers
-
-        for view in filedata:
+        # Open up the nightly report database for writing
+        self.db = sqlite3.connect(config['temp_db'])
+        self.cursor = self.db.cursor()
+
+        # Students and videos are stored once and referred to by id, keep the ids
+        #   that already exist in memory so each row doesn't need a lookup
+        self.student_ids = get_student_ids(self.cursor)
+        self.video_ids = get_video_ids(self.cursor)
+        self.manifest = get_report_manifest(self.cursor)
+        self.archived_before = get_archived_before(self.cursor)
             
-            if view != []:
-
-                lname = view[view_config['lname_col']].strip().lower()
-                fname = view[view_config['fname_col']].strip().lower()
-                video = view[view_config['videoname_col']].strip().lower()
-                starttime = datetime.strptime(view[view_config['starttime_col']], '%Y-%m-%d %H:%M:%S')
-                endtime = datetime.strptime(view[view_config['endtime_col']], '%Y-%m-%d %H:%M:%S')
-                playlength = int(view[view_config['playlength_col']])
-                playpct = round(int(playlength) / int(view[view_config['videolength_col']]) * 100)
-                timediff = (endtime - starttime).total_seconds()
-                if timediff != 0:
-                    factor = playlength / timediff
-                else:
-                    factor = 1.0
-                totalplaytime = int(view[view_config['totalplaytime_col']])
+        self.views_loaded = 0
+        self.views_archived = 0
+        self.reports_loaded = 0
+        self.reports_skipped = 0
+
+    def load(self, reportlist):
+        cursor = self.cursor
+
+        # Loop through all the files saved from yuja
+        for filename in reportlist:
                 
-                cursor.execute(insert_sql, (lname, fname, video, starttime, endtime, playlength, playpct, factor, totalplaytime))
+            path = os.path.abspath(filename)
+            stats = os.stat(path)
+            entry = self.manifest.get(path)
+
+            if entry != None and entry[0] == stats.st_size and entry[1] == stats.st_mtime_ns:
+                self.reports_skipped += 1
+                continue
         
-        fp.close()
+            with open(path, 'rb') as fp:
+                content = fp.read()
+            digest = hashlib.sha256(content).hexdigest()
+
+            # A report can be rewritten with exactly the same views in it
+            if entry != None and entry[2] == digest:
+                self.reports_skipped += 1
+
+            else:
+                for lname, fname, video, *view in read_report(content, self.view_config):
+
+                    # The reports are downloaded in full, but the views from
+                    #   archived terms are already in the archive
+                    if view[0] < self.archived_before:
+                        self.views_archived += 1
+                        continue
+
+                    student_id = get_dimension_id(cursor, self.student_ids, 'students', (lname, fname))
+                    video_id = get_dimension_id(cursor, self.video_ids, 'videos', (video,))
+
+                    starttime, endtime, playlength, playpct, totalplaytime, user_pid = view
+                    cursor.execute(view_insert_sql, (video_id, starttime, student_id, endtime, playlength,
+                                                     playpct, totalplaytime, user_pid))
+                    self.views_loaded += 1
+
+                self.reports_loaded += 1
+
+            cursor.execute(manifest_sql, (path, stats.st_size, stats.st_mtime_ns, digest, round(time.time())))
+            self.manifest[path] = (stats.st_size, stats.st_mtime_ns, digest)
+
+        self.db.commit()
+
+    ## Closes the database and returns what was loaded
+    def close(self):
+        # Close the datatbase
+        self.db.commit()
+        self.db.close()
+
+        instrument.count(self.config, 'views_loaded', self.views_loaded)
+        instrument.count(self.config, 'reports_loaded', self.reports_loaded)
+        instrument.count(self.config, 'reports_skipped', self.reports_skipped)
+        instrument.count(self.config, 'archived_views_skipped', self.views_archived)
+
+        msg = f'Loaded {self.views_loaded} views from {self.reports_loaded} reports, ' \
+              f'{self.reports_skipped} unchanged reports were skipped.'
+        if self.views_archived > 0:
+            msg += f' {self.views_archived} views from archived terms were left out.'
+
+        return msg
+
+
+manifest_sql = '''INSERT OR REPLACE INTO report_manifest values(?, ?, ?, ?, ?)'''
+
+# A view loaded again from an older report that has no userPID keeps the one
+#   it already has
+view_insert_sql = '''INSERT INTO view_data values(?, ?, ?, ?, ?, ?, ?, ?)
+                     ON CONFLICT (video_id, starttime, student_id, endtime, playlength) DO UPDATE
+                     SET playpct = excluded.playpct, totalplaytime = excluded.totalplaytime,
+                         user_pid = coalesce(excluded.user_pid, user_pid)'''
+
+
+##################################################################
+##
+##  Reloads every report, including the compressed copies kept by the
+##    'compress' report retention, without checking the manifest. This is for
+##    rebuilding the database after a reset. The reports are read and parsed
+##    by a pool of worker processes, while this process alone writes the rows
+##    they send back into the database.
+##
+
+def rebuild_views_db(config, workers=None):
+
+    if workers == None:
+        workers = os.cpu_count() or 1
+
+    insert_sql = view_insert_sql
+
+    # Load older copies first so that the newest version of a view wins
+    reportlist = glob(os.path.join(config['report_folder'], 'ingested', '*_report_*.csv.gz'))
+    reportlist.sort(key=os.path.getmtime)
+    reportlist += glob(os.path.join(config['report_folder'], '*_report.csv'))
+
+    timestart = time.perf_counter()
+
+    db = sqlite3.connect(config['temp_db'])
+    cursor = db.cursor()
+
+    student_ids = get_student_ids(cursor)
+    video_ids = get_video_ids(cursor)
+    archived_before = get_archived_before(cursor)
+    views_loaded = 0
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+
+        results = pool.map(read_report_file, reportlist, repeat(config['view_data']))
+
+        for filename, (stats, digest, views) in zip(reportlist, results):
+
+            rows = []
+            for lname, fname, video, starttime, endtime, playlength, playpct, totalplaytime, user_pid in views:
+                if starttime < archived_before:
+                    continue
+                student_id = get_dimension_id(cursor, student_ids, 'students', (lname, fname))
+                video_id = get_dimension_id(cursor, video_ids, 'videos', (video,))
+                rows.append((video_id, starttime, student_id, endtime, playlength, playpct, totalplaytime, user_pid))
+
+            cursor.executemany(insert_sql, rows)
+            views_loaded += len(rows)
+
+            if not filename.endswith('.gz'):
+                cursor.execute(manifest_sql, (os.path.abspath(filename), stats[0], stats[1], digest,
+                                              round(time.time())))
 
-    # Close the datatbase
     db.commit()
     db.close()
 
+    elapsed = time.perf_counter() - timestart
+    rate = views_loaded / elapsed if elapsed > 0 else 0
+
+    instrument.count(config, 'views_loaded', views_loaded)
+    instrument.count(config, 'reports_loaded', len(reportlist))
+
+    return f'Rebuilt {views_loaded} views from {len(reportlist)} reports using {workers} ' \
+           f'processes in {elapsed:.1f} seconds ({rate:.0f} views per second).'
+
+
+##################################################################
+##
+##  Runs in a worker process during a rebuild. Reads a single report, which
+##    may be gzip compressed, and returns its (size, mtime), hash and views.
+##
+
+def read_report_file(filename, view_config):
+
+    stats = os.stat(filename)
+
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rb') as fp:
+        content = fp.read()
+
+    digest = hashlib.sha256(content).hexdigest()
+
+    return (stats.st_size, stats.st_mtime_ns), digest, read_report(content, view_config)
+
+
+##################################################################
+##
+##  Parses the raw contents of a report file
+##
+
+def read_report(content, view_config):
+
+    filedata = list(csv.reader(io.StringIO(content.decode('utf-8'))))
+    filedata = filedata[1:] # skip over column headers
+
+    return parse_report_rows(filedata, view_config)
+
+
+##################################################################
+##
+##  Reads the rows of a report from yuja and returns each view as a tuple of
+##    (lname, fname, video, starttime, endtime, playlength, playpct, totalplaytime, user_pid)
+##    ready to be stored, with the times converted to epoch seconds. Reports
+##    saved before the userPID was kept have no user_pid column and give None.
+##
+
+def parse_report_rows(filedata, view_config):
+
+    views = []
+    userpid_col = view_config.get('userpid_col', 8)
+
+    for view in filedata:
+
+        if view != []:
+
+            lname = view[view_config['lname_col']].strip().lower()
+            fname = view[view_config['fname_col']].strip().lower()
+            video = view[view_config['videoname_col']].strip().lower()
+            starttime = util.timestamp_to_epoch(view[view_config['starttime_col']])
+            endtime = util.timestamp_to_epoch(view[view_config['endtime_col']])
+            playlength = int(view[view_config['playlength_col']])
+            playpct = round(int(playlength) / int(view[view_config['videolength_col']]) * 100)
+            totalplaytime = int(view[view_config['totalplaytime_col']])
+
+            user_pid = None
+            if len(view) > userpid_col and view[userpid_col] != '':
+                user_pid = int(view[userpid_col])
+
+            views.append((lname, fname, video, starttime, endtime, playlength, playpct, totalplaytime, user_pid))
+
+    return views
+
+
+##################################################################
+##
+##  Reads the report manifest into a dictionary of path: (size, mtime, sha256)
+##
+
+def get_report_manifest(cursor):
+
+    cursor.execute('''SELECT path, size, mtime, sha256 FROM report_manifest''')
+    return { path: (size, mtime, sha256) for path, size, mtime, sha256 in cursor }
+
+
+##################################################################
+##
+##  Once the reports database has been copied back into place, reports that
+##    are listed in its manifest are safely stored and can be cleaned up. The
+##    'report_retention' setting picks what happens to them:
+##
+##    keep     - leave the reports where they are (default)
+##    compress - gzip each report into report_folder/ingested, with part of
+##               its hash in the name so every distinct version is kept
+##    delete   - remove the reports
+##
+
+def apply_report_retention(config):
+
+    retention = config.get('report_retention', 'keep')
+    if retention == 'keep':
+        return ''
+
+    db = sqlite3.connect(config['reports_db'])
+    manifest = get_report_manifest(db.cursor())
+    db.close()
+
+    ingested_folder = os.path.join(config['report_folder'], 'ingested')
+    removed = 0
+
+    for filename in glob(os.path.join(config['report_folder'], '*_report.csv')):
+
+        path = os.path.abspath(filename)
+        stats = os.stat(path)
+        entry = manifest.get(path)
+
+        # Only touch a report if it is exactly the file that was loaded
+        if entry == None or entry[0] != stats.st_size or entry[1] != stats.st_mtime_ns:
+            continue
+
+        if retention == 'compress':
+            os.makedirs(ingested_folder, exist_ok=True)
+            name = os.path.basename(filename)[:-len('.csv')]
+            archive_name = os.path.join(ingested_folder, f'{name}_{entry[2][:12]}.csv.gz')
+            if not os.path.exists(archive_name):
+                with open(path, 'rb') as src, gzip.open(archive_name, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+
+        os.remove(path)
+        removed += 1
+
+    if retention == 'compress':
+        return f'Compressed {removed} loaded reports into {ingested_folder}'
+    else:
+        return f'Deleted {removed} loaded reports'
+
+
+##################################################################
+##
+##  Starts a download run for a list of videos and returns its id along with
+##    the names of the videos that are already downloaded. When resume is set
+##    the most recent run that never finished is carried on instead, so that
+##    only the videos it didn't get to are downloaded again.
+##
+
+def start_download_run(config, videos, resume=False):
+
+    db = sqlite3.connect(config['temp_db'])
+
+    run = None
+    if resume:
+        sql = '''SELECT run_id FROM download_runs WHERE finished IS NULL ORDER BY run_id DESC LIMIT 1'''
+        run = db.execute(sql).fetchone()
+
+    completed = set()
+    if run != None:
+        run_id = run[0]
+        sql = '''SELECT video FROM download_checkpoints WHERE run_id = ? AND status = 'done' '''
+        completed = { video for video, in db.execute(sql, (run_id,)) }
+    else:
+        run_id = db.execute('''INSERT INTO download_runs (started) values(?)''', (int(time.time()),)).lastrowid
+
+    # Every video in the run is listed so a failed run shows what was left
+    sql = '''INSERT OR IGNORE INTO download_checkpoints values(?, ?, 'pending', 0, NULL, ?)'''
+    db.executemany(sql, [(run_id, video['name'], int(time.time())) for video in videos])
+
+    db.commit()
+    db.close()
+
+    return run_id, completed
+
+
+##################################################################
+##
+##  Records how the download of a single video went. Each checkpoint is
+##    committed straight away so it survives the program being stopped.
+##
+
+def checkpoint_download(config, run_id, video, status, attempts, error=None):
+
+    db = sqlite3.connect(config['temp_db'])
+
+    sql = '''INSERT OR REPLACE INTO download_checkpoints values(?, ?, ?, ?, ?, ?)'''
+    db.execute(sql, (run_id, video, status, attempts, error, int(time.time())))
+
+    db.commit()
+    db.close()
+
+
+def finish_download_run(config, run_id):
+
+    db = sqlite3.connect(config['temp_db'])
+    db.execute('''UPDATE download_runs SET finished = ? WHERE run_id = ?''', (int(time.time()), run_id))
+
+    # Every run before this one is done with, a run that never finished has
+    #   been carried on or replaced by this one, so only this run is kept
+    db.execute('''DELETE FROM download_checkpoints WHERE run_id < ?''', (run_id,))
+    db.execute('''DELETE FROM download_runs WHERE run_id < ?''', (run_id,))
+    db.commit()
+    db.close()
+
+
+##################################################################
+##
+##  Reads the known YuJa identities into a dictionary of
+##    user_pid: (sid, username, status)
+##
+
+def get_identities(cursor):
+
+    cursor.execute('''SELECT user_pid, sid, username, status FROM identities''')
+    return { user_pid: (sid, username, status) for user_pid, sid, username, status in cursor }
+
+
+def save_identity(cursor, user_pid, sid, username, status):
+
+    sql = '''INSERT OR REPLACE INTO identities values(?, ?, ?, ?, ?)'''
+    cursor.execute(sql, (user_pid, sid, username, status, int(time.time())))
+
+
+##################################################################
+##
+##  Yields the rows of an executed query a batch at a time with fetchmany,
+##    so that only one batch is ever held by sqlite3 at once
+##
+
+def fetch_in_batches(cursor, size=1000):
+
+    while True:
+        rows = cursor.fetchmany(size)
+        if len(rows) == 0:
+            return
+        yield from rows
+
+
+##################################################################
+##
+##  Reads the ids of the students and videos already in the database into
+##    dictionaries keyed the same way as get_dimension_id expects
+##
+
+def get_student_ids(cursor):
+
+    cursor.execute('''SELECT lname, fname, student_id FROM students''')
+    return { (lname, fname): student_id for lname, fname, student_id in cursor }
+
+
+def get_video_ids(cursor):
+
+    cursor.execute('''SELECT name, video_id FROM videos''')
+    return { (name,): video_id for name, video_id in cursor }
+
+
+##################################################################
+##
+##  Returns the id of a student or video, adding it to its table the first
+##    time it is seen
+##
+
+dimension_inserts = {
+    'students': '''INSERT INTO students (lname, fname) values(?, ?)''',
+    'videos': '''INSERT INTO videos (name) values(?)'''
+}
+
+def get_dimension_id(cursor, ids, table, key):
+
+    dimension_id = ids.get(key)
+    if dimension_id is None:
+        cursor.execute(dimension_inserts[table], key)
+        dimension_id = cursor.lastrowid
+        ids[key] = dimension_id
+
+    return dimension_id
+
+##################################################################
+##
+##  Older terms are moved out of the reports database into one archive
+##    database per term, stored in config['archive_folder']. The reports
+##    database then only holds the views that the current classes can be
+##    graded on, which keeps the nightly copy and the grading queries small.
+##    Terms are named by the year and season a view started in.
+##
+
+TERM_SEASONS = { 1: 'SP', 2: 'SP', 3: 'SP', 4: 'SP', 5: 'SP',
+                 6: 'SU', 7: 'SU',
+                 8: 'FA', 9: 'FA', 10: 'FA', 11: 'FA', 12: 'FA' }
+
+def get_term_name(year, month):
+
+    return f'{year}{TERM_SEASONS[month]}'
+
+
+def get_archive_path(config, term):
+
+    return os.path.join(config['archive_folder'], f'views_{term}.db')
+
+
+##################################################################
+##
+##  Moves every view that started before the earliest term start date in
+##    class_list into its term's archive database. Nothing a current class
+##    can be graded on is ever moved, since grading only looks at views
+##    that start on or after the term start date.
+##
+
+def archive_old_terms(config, class_list):
+
+    msg = ''
+
+    cutoff = get_earliest_term_start(class_list)
+    if cutoff == None:
+        return msg
+
+    db = sqlite3.connect(config['temp_db'])
+
+    # Group the months that have old views by the term they belong to
+    sql = '''SELECT DISTINCT strftime('%Y', starttime, 'unixepoch'), strftime('%m', starttime, 'unixepoch')
+             FROM view_data WHERE starttime < ?'''
+    terms = {}
+    for year, month in db.execute(sql, (cutoff,)):
+        start = util.datetime_to_epoch(datetime(int(year), int(month), 1))
+        end = util.datetime_to_epoch(datetime(int(year) + int(month) // 12, int(month) % 12 + 1, 1))
+        terms.setdefault(get_term_name(int(year), int(month)), []).append((start, min(end, cutoff)))
+
+    if len(terms) > 0:
+        os.makedirs(config['archive_folder'], exist_ok=True)
+
+    for term, month_ranges in sorted(terms.items()):
+
+        archive_path = get_archive_path(config, term)
+        create_archive_db(archive_path)
+
+        db.execute('ATTACH DATABASE ? AS archive', (archive_path,))
+        moved = 0
+        for start, end in month_ranges:
+            for sql in archive_sql:
+                cursor = db.execute(sql, (start, end))
+            moved += cursor.rowcount
+        db.commit()
+        db.execute('DETACH DATABASE archive')
+
+        msg += f'Archived {moved} views from {term} into {archive_path}\n'
+        instrument.count(config, 'views_archived', moved)
+
+    # Views before the cutoff are left out of the reports from now on, so there
+    #   is nothing more to archive until a later term starts
+    if cutoff > get_archived_before(db.cursor()):
+        db.execute('''DELETE FROM archive_state''')
+        db.execute('''INSERT INTO archive_state values(?)''', (cutoff,))
+        db.commit()
+
+    if len(terms) > 0:
+        # Students that only appear in archived terms are no longer needed here
+        db.execute('''DELETE FROM students WHERE student_id NOT IN (SELECT student_id FROM view_data)''')
+        db.commit()
+        db.execute('VACUUM')
+
+    db.close()
+
+    return msg
+
+
+# Each statement is run with the start and end epoch of the range being moved.
+#   Students and videos are matched by name since the archive has its own ids.
+
+archive_sql = [
+    '''INSERT OR IGNORE INTO archive.students (lname, fname)
+           SELECT DISTINCT s.lname, s.fname FROM main.view_data d
+               JOIN main.students s ON s.student_id = d.student_id
+           WHERE d.starttime >= ?1 AND d.starttime < ?2''',
+
+    '''INSERT OR IGNORE INTO archive.videos (name)
+           SELECT DISTINCT v.name FROM main.view_data d
+               JOIN main.videos v ON v.video_id = d.video_id
+           WHERE d.starttime >= ?1 AND d.starttime < ?2''',
+
+    '''INSERT OR REPLACE INTO archive.view_data
+           SELECT av.video_id, d.starttime, ast.student_id, d.endtime, d.playlength, d.playpct, d.totalplaytime,
+                  d.user_pid
+           FROM main.view_data d
+               JOIN main.students s ON s.student_id = d.student_id
+               JOIN archive.students ast ON ast.lname = s.lname AND ast.fname = s.fname
+               JOIN main.videos v ON v.video_id = d.video_id
+               JOIN archive.videos av ON av.name = v.name
+           WHERE d.starttime >= ?1 AND d.starttime < ?2''',
+
+    '''DELETE FROM main.view_data WHERE starttime >= ?1 AND starttime < ?2'''
+]
+
+
+# Every view starting before this has been archived, 0 before anything has been
+def get_archived_before(cursor):
+
+    row = cursor.execute('''SELECT archived_before FROM archive_state''').fetchone()
+    return 0 if row == None else row[0]
+
+
+##################################################################
+##
+##  Returns the earliest term start date of all the classes as epoch seconds
+##
+
+def get_earliest_term_start(class_list):
+
+    earliest = None
+    for course in class_list:
+        date = course.termstart.split('/')
+        termstart = util.datetime_to_epoch(datetime(int(date[2]), int(date[0]), int(date[1]), 0, 0, 0))
+        if earliest == None or termstart < earliest:
+            earliest = termstart
+
+    return earliest
+
+
+##################################################################
+##
+##  Makes sure an archive database exists and is at the current schema
+##    version, so that it can be attached next to the reports database
+##
+
+def create_archive_db(archive_path):
+
+    conn = sqlite3.connect(archive_path)
+    migrate_report_db(conn)
+    conn.close()
+
+
+##################################################################
+##
+##  Opens the reports database with every term archive attached. The
+##    temporary view all_view_data has the view_data_compat layout and
+##    covers the current views along with all the archived ones. SQLite
+##    allows ten attached databases unless it was built with a higher limit.
+##
+
+def open_history_db(config):
+
+    db = sqlite3.connect(config['temp_db'])
+
+    selects = ['SELECT * FROM main.view_data_compat']
+    archives = sorted(glob(os.path.join(config['archive_folder'], 'views_*.db')))
+
+    for i, archive_path in enumerate(archives):
+        create_archive_db(archive_path)
+        db.execute(f'ATTACH DATABASE ? AS archive{i}', (archive_path,))
+        selects.append(f'SELECT * FROM archive{i}.view_data_compat')
+
+    db.execute('CREATE TEMP VIEW all_view_data AS ' + ' UNION ALL '.join(selects))
+
+    return db
+
 # def getViewTime (start, end):
 
 #     starttime = getDateTime(start)
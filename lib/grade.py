@@ -1,7 +1,11 @@
-import os, csv, glob, sqlite3
+import os, csv, glob, math, sqlite3
 from datetime import datetime
+from itertools import repeat
+from urllib.request import pathname2url
+from concurrent.futures import ProcessPoolExecutor
 
-import student, util
+import student, util, instrument, report, logs
+import database
 
 ##########################################################################
 ##
@@ -23,25 +27,181 @@ def test():
 ##
 ##  Combines the data from the main database, any override information
 ##    provided by instructors and calculates the grades for each student
-##    for each of the videos contained in a class
+##    for each of the videos contained in a class. Views are matched to
+##    students through the YuJa identities already known, and by name for
+##    everything else. Any identity the name matches settle is saved for
+##    the next run.
+##
+##  With 'grade_workers' set above 1 the courses are shared out between that
+##    many worker processes, see grade_in_parallel.
 ##
 
+@instrument.hotspot('process_video_grades')
 def process_video_grades(config, class_list, video_data):
 
+    db = sqlite3.connect(config['temp_db'])
+    cursor = db.cursor()
+
+    identities = database.get_identities(cursor)
+    matches = {}
+
+    workers = config.get('grade_workers') or 1
+    if workers > 1 and len(class_list) > 1:
+        msg = grade_in_parallel(config, class_list, video_data, identities, matches, workers)
+    else:
+        msg = grade_courses(config, db, class_list, video_data, identities, matches)
+    msg += report.emit(config, learn_identities(cursor, identities, matches), 'info', 'identities')
+
+    db.commit()
+    db.close()
+
+    return msg
+
+
+#############################################################################
+##
+##  Grades the courses a group at a time for the --stream mode. Each group has
+##    its instructor gradebooks loaded, is graded, has its gradebooks written
+##    and is then released before the next group is started, so only one
+##    group's gradebooks, views and grades are held at once. The identities
+##    are learned at the end from every group's matches, as they are by
+##    process_video_grades. The groups are graded in this process, so
+##    'grade_workers' is not used.
+##
+
+@instrument.hotspot('stream_video_grades')
+def stream_video_grades(config, class_list, video_data):
+
+    db = sqlite3.connect(config['temp_db'])
+    cursor = db.cursor()
+
+    identities = database.get_identities(cursor)
+    matches = {}
+
+    msg = ''
+    for group in get_gradebook_groups(class_list):
+        load_instructor_gradebooks(config, group, video_data)
+        msg += grade_courses(config, db, group, video_data, identities, matches, stream=True)
+        create_instructor_gradebooks(config, group, video_data)
+
+        for course in group:
+            course.release()
+        instrument.count(config, 'course_groups_streamed')
+
+    msg += report.emit(config, learn_identities(cursor, identities, matches), 'info', 'identities')
+
+    db.commit()
+    db.close()
+
+    return msg
+
+
+#############################################################################
+##
+##  Grades courses one at a time for the --pipeline mode, as each playlist's
+##    reports finish loading. Every course is graded with the identities
+##    known when grading started and its matches are kept, so the identities
+##    are only learned by close, once every course has been graded, and come
+##    out just as they would from process_video_grades. Each course's report
+##    records are kept as well, and are emitted by close in class list order
+##    whichever order the courses were graded in.
+##
+
+class CourseGrader:
+    def __init__(self, config, video_data):
+        self.config = config
+        self.video_data = video_data
+
+        self.db = sqlite3.connect(config['temp_db'])
+        self.cursor = self.db.cursor()
+        self.identities = database.get_identities(self.cursor)
+        self.matches = {}
+        self.records = {}
+
+    ## Grades one course, keeping its report records until close
+    def grade(self, course):
+        config = dict(self.config, report=report.Recorder())
+        grade_courses(config, self.db, [course], self.video_data, self.identities, self.matches)
+        self.records[course.name] = config['report'].records
+
+    def graded(self, course):
+        return course.name in self.records
+
+    ## Emits the records of the courses in class_list, saves the identities
+    ##   settled by every course graded and closes the database
+    def close(self, class_list):
+        msg = ''
+        for course in class_list:
+            msg += report.replay(self.config, self.records.get(course.name, []))
+
+        msg += report.emit(self.config, learn_identities(self.cursor, self.identities, self.matches),
+                           'info', 'identities')
+
+        self.db.commit()
+        self.db.close()
+
+        return msg
+
+
+#############################################################################
+##
+##  Splits class_list into the groups of courses that have to be streamed
+##    together. Loading a course's gradebooks reads every file starting with
+##    its instructor's name and deletes all but its own, so a course whose
+##    instructor's name starts with another's has to be loaded before either
+##    gradebook is written again. Each group keeps the class list order.
+##
+
+def get_gradebook_groups(class_list):
+
+    order = { id(course): i for i, course in enumerate(class_list) }
+
+    groups = []
+    prefix = None
+    for course in sorted(class_list, key=lambda course: course.instructor.casefold()):
+        name = course.instructor.casefold()
+        if prefix == None or not name.startswith(prefix):
+            prefix = name
+            groups.append([])
+        groups[-1].append(course)
+
+    for group in groups:
+        group.sort(key=lambda course: order[id(course)])
+
+    return sorted(groups, key=lambda group: order[id(group[0])])
+
+
+#############################################################################
+##
+##  Grades every course in class_list from the views in the open database.
+##    Every student matched by name to a view with a userPID not yet known
+##    is recorded in matches as userPID: {sid: username}.
+##
+##  When streaming the views are read a batch at a time, and only those the
+##    course's own students look up are kept.
+##
+
+def grade_courses(config, db, class_list, video_data, identities, matches, stream=False):
+
     msg = ''
     db_config = config['database']
-    video_config = config['video_data']
-    db = sqlite3.connect(config['temp_db'])
+    userpid_col = db_config.get('userpid_col', 9)
 
-    sql = '''SELECT * FROM view_data WHERE video LIKE ? AND starttime >= ? AND starttime <= ?'''
+    sql = '''SELECT * FROM view_data_compat WHERE video LIKE ? AND starttime >= ? AND starttime <= ?'''
 
     # traverse through each course
     for course in class_list:
 
-        msg += f"\nProcessing grades for: {course.name}\n"
+        # Counted here and added to the run record once the course is done
+        student_videos_graded = 0
+        grades_calculated = 0
+
+        msg += report.emit(config, f"\nProcessing grades for: {course.name}\n", 'info', 'course', course=course.name)
+        instrument.count(config, 'courses_graded')
 
         # Get a list of all videos that need to be evaluated for the class
         videos = util.get_videos_in_playlist(course.videoset, video_data)
+        keys = util.get_view_keys(course.students) if stream else None
 
         # Get the term start and term end dates for the class - specified in classes.csv
         startdate = course.termstart.split('/')
@@ -53,7 +213,8 @@ def process_video_grades(config, class_list, video_data):
         # go through each video in the course playlist
         for video in videos:
 
-            msg += f"Processing video: {video['name']}\n"
+            msg += report.emit(config, f"Processing video: {video['name']}\n", 'debug', 'video',
+                               course=course.name, video=video['name'])
 
             # Get the video's due date if it exists
             duedates = util.get_student_by_username(course, 'duedates')
@@ -64,22 +225,32 @@ def process_video_grades(config, class_list, video_data):
                     try:
                         termenddate = datetime(int(date[2]), int(date[0]), int(date[1]), 23, 59, 59)
                     except IndexError:
-                        print(f"There is a due-date format error in {course.name}. Please check the d2l gradebook.")
+                        logs.display(f"There is a due-date format error in {course.name}. Please check the d2l gradebook.", 'error')
                         raise SystemExit(-1)
 
             #### Query all the views for this video within the term dates
             #### then loop through it and compile grades
             cursor = db.cursor()
-            cursor.execute(sql, (video['name'], termstartdate, termenddate))
-            view_data = cursor.fetchall()
+            cursor.execute(sql, (video['name'], util.datetime_to_epoch(termstartdate), util.datetime_to_epoch(termenddate)))
+            if stream:
+                view_data = database.fetch_in_batches(cursor, config.get('fetch_size', 1000))
+            else:
+                view_data = cursor.fetchall()
+            view_index = util.index_views(config, view_data, identities, keys)
 
             # Get the total amount of time each student spent on the video
             for student in course.students:
 
                 if student.username != 'duedates':
+
+                    student_videos_graded += 1
                     
                     # Retrieve all the views pertinent to this particular student
-                    views = util.get_views_for_student(config, student, view_data)
+                    views = util.get_views_for_student(student, view_index)
+
+                    for view in views:
+                        if view[userpid_col] != None and view[userpid_col] not in identities:
+                            matches.setdefault(view[userpid_col], {})[student.sid] = student.username
                     
                     if len(views) > 0:
                     
@@ -125,7 +296,10 @@ def process_video_grades(config, class_list, video_data):
                             grade = 100
                             
                         student.videoswatched[video['name']] = int(grade)
-                        msg += f"Student {student.lname[0]}, {student.fname[0].ljust(35,'.')} {grade}%\n"
+                        grades_calculated += 1
+                        msg += report.emit(config, f"Student {student.lname[0]}, {student.fname[0].ljust(35,'.')} {grade}%\n",
+                                           'debug', 'grade', course=course.name, sid=student.sid, video=video['name'],
+                                           grade=int(grade))
 
                     #  If the student hasn't watched the video by the due date assign a grade of zero
                     elif datetime.now() > termenddate:
@@ -134,13 +308,140 @@ def process_video_grades(config, class_list, video_data):
                         
                         student.videoswatched[video['name']] = max(student.videoswatched[video['name']], 0)    
                         if student.videoswatched[video['name']] == 0:
-                            msg += f"Student {student.lname[0]}, {student.fname[0].ljust(35,'.')} 0% --> Did not watch by the due date\n"
+                            msg += report.emit(config, f"Student {student.lname[0]}, {student.fname[0].ljust(35,'.')} 0% --> Did not watch by the due date\n",
+                                               'debug', 'missed', course=course.name, sid=student.sid, video=video['name'],
+                                               grade=0)
                         else:
-                            msg += f"Student {student.lname[0]}, {student.fname[0].ljust(35,'.')} {student.videoswatched[video['name']]}%"
+                            msg += report.emit(config, f"Student {student.lname[0]}, {student.fname[0].ljust(35,'.')} {student.videoswatched[video['name']]}%",
+                                               'debug', 'missed', course=course.name, sid=student.sid, video=video['name'],
+                                               grade=student.videoswatched[video['name']])
+
+        instrument.count(config, 'student_videos_graded', student_videos_graded)
+        instrument.count(config, 'grades_calculated', grades_calculated)
 
     return msg
 
 
+###############################################################################
+##
+##  Grades the courses in a pool of worker processes. Each course only changes
+##    its own students, so the courses are split into one shard per worker,
+##    balanced by the number of grades in each. Every worker reads the views
+##    through its own read-only connection and sends back, for each course,
+##    its report records, its grades and the identities it matched. These are
+##    put back into class_list in class list order and the records emitted
+##    one at a time, so the report and matches come out just as they would
+##    from grade_courses.
+##
+
+def grade_in_parallel(config, class_list, video_data, identities, matches, workers):
+
+    shards = [[] for i in range(min(workers, len(class_list)))]
+    sizes = [0] * len(shards)
+
+    for index, course in sorted(enumerate(class_list), key=lambda item: -get_course_size(item[1])):
+        smallest = sizes.index(min(sizes))
+        shards[smallest].append((index, course))
+        sizes[smallest] += get_course_size(course)
+
+    # Only the settings grading needs go to the workers, the rest of the
+    #   config holds things like the run record that can't be sent
+    worker_config = { 'temp_db': config['temp_db'], 'database': config['database'] }
+
+    results = [None] * len(class_list)
+    with ProcessPoolExecutor(max_workers=len(shards)) as pool:
+        shard_results = pool.map(grade_shard, [[course for index, course in shard] for shard in shards],
+                                 repeat(worker_config), repeat(video_data), repeat(identities))
+
+        for shard, (course_results, counters) in zip(shards, shard_results):
+            for (index, course), result in zip(shard, course_results):
+                results[index] = result
+            for name, value in counters.items():
+                instrument.count(config, name, value)
+
+    msg = ''
+    for course, (records, grades, dict_rows, course_matches) in zip(class_list, results):
+        msg += report.replay(config, records)
+        course.grades = grades
+        for i, videoswatched in dict_rows:
+            course.students[i].videoswatched = videoswatched
+        for pid, students in course_matches.items():
+            matches.setdefault(pid, {}).update(students)
+
+    return msg
+
+
+def get_course_size(course):
+
+    return len(course.students) * len(course.video_ordinals or [None])
+
+
+##############################################################################
+##
+##  Runs in a worker process. Grades each course of the shard and returns
+##    (report records, grades array, students graded in a plain dict,
+##    matches) for each, along with the counts the run record would get.
+##
+
+def grade_shard(courses, config, video_data, identities):
+
+    config = dict(config, run=instrument.Run({ 'memory': False }))
+
+    # The views are only read here, so several workers can share the database
+    db = sqlite3.connect('file:' + pathname2url(config['temp_db']) + '?mode=ro', uri=True)
+
+    results = []
+    for course in courses:
+        course_matches = {}
+        config['report'] = report.Recorder()
+        grade_courses(config, db, [course], video_data, identities, course_matches)
+
+        # Students that were added without a row of the grades array, like the
+        #   due dates, keep their grades in a dict which is sent back as well
+        dict_rows = [(i, student.videoswatched) for i, student in enumerate(course.students)
+                     if isinstance(student.videoswatched, dict) and student.username != 'duedates']
+
+        results.append((config['report'].records, course.grades, dict_rows, course_matches))
+
+    db.close()
+
+    return results, config['run'].counters
+
+
+###############################################################################
+##
+##  Saves the identities that grading has settled. A userPID is confirmed
+##    when its views matched exactly one student by name and that student
+##    matched no other userPID, and it is marked ambiguous when its views
+##    matched more than one student. Returns a message when anything is new.
+##
+
+def learn_identities(cursor, identities, matches):
+
+    pids_by_sid = {}
+    for pid, students in matches.items():
+        for sid in students:
+            pids_by_sid.setdefault(sid, set()).add(pid)
+
+    confirmed = 0
+    ambiguous = 0
+
+    for pid, students in matches.items():
+        if len(students) > 1:
+            database.save_identity(cursor, pid, None, None, 'ambiguous')
+            ambiguous += 1
+        else:
+            sid, username = next(iter(students.items()))
+            if pids_by_sid[sid] == {pid}:
+                database.save_identity(cursor, pid, sid, username, 'confirmed')
+                confirmed += 1
+
+    if confirmed + ambiguous == 0:
+        return ''
+
+    return f'\nLearned {confirmed} YuJa identities, {ambiguous} were ambiguous.\n'
+
+
 ###############################################################################
 ##
 ##  Each instructor has a .csv gradebook in the shared onedrive folder, and they
@@ -148,6 +449,7 @@ def process_video_grades(config, class_list, video_data):
 ##    there. This function reads those gradebooks and stores the grades written
 ##    there in class_list in order to process these overrides.
 
+@instrument.hotspot('load_instructor_gradebooks')
 def load_instructor_gradebooks(config, class_list, video_data):
 
     OVERRIDE_DIR = config['gradebook_shared_folder']
@@ -168,6 +470,7 @@ def load_instructor_gradebooks(config, class_list, video_data):
                 gradebook_file = open(gradebook_filename, encoding='utf-8')
                 csvReader = csv.reader(gradebook_file)
                 gradebook_data = list(csvReader)
+                instrument.count(config, 'gradebooks_read')
 
                 # populate the data from the grade book into classList
                 for student_record in gradebook_data:
@@ -198,13 +501,21 @@ def load_instructor_gradebooks(config, class_list, video_data):
                             stu = util.get_student_by_username(course, username)
 
                             if util.is_number(grade) and stu != None:
-                                grade = round(float(grade))
                                 d2lname = gradebook_data[0][i]
+
+                                grade = float(grade)
+                                if math.isfinite(grade):
+                                    grade = round(grade)
+                                if not student.fits_grade_row(grade):
+                                    logs.display(f'Skipping grade {student_record[i]} for {username} on {d2lname} '
+                                                 f'in {course.name}, it is not a usable grade', 'warning')
+                                    continue
+
                                 try:
                                     video = get_video_by_d2lname(d2lname, course.videoset, video_data)
                                     videoname = video['name']
                                 except TypeError:
-                                    print(f'Could not find video {d2lname} in {course.name}')
+                                    logs.display(f'Could not find video {d2lname} in {course.name}', 'error')
                                     SystemExit(-1)
 
                                 # if no grade has been assigned, go ahead and assign it
@@ -283,6 +594,7 @@ def create_instructor_gradebooks(config, class_list, video_data):
         output_writer = csv.writer(output_file)
         output_writer.writerows(data)
         output_file.close()
+        instrument.count(config, 'gradebooks_written')
     
 
 ###############################################################################
@@ -0,0 +1,349 @@
+import os, sys, json, time, sqlite3, threading, tracemalloc, cProfile
+from contextlib import contextmanager
+
+#########################################################################
+##
+##  NOTES:
+##
+##    Records how long each step of a run took and how much it did. A Run is
+##    kept in config['run'] so that any module with the config can add to it
+##    without knowing whether a run is being recorded:
+##
+##      with instrument.stage(config, 'load_views'):
+##          ...
+##      instrument.count(config, 'views_loaded', 120)
+##
+##    Every stage gets its wall time and CPU time. Stages can be nested, a
+##    nested stage is named after its parent ('download/login'). The CPU
+##    time of a stage on the main thread is that of the whole process, so it
+##    includes the threads the stage started. On any other thread it is the
+##    CPU time of that thread alone.
+##
+##    Setting memory = true in the [instrument] section of config.toml, or
+##    the --memory option, also gives each stage on the main thread the peak
+##    memory allocated while it ran as seen by tracemalloc. It is off by
+##    default since tracemalloc makes the run noticeably slower.
+##
+##    At the end of the run the record is written as JSON to
+##    config['run_folder'] and stored in the run_history, run_stages and
+##    run_counters tables of the reports database.
+##
+##    Profiling is turned on by the 'profile' setting of [instrument] or the
+##    --profile option:
+##
+##      cprofile - every top level stage on the main thread runs under
+##                 cProfile and is saved as run_<time>_<stage>.pstats. Steps
+##                 run on other threads by the pipeline are not included.
+##      sample   - a background thread looks at the main thread's stack every
+##                 'sample_interval' seconds (0.01 by default). It is cheap
+##                 enough to leave on, the stacks are saved in the collapsed
+##                 format flame graph tools read as run_<time>_samples.txt.
+##
+##    With cprofile the hotspots, functions marked with
+##    @instrument.hotspot('name'), also have their calls and time taken from
+##    each stage's profile into the run record. The decorator only notes the
+##    function's code and hands back the function itself, so a hotspot costs
+##    nothing at all, and calls made on other threads aren't counted.
+##
+#########################################################################
+
+
+##############################################################################
+##
+##  Used for testing and debugging purposes for this particular file
+##
+
+def test():
+
+    config = { 'instrument': { 'profile': 'sample' } }
+    start_run(config)
+
+    with stage(config, 'outer'):
+        data = [i for i in range(100000)]
+        with stage(config, 'inner'):
+            time.sleep(0.1)
+            count(config, 'items', len(data))
+
+    config['run'].finish()
+
+    print(json.dumps(config['run'].record('completed'), indent=2))
+    print(config['run'].summary())
+
+
+##############################################################################
+##
+##  Starts recording a run and keeps it in the config
+##
+
+def start_run(config):
+
+    config['run'] = Run(config.get('instrument', {}), config.get('run_folder'))
+    return config['run']
+
+
+@contextmanager
+def stage(config, name):
+
+    run = config.get('run')
+    if run == None:
+        yield
+    else:
+        with run.stage(name):
+            yield
+
+
+# Whether the run profiles or measures memory, which is only done for stages
+#   on the main thread
+def on_main_thread_only(config):
+
+    run = config.get('run')
+    return run != None and (run.profile != None or run.trace_memory)
+
+
+def count(config, name, amount=1):
+
+    run = config.get('run')
+    if run != None:
+        run.count(name, amount)
+
+
+##############################################################################
+##
+##  The timings and counters of a single run of the program
+##
+
+class Run:
+    def __init__(self, settings={}, run_folder=None):
+        self.started = time.time()
+        self.name = 'run_' + time.strftime('%Y%m%d_%H%M%S', time.localtime(self.started))
+        self.run_folder = run_folder
+        self.trace_memory = settings.get('memory', False)
+        self.profile = settings.get('profile')
+        self.stages = []
+        self.counters = {}
+        self.hotspots = {}
+        self.lock = threading.Lock()
+        self.open_stages = []
+        self.sampler = None
+
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+        if self.profile == 'sample':
+            self.sampler = Sampler(settings.get('sample_interval', 0.01))
+            self.sampler.start()
+
+    ## Stops the sampler, saving what it collected
+    def finish(self):
+        if self.sampler != None:
+            self.sampler.stop()
+            if self.run_folder != None:
+                os.makedirs(self.run_folder, exist_ok=True)
+                self.sampler.save(os.path.join(self.run_folder, self.name + '_samples.txt'))
+
+    def get_profile_path(self, stage):
+        os.makedirs(self.run_folder, exist_ok=True)
+        return os.path.join(self.run_folder, f'{self.name}_{stage}.pstats')
+
+    @contextmanager
+    def stage(self, name):
+        on_main_thread = threading.current_thread() is threading.main_thread()
+
+        # Only stages on the main thread are nested and have their memory
+        #   measured, tracemalloc can't tell the threads apart
+        profiler = None
+        if on_main_thread:
+            if len(self.open_stages) > 0:
+                name = self.open_stages[-1]['name'] + '/' + name
+            elif self.profile == 'cprofile':
+                profiler = cProfile.Profile()
+            entry = { 'name': name, 'child_peak': 0 }
+            self.open_stages.append(entry)
+            if self.trace_memory:
+                tracemalloc.reset_peak()
+
+        if profiler != None:
+            profiler.enable()
+
+        cpu_time = time.process_time if on_main_thread else time.thread_time
+
+        wall_start = time.perf_counter()
+        cpu_start = cpu_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = cpu_time() - cpu_start
+
+            if profiler != None:
+                profiler.disable()
+                self.add_hotspots(profiler)
+                if self.run_folder != None:
+                    profiler.dump_stats(self.get_profile_path(name))
+
+            peak = None
+            if on_main_thread:
+                self.open_stages.pop()
+                if self.trace_memory:
+                    peak = max(tracemalloc.get_traced_memory()[1], entry['child_peak'])
+                    if len(self.open_stages) > 0:
+                        parent = self.open_stages[-1]
+                        parent['child_peak'] = max(parent['child_peak'], peak)
+
+            with self.lock:
+                self.stages.append({ 'stage': name, 'wall': round(wall, 6), 'cpu': round(cpu, 6),
+                                     'peak_memory': peak })
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    ## Adds the calls to hotspots from a stage's profile
+    def add_hotspots(self, profiler):
+        with self.lock:
+            for entry in profiler.getstats():
+                name = hotspot_codes.get(entry.code)
+                if name != None:
+                    calls, total = self.hotspots.get(name, (0, 0))
+                    self.hotspots[name] = (calls + entry.callcount, total + entry.totaltime)
+
+    def record(self, status):
+        return {
+            'started': round(self.started),
+            'finished': round(time.time()),
+            'status': status,
+            'wall': round(time.time() - self.started, 6),
+            'stages': self.stages,
+            'counters': self.counters,
+            'hotspots': { name: { 'calls': calls, 'seconds': round(seconds, 6) }
+                          for name, (calls, seconds) in self.hotspots.items() },
+            'samples': self.sampler.top() if self.sampler != None else []
+        }
+
+    ## A table of the stages and counters for the log
+    def summary(self):
+        msg = '\nStage'.ljust(46) + 'Wall (s)'.rjust(10) + 'CPU (s)'.rjust(10) + 'Peak (MB)'.rjust(11) + '\n'
+        for entry in self.stages:
+            peak = '' if entry['peak_memory'] == None else f"{entry['peak_memory'] / 1048576:.1f}"
+            msg += entry['stage'][:44].ljust(45) + f"{entry['wall']:10.2f}{entry['cpu']:10.2f}{peak:>11}\n"
+
+        for name, value in sorted(self.counters.items()):
+            msg += f'{name}: {value}\n'
+
+        for name, (calls, seconds) in sorted(self.hotspots.items()):
+            msg += f'{name}: {calls} calls, {seconds:.3f} seconds\n'
+
+        return msg
+
+
+##############################################################################
+##
+##  Marks a function as a hotspot. Its code is kept with the name so the
+##    profiles can be searched for it, and the function itself is returned.
+##    A module in lib can be loaded twice (as lib.grade and as grade), which
+##    gives each copy of the function its own code under the same name.
+##
+
+hotspot_codes = {}
+
+def hotspot(name):
+
+    def mark(func):
+        hotspot_codes[func.__code__] = name
+        return func
+
+    return mark
+
+
+##############################################################################
+##
+##  Samples the main thread's stack from a background thread. Each sample is
+##    kept as a collapsed stack, 'outer;inner;innermost', with its count.
+##
+
+class Sampler(threading.Thread):
+    def __init__(self, interval):
+        super().__init__(name='sampler', daemon=True)
+        self.interval = interval
+        self.stacks = {}
+        self.stopped = threading.Event()
+        self.main_id = threading.main_thread().ident
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.main_id)
+            stack = []
+            while frame != None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                frame = frame.f_back
+            key = ';'.join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            for stack, samples in sorted(self.stacks.items()):
+                f.write(f'{stack} {samples}\n')
+
+    ## The functions that were running most often when a sample was taken
+    def top(self, count=20):
+        functions = {}
+        for stack, samples in self.stacks.items():
+            function = stack.rsplit(';', 1)[-1]
+            functions[function] = functions.get(function, 0) + samples
+        return sorted(functions.items(), key=lambda item: -item[1])[:count]
+
+
+##############################################################################
+##
+##  Writes the run record to the run folder as JSON and adds it to the run
+##    history in the reports database. Returns the path of the JSON file.
+##
+
+def save_run(config, status):
+
+    run = config['run']
+    run.finish()
+    record = run.record(status)
+
+    os.makedirs(config['run_folder'], exist_ok=True)
+    record_path = os.path.join(config['run_folder'], run.name + '.json')
+    with open(record_path, 'w') as f:
+        json.dump(record, f, indent=2)
+
+    # A run that failed before the reports database was set up has nowhere
+    #   to keep its history, the JSON record is all there is
+    db = sqlite3.connect(config['reports_db'])
+    if db.execute('PRAGMA user_version').fetchone()[0] < 6:
+        db.close()
+        return record_path
+
+    cursor = db.cursor()
+
+    sql = '''INSERT INTO run_history (started, finished, status, wall) values(?, ?, ?, ?)'''
+    cursor.execute(sql, (record['started'], record['finished'], status, record['wall']))
+    run_id = cursor.lastrowid
+
+    sql = '''INSERT INTO run_stages values(?, ?, ?, ?, ?)'''
+    cursor.executemany(sql, [(run_id, entry['stage'], entry['wall'], entry['cpu'], entry['peak_memory'])
+                             for entry in record['stages']])
+
+    sql = '''INSERT INTO run_counters values(?, ?, ?)'''
+    cursor.executemany(sql, [(run_id, name, value) for name, value in record['counters'].items()])
+
+    db.commit()
+    db.close()
+
+    return record_path
+
+
+##############################################################################
+##                                                                 MAIN PROGRAM
+##############################################################################
+
+if __name__ == '__main__':
+    test()
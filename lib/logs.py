@@ -0,0 +1,137 @@
+import sys, queue, logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+#########################################################################
+##
+##  NOTES:
+##
+##    Everything the program shows or logs goes through the root logger,
+##    which only puts each record on a queue. A QueueListener thread takes
+##    them off and does the slow part, writing to the log file and the
+##    console, so a run never waits on either one:
+##
+##      logs.display('Loading video data...', end='')
+##      logs.display(f'Waiting: {wait} seconds.', 'debug')
+##
+##    The log file is config['logfile'], rotated once it reaches 'max_mb' of
+##    the [logging] section of config.toml (10 by default) with 'backups' old
+##    copies kept (5 by default). It gets every record.
+##
+##    The console shows 'console_level' and above, 'info' by default. Quiet
+##    mode, --quiet or suppress_console_output in config.toml, only shows
+##    warnings and errors.
+##
+##    Until setup_logging is called, as in the module tests and benchmarks,
+##    the root logger has no handlers, so only warnings and errors are shown.
+##
+#########################################################################
+
+LEVELS = { 'debug': logging.DEBUG, 'info': logging.INFO, 'warning': logging.WARNING, 'error': logging.ERROR }
+
+
+##############################################################################
+##
+##  Used for testing and debugging purposes for this particular file
+##
+
+def test():
+
+    import tempfile, os
+
+    config = { 'logfile': os.path.join(tempfile.mkdtemp(), 'log.txt') }
+    setup_logging(config)
+
+    display('Loading...', end='')
+    display('[ COMPLETE ]')
+    display('Only in the log file', 'debug')
+
+    stop_logging()
+    print(open(config['logfile']).read())
+
+
+##############################################################################
+##
+##  Writes a record to the console without a newline when end is given, so
+##    that '[ COMPLETE ]' can follow 'Loading video data...' on one line
+##
+
+class ConsoleHandler(logging.StreamHandler):
+
+    def emit(self, record):
+        try:
+            self.stream.write(self.format(record) + getattr(record, 'end', '\n'))
+            self.flush()
+        except Exception:
+            self.handleError(record)
+
+
+##############################################################################
+##
+##  Points the root logger at a queue and starts the thread that writes the
+##    records. Returns the root logger.
+##
+
+log_queue = None
+listener = None
+
+def setup_logging(config):
+
+    global log_queue, listener
+
+    settings = config.get('logging', {})
+
+    if config.get('quiet', False) or config.get('suppress_console_output', False):
+        console_level = 'warning'
+    else:
+        console_level = config.get('console_level', 'info')
+
+    file_handler = RotatingFileHandler(config['logfile'], maxBytes=settings.get('max_mb', 10) * 1048576,
+                                       backupCount=settings.get('backups', 5), encoding='utf-8')
+    file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    file_handler.setLevel(logging.DEBUG)
+
+    console_handler = ConsoleHandler(sys.stdout)
+    console_handler.setLevel(LEVELS[console_level])
+
+    log_queue = queue.Queue()
+    listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    listener.start()
+
+    logger = logging.getLogger()
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(QueueHandler(log_queue))
+    logger.setLevel(logging.DEBUG)
+
+    return logger
+
+
+# Writes out everything still on the queue and stops the writing thread
+def stop_logging():
+
+    global listener
+
+    if listener != None:
+        listener.stop()
+        listener = None
+
+
+# Waits until every record so far has been written, for when the console has
+#   to be up to date, like before asking a question
+def flush():
+
+    if listener != None:
+        log_queue.join()
+
+
+def display(msg, level='info', end='\n'):
+
+    logging.getLogger().log(LEVELS[level], msg, extra={ 'end': end })
+
+
+##############################################################################
+##                                                                 MAIN PROGRAM
+##############################################################################
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,123 @@
+import time, random
+
+#########################################################################
+##
+##  NOTES:
+##
+##    Paces the requests made to YuJa's servers. Instead of waiting a fixed
+##    random time between requests, the delay is adjusted after every
+##    response in the same way TCP adjusts its window (AIMD):
+##
+##      - a healthy response takes 'step' seconds off the delay
+##      - an error multiplies the delay by 'backoff'
+##      - a throttle response (429 / 503) multiplies it by 'backoff' twice
+##      - a response much slower than usual ('slow_factor' times the running
+##        average) multiplies it by half of 'backoff' above one, since a slow
+##        server is usually a busy one
+##
+##    Large responses cost the server more, so 'seconds_per_mb' is added to
+##    the next wait for every megabyte returned. The delay always stays
+##    between 'floor' and 'ceiling'. All of these come from the [pacing]
+##    section of config.toml, in seconds.
+##
+#########################################################################
+
+
+##############################################################################
+##
+##  Used for testing and debugging purposes for this particular file
+##
+
+def test():
+
+    pacer = Pacer({'pacing': {'floor': 0.1, 'ceiling': 1, 'initial': 0.5}})
+
+    for latency, size, error, throttled in [(0.2, 1000, False, False), (0.2, 1000, False, False),
+                                            (1.5, 1000, False, False), (0.2, 0, True, False),
+                                            (0.2, 0, False, True), (0.2, 2000000, False, False)]:
+        pacer.wait()
+        pacer.record(latency, size, error, throttled)
+        print(f'latency {latency}, size {size}, error {error}, throttled {throttled} -> delay {pacer.delay:.2f}')
+
+    print(pacer.summary())
+
+
+##############################################################################
+##
+##  One pacer is shared by everything that talks to YuJa in a run, so that
+##    downloads, length lookups and deletes all slow down together when the
+##    server is struggling.
+##
+
+class Pacer:
+    def __init__(self, config):
+        pacing = config.get('pacing', {})
+        self.floor = pacing.get('floor', 2.0)
+        self.ceiling = pacing.get('ceiling', 15.0)
+        self.step = pacing.get('step', 0.5)
+        self.backoff = pacing.get('backoff', 2.0)
+        self.slow_factor = pacing.get('slow_factor', 3.0)
+        self.seconds_per_mb = pacing.get('seconds_per_mb', 1.0)
+
+        self.delay = self.clamp(pacing.get('initial', 5.0))
+        self.extra = 0
+        self.latency = None
+        self.last_response = None
+
+        self.requests = 0
+        self.errors = 0
+        self.waited = 0
+
+    def clamp(self, delay):
+        return min(self.ceiling, max(self.floor, delay))
+
+    ## Sleeps until the current delay has passed since the last response. Time
+    ##   spent working on that response counts towards the delay.
+    def wait(self):
+        if self.last_response == None:
+            return
+
+        delay = self.delay * random.uniform(0.8, 1.2) + self.extra
+        remaining = delay - (time.monotonic() - self.last_response)
+        if remaining > 0:
+            time.sleep(remaining)
+            self.waited += remaining
+
+    ## Adjusts the delay from how long a request took, how many bytes came
+    ##   back and whether it failed or was throttled
+    def record(self, latency, size=0, error=False, throttled=False):
+        self.requests += 1
+        self.last_response = time.monotonic()
+
+        if throttled:
+            self.errors += 1
+            self.delay *= self.backoff * self.backoff
+        elif error:
+            self.errors += 1
+            self.delay *= self.backoff
+        elif self.latency != None and latency > self.latency * self.slow_factor:
+            self.delay *= 1 + (self.backoff - 1) / 2
+        else:
+            self.delay -= self.step
+
+        # Keep a running average of the healthy response times
+        if not (error or throttled):
+            if self.latency == None:
+                self.latency = latency
+            else:
+                self.latency = 0.8 * self.latency + 0.2 * latency
+
+        self.delay = self.clamp(self.delay)
+        self.extra = self.seconds_per_mb * size / 1000000
+
+    def summary(self):
+        return f'Paced {self.requests} requests ({self.errors} failed or throttled), ' \
+               f'waited {self.waited:.1f} seconds in total, final delay {self.delay:.1f} seconds.\n'
+
+
+##############################################################################
+##                                                                 MAIN PROGRAM
+##############################################################################
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,234 @@
+import os, queue, threading
+from glob import glob
+
+import util, grade, backend
+import database as db
+
+#########################################################################
+##
+##  NOTES:
+##
+##    Runs the download, loading and grading steps at the same time instead
+##    of one after the other. Three threads feed the grading, which runs on
+##    the calling thread:
+##
+##      download - downloads the reports from YuJa and hands each report to
+##                 the load thread as soon as it has been written
+##      load     - loads each report into the database as it arrives, and
+##                 marks a playlist as ready once all of its reports are in
+##      roster   - builds the class list and reads the instructor gradebooks
+##                 while the downloads are running
+##
+##    Every thread opens its own connection to the database. Grading only
+##    ever changes the students in the course being graded, so courses from
+##    different playlists can be graded while other reports are loading. The
+##    identities are learned once every course has been graded, from all of
+##    their matches, so a userPID whose views match students in two courses
+##    is found to be ambiguous as it is when grading the whole class list.
+##
+#########################################################################
+
+
+##############################################################################
+##
+##  Used for testing and debugging purposes for this particular file
+##
+
+def test():
+
+    import video, student
+
+    config = util.load_config('config.toml')
+    error, msg, video_data = video.load_video_data(config)
+
+    def prepare_roster():
+        error, msg, class_list = student.create_class_list(config, video_data)
+        msg, class_list = student.refresh_students(config, class_list)
+        return class_list
+
+    util.create_temp_db(config)
+    error, msg, class_list = run_pipeline(config, video_data, prepare_roster)
+    util.delete_temp_db(config)
+
+    print(msg)
+
+
+##############################################################################
+##
+##  Wraps a step of the pipeline in a thread that keeps the step's return
+##    value, or the exception it raised so it can be raised again by wait().
+##    The threads are daemons so that an error exit doesn't have to wait for
+##    the downloads to finish.
+##
+
+class PipelineThread(threading.Thread):
+    def __init__(self, name, target):
+        super().__init__(name=name, daemon=True)
+        self.target = target
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = self.target()
+        except BaseException as e:
+            self.error = e
+
+    def wait(self):
+        self.join()
+        if self.error != None:
+            raise self.error
+        return self.result
+
+
+##############################################################################
+##
+##  Downloads, loads and grades the reports. prepare_roster is called on the
+##    roster thread and must return the class list. Returns the error code, the
+##    combined messages and the graded class list.
+##
+
+def run_pipeline(config, video_data, prepare_roster):
+
+    error = 0
+    msg = ''
+
+    reports = queue.Queue()
+    ready_playlists = queue.Queue()
+    download_failed = threading.Event()
+
+    # The videos that will be downloaded, and the ones each playlist still
+    #   needs before it can be graded
+    downloading = set()
+    if config['download_reports']:
+        downloading = set(util.get_distinct_video_names(util.get_videos_to_process(video_data)))
+
+    waiting = {}
+    for playlist in util.get_video_playlists(video_data):
+        videos = util.get_videos_in_playlist(playlist, video_data)
+        waiting[playlist] = set(util.get_distinct_video_names(videos)) & downloading
+
+    def download():
+        try:
+            result = backend.download_new_reports(config, video_data,
+                                                  on_report=lambda video, path: reports.put((video['name'], path)))
+            if result[0] < 0:
+                download_failed.set()
+            return result
+        except BaseException:
+            download_failed.set()
+            raise
+        finally:
+            reports.put(None)
+
+    def load():
+        # One connection and one set of ids is kept for every report the
+        #   thread loads
+        loader = None
+        try:
+            loader = db.ViewLoader(config)
+
+            # Reports that aren't downloaded tonight can be loaded straight away
+            skip = {os.path.abspath(util.get_report_filename(config, name)) for name in downloading}
+            reportlist = glob(os.path.join(config['report_folder'], '*_report.csv'))
+            reportlist = [filename for filename in reportlist if os.path.abspath(filename) not in skip]
+            loader.load(reportlist)
+
+            release_ready_playlists(waiting, ready_playlists)
+
+            loaded = 0
+            item = reports.get()
+            while item != None:
+                videoname, report_path = item
+                loader.load([report_path])
+                loaded += 1
+
+                for names in waiting.values():
+                    names.discard(videoname)
+                release_ready_playlists(waiting, ready_playlists)
+
+                item = reports.get()
+
+            # Anything still waiting after the downloads have all finished
+            #   has nothing more to wait for, unless the downloads failed
+            if not download_failed.is_set():
+                for names in waiting.values():
+                    names.clear()
+                release_ready_playlists(waiting, ready_playlists)
+
+            load_msg = loader.close()
+            loader = None
+            return load_msg + f'\nLoaded {loaded} downloaded reports as they arrived.\n'
+
+        finally:
+            if loader != None:
+                loader.db.close()
+            ready_playlists.put(None)
+
+    def roster():
+        class_list = prepare_roster()
+        return grade.load_instructor_gradebooks(config, class_list, video_data)
+
+    download_thread = PipelineThread('download', download)
+    load_thread = PipelineThread('load', load)
+    roster_thread = PipelineThread('roster', roster)
+
+    download_thread.start()
+    load_thread.start()
+    roster_thread.start()
+
+    class_list = roster_thread.wait()
+
+    # Grade each playlist as soon as it is ready. The grader keeps each
+    #   course's report so that they come out in class list order no matter
+    #   which playlist finished first.
+    grader = grade.CourseGrader(config, video_data)
+    try:
+        playlist = ready_playlists.get()
+        while playlist != None:
+            for course in class_list:
+                if course.videoset == playlist:
+                    grader.grade(course)
+            playlist = ready_playlists.get()
+
+        download_error, download_msg = download_thread.wait()
+        load_msg = load_thread.wait()
+        msg += download_msg + load_msg
+
+        if download_error < 0:
+            return download_error, msg, class_list
+
+        # Courses whose playlist has no videos still get their messages
+        for course in class_list:
+            if not grader.graded(course):
+                grader.grade(course)
+
+        msg += grader.close(class_list)
+        grader = None
+
+    finally:
+        if grader != None:
+            grader.db.close()
+
+    return error, msg, class_list
+
+
+##############################################################################
+##
+##  Queues up every playlist that isn't waiting on any more reports
+##
+
+def release_ready_playlists(waiting, ready_playlists):
+
+    for playlist in list(waiting.keys()):
+        if len(waiting[playlist]) == 0:
+            del waiting[playlist]
+            ready_playlists.put(playlist)
+
+
+##############################################################################
+##                                                                 MAIN PROGRAM
+##############################################################################
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,143 @@
+import os, json, time, logging, threading
+
+#########################################################################
+##
+##  NOTES:
+##
+##    Reports what a run did as a stream of records rather than one long
+##    message built up as the run goes. A Reporter is kept in
+##    config['report'], like the run record, and each record is handed to
+##    it as it happens:
+##
+##      msg += report.emit(config, f'Withdraw: {name}\n', 'info', 'withdraw', sid=sid)
+##
+##    With a Reporter the record is written straight away to
+##    run_<time>_report.jsonl in the run folder as one line of JSON and to
+##    the log, which shows it on the console if its level is shown there (see
+##    logs.py), and emit returns ''. Without one emit returns the text, so
+##    the message is built up as before.
+##
+##    A worker process can't write to the parent's report, so it keeps its
+##    records in a Recorder instead and sends them back to be emitted by the
+##    parent one at a time with replay, just as they would have been had
+##    the parent made them.
+##
+#########################################################################
+
+LEVELS = { 'debug': logging.DEBUG, 'info': logging.INFO, 'warning': logging.WARNING, 'error': logging.ERROR }
+
+
+##############################################################################
+##
+##  Used for testing and debugging purposes for this particular file
+##
+
+def test():
+
+    import tempfile
+
+    config = { 'run_folder': tempfile.mkdtemp() }
+    start_report(config, logging.getLogger(), 'run_test')
+
+    msg = emit(config, 'Grading...\n')
+    msg += emit(config, 'Student a, b.... 100%\n', 'debug', 'grade', sid='001', grade=100)
+
+    path = finish_report(config)
+    print(repr(msg), open(path).read())
+
+
+##############################################################################
+##
+##  Starts a report for the run and keeps it in the config
+##
+
+def start_report(config, logger, name):
+
+    path = os.path.join(config['run_folder'], name + '_report.jsonl')
+    config['report'] = Reporter(path, logger)
+    return config['report']
+
+
+def finish_report(config):
+
+    reporter = config.pop('report', None)
+    if reporter == None:
+        return None
+
+    reporter.close()
+    return reporter.path
+
+
+def emit(config, text, level='info', event='message', **fields):
+
+    reporter = config.get('report')
+    if reporter == None or text == '':
+        return text
+
+    reporter.emit(text, level, event, fields)
+    return ''
+
+
+# Emits the records a Recorder kept and returns what emit returned for them
+def replay(config, records):
+
+    msg = ''
+    for text, level, event, fields in records:
+        msg += emit(config, text, level, event, **fields)
+
+    return msg
+
+
+##############################################################################
+##
+##  Writes each record as it comes. The pipeline reports from several threads
+##    at once, so the writing is done under a lock.
+##
+
+class Reporter:
+    def __init__(self, path, logger):
+        self.path = path
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.counts = dict.fromkeys(LEVELS, 0)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, 'w', encoding='utf-8')
+
+    def emit(self, text, level, event, fields):
+        text = text.strip('\n')
+        record = { 'time': round(time.time(), 3), 'level': level, 'event': event, **fields, 'msg': text }
+
+        with self.lock:
+            self.counts[level] += 1
+            self.file.write(json.dumps(record, default=str) + '\n')
+            self.logger.log(LEVELS[level], text)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+##############################################################################
+##
+##  Keeps each record as it comes, in a form that can be sent between
+##    processes, for replay to emit later
+##
+
+class Recorder:
+    def __init__(self):
+        self.records = []
+
+    def emit(self, text, level, event, fields):
+        self.records.append((text, level, event, fields))
+
+    def close(self):
+        pass
+
+
+##############################################################################
+##                                                                 MAIN PROGRAM
+##############################################################################
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,178 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import instrument, report
+
+#########################################################################
+##
+##  NOTES:
+##
+##    Runs the steps of a run that don't depend on each other at the same
+##    time. The steps are given as a small graph, each one with the names of
+##    the steps it has to wait for, and each is called with their results:
+##
+##      stages.run_stages(config, [
+##          ('create_report_db', [], lambda: db.create_report_db(config)),
+##          ('create_temp_db', ['create_report_db'], lambda created: util.create_temp_db(config)),
+##          ('load_video_data', [], lambda: load_video_data(config, logger)),
+##      ], results)
+##
+##    A step starts as soon as every step it waits for has finished, on one
+##    of 'stage_workers' threads (4 by default). With stage_workers = 1 the
+##    steps run one at a time on the calling thread, in the order given.
+##    They are also run that way when the run is profiled or measures memory
+##    (see instrument.py), as both are only done on the main thread.
+##    Each step's result is kept in results under its name, and a step whose
+##    result is already there, like something the daemon kept from the last
+##    run, is not run again.
+##
+##    Every step is a stage of the run record. Once they have all finished
+##    the time each one started and took is reported, with the steps on the
+##    critical path, the chain of steps that decided how long it all took,
+##    marked with a *.
+##
+##    If a step fails no more are started, the ones already running are let
+##    finish and the error of the first step to fail is raised again.
+##
+#########################################################################
+
+DEFAULT_WORKERS = 4
+
+
+##############################################################################
+##
+##  Used for testing and debugging purposes for this particular file
+##
+
+def test():
+
+    config = {}
+    instrument.start_run(config)
+
+    results = { 'given': 1 }
+    msg = run_stages(config, [
+        ('slow', [], lambda: time.sleep(0.3) or 2),
+        ('fast', [], lambda: time.sleep(0.1) or 3),
+        ('after_fast', ['fast'], lambda fast: time.sleep(0.1) or fast * 2),
+        ('last', ['slow', 'after_fast', 'given'], lambda *values: sum(values)),
+    ], results)
+
+    print(results)
+    print(msg)
+
+
+##############################################################################
+##
+##  Runs the stages as their dependencies allow and returns the timing report
+##
+
+def run_stages(config, stages, results):
+
+    names = [stage[0] for stage in stages]
+    for name, after, function in stages:
+        for dependency in after:
+            if dependency not in results and dependency not in names:
+                raise ValueError(f'Stage {name} waits for {dependency}, which is not a stage.')
+
+    pending = [stage for stage in stages if stage[0] not in results]
+    timings = {}
+    errors = {}
+    started = time.perf_counter()
+
+    workers = config.get('stage_workers', DEFAULT_WORKERS)
+    if workers <= 1 or instrument.on_main_thread_only(config):
+        for stage in pending:
+            if len(errors) == 0:
+                run_stage(config, stage, results, timings, errors, started)
+
+    else:
+        running = {}
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='stage') as pool:
+            while len(pending) > 0 or len(running) > 0:
+
+                # Start everything that is ready, unless a stage has failed
+                if len(errors) == 0:
+                    for stage in [stage for stage in pending if all(name in results for name in stage[1])]:
+                        pending.remove(stage)
+                        running[pool.submit(run_stage, config, stage, results, timings, errors, started)] = stage
+                if len(running) == 0:
+                    if len(errors) == 0:
+                        raise ValueError('Stages ' + ', '.join(stage[0] for stage in pending) + ' wait for each other.')
+                    break
+
+                done, not_done = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    del running[future]
+
+    if len(errors) > 0:
+        raise errors[min(errors, key=lambda name: timings[name][1])]
+
+    if len(timings) == 0:
+        return ''
+
+    return report.emit(config, format_timings(stages, timings), 'info', 'stages',
+                       critical_path=get_critical_path(stages, timings),
+                       timings={ name: [round(start, 6), round(end, 6)] for name, (start, end) in timings.items() })
+
+
+# Runs one stage and keeps its result, or the error it raised, along with the
+#   times it started and finished from the start of run_stages
+def run_stage(config, stage, results, timings, errors, started):
+
+    name, after, function = stage
+    start = time.perf_counter() - started
+    try:
+        with instrument.stage(config, name):
+            results[name] = function(*[results[dependency] for dependency in after])
+    except BaseException as e:
+        errors[name] = e
+    finally:
+        timings[name] = (start, time.perf_counter() - started)
+
+
+##############################################################################
+##
+##  Walks back from the stage that finished last, each time to the stage it
+##    waited for that finished last, and returns the stages on the way
+##
+
+def get_critical_path(stages, timings):
+
+    if len(timings) == 0:
+        return []
+
+    after = { name: dependencies for name, dependencies, function in stages }
+
+    path = [max(timings, key=lambda name: timings[name][1])]
+    while True:
+        waited_for = [name for name in after[path[-1]] if name in timings]
+        if len(waited_for) == 0:
+            break
+        path.append(max(waited_for, key=lambda name: timings[name][1]))
+
+    return list(reversed(path))
+
+
+def format_timings(stages, timings):
+
+    critical_path = get_critical_path(stages, timings)
+    total = max([end for start, end in timings.values()], default=0)
+
+    msg = '\nStage'.ljust(46) + 'Start (s)'.rjust(10) + 'Wall (s)'.rjust(10) + '\n'
+    for name, after, function in stages:
+        if name in timings:
+            start, end = timings[name]
+            marker = '*' if name in critical_path else ' '
+            msg += f'{marker} {name[:42]}'.ljust(45) + f'{start:10.2f}{end - start:10.2f}\n'
+
+    msg += f"Critical path: {' -> '.join(critical_path)}, {total:.2f} seconds\n"
+
+    return msg
+
+
+##############################################################################
+##                                                                 MAIN PROGRAM
+##############################################################################
+
+if __name__ == '__main__':
+    test()
@@ -1,5 +1,8 @@
 
-import os, csv, util
+import os, util, csvcache, report
+from array import array
+from itertools import repeat
+from collections.abc import MutableMapping
 
 #########################################################################
 ##
@@ -19,6 +22,8 @@ import os, csv, util
 #########################################################################
 
 class Student:
+    __slots__ = ('fname', 'lname', 'sid', 'course', 'username', 'canwithdraw', 'videoswatched')
+
     def __init__(self, fname, lname, sid, username, course, canwithdraw):
         self.fname = fname
         self.lname = lname
@@ -61,6 +66,9 @@ class Student:
         return str(self.toList())
 
 class Course:
+    __slots__ = ('videoset', 'name', 'termstart', 'termend', 'instructor', 'email', 'students',
+                 'video_ordinals', 'grades', 'rows')
+
     def __init__(self, videoset, name, termstart, termend, instructor, email):
         self.videoset = videoset
         self.name = name
@@ -69,10 +77,97 @@ class Course:
         self.instructor = instructor
         self.email = email
         self.students = []
+        self.video_ordinals = None
+        self.grades = array('i')
+        self.rows = 0
+
+    ## Sets the videos graded in this course, as { video name: column } shared
+    ##   by every course with the same playlist. Students added from then on
+    ##   keep their grades in a row of the course's grades.
+    def set_videos(self, video_ordinals):
+        self.video_ordinals = video_ordinals
 
     def add_student(self, student):
+        if self.video_ordinals != None:
+            grades = student.videoswatched
+            student.videoswatched = GradeRow(self, self.rows)
+            self.grades.extend(repeat(NOT_SET, len(self.video_ordinals)))
+            self.rows += 1
+            student.videoswatched.update(grades)
+
         self.students.append(student)
 
+    ## Lets go of the students and their grades once the course's gradebook
+    ##   has been written
+    def release(self):
+        self.students = []
+        self.grades = array('i')
+        self.rows = 0
+
+
+################################################################################
+##
+##  A student's grades as a row of the course's grades array, one column per
+##    video in the playlist. It acts as the { video name: grade } dictionary
+##    the rest of the program uses, where a grade is a whole number or None.
+##    A video that was never set isn't in the row at all, as with a dict.
+##
+
+NOT_SET = -2147483648
+NO_GRADE = -2147483647
+MAX_GRADE = 2147483647
+
+# Whether a grade can be kept in the row, every whole number the grades array
+#   holds other than the two markers above
+def fits_grade_row(grade):
+
+    return NO_GRADE < grade <= MAX_GRADE
+
+
+class GradeRow(MutableMapping):
+    __slots__ = ('course', 'start')
+
+    def __init__(self, course, row):
+        self.course = course
+        self.start = row * len(course.video_ordinals)
+
+    def __getitem__(self, name):
+        grade = self.course.grades[self.start + self.course.video_ordinals[name]]
+        if grade == NOT_SET:
+            raise KeyError(name)
+        return None if grade == NO_GRADE else grade
+
+    def __setitem__(self, name, grade):
+        self.course.grades[self.start + self.course.video_ordinals[name]] = NO_GRADE if grade == None else grade
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        self.course.grades[self.start + self.course.video_ordinals[name]] = NOT_SET
+
+    def __contains__(self, name):
+        ordinal = self.course.video_ordinals.get(name)
+        return ordinal != None and self.course.grades[self.start + ordinal] != NOT_SET
+
+    def get(self, name, default=None):
+        ordinal = self.course.video_ordinals.get(name)
+        if ordinal == None:
+            return default
+        grade = self.course.grades[self.start + ordinal]
+        if grade == NOT_SET:
+            return default
+        return None if grade == NO_GRADE else grade
+
+    def __iter__(self):
+        grades = self.course.grades
+        return (name for name, ordinal in self.course.video_ordinals.items() if grades[self.start + ordinal] != NOT_SET)
+
+    def __len__(self):
+        return sum(1 for name in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
 
 ##############################################################################
 ##
@@ -112,6 +207,14 @@ def create_class_list(config, video_data):
     if error < 0:
         return error, msg, class_list
 
+    # Every course with the same playlist numbers its videos the same way
+    video_ordinals = {}
+    for course in class_list:
+        if course.videoset not in video_ordinals:
+            names = [video['name'] for video in util.get_videos_in_playlist(course.videoset, video_data)]
+            video_ordinals[course.videoset] = { name: i for i, name in enumerate(dict.fromkeys(names)) }
+        course.set_videos(video_ordinals[course.videoset])
+
     # Once the class data and the student data has been loaded, the next
     # step is to traverse through the students and place them into their
     # appropriate classes.
@@ -124,13 +227,10 @@ def create_class_list(config, video_data):
             if course.name == student.course:
                 # Set up each student with a list of all the available videos for
                 #   their class and set the grade to a default value
-                videos = util.get_videos_in_playlist(course.videoset, video_data)
-
-                for video in videos:
-                    name = video['name']
+                course.add_student(student)
+                for name in course.video_ordinals:
                     student.videoswatched[name] = None
 
-                course.students.append(student)
                 found = True
 
         if not found:
@@ -157,9 +257,7 @@ def loadClassData(config):
 
         # Collect the data about the courses
         if os.path.exists(CLASS_FILE):
-            classfile = open(CLASS_FILE, encoding='ISO-8859-1')
-            classfilereader = csv.reader(classfile)
-            classdata = list(classfilereader)
+            classdata = csvcache.read_csv(config, CLASS_FILE, 'ISO-8859-1')
             # Delete the first row of data which is just column titles
             classdata = classdata[1:]
         else:
@@ -203,9 +301,7 @@ def loadStudentData(config):
     studentList = []
 
     if os.path.exists(STUDENT_FILE):
-        studentfile = open(STUDENT_FILE, encoding='ISO-8859-1')
-        studentfilereader = csv.reader(studentfile)
-        studentdata = list(studentfilereader)
+        studentdata = csvcache.read_csv(config, STUDENT_FILE, 'ISO-8859-1')
 
     else:
         error = -1
@@ -330,14 +426,16 @@ def getCurrentStudents(classList):
 
 ################################################################################
 ##
-## Goes through the student database looking for additions and withdrawals
+## Goes through the student database looking for additions and withdrawals.
+##   The IR extract is loaded here unless it has been loaded already.
 ##
 
-def refresh_students(config, classList):
+def refresh_students(config, classList, enrollmentReportFromIR=None):
     
     message = ''
 
-    enrollmentReportFromIR = load_student_data_from_extract(config)
+    if enrollmentReportFromIR == None:
+        enrollmentReportFromIR = load_student_data_from_extract(config)
     
     studentList = getCurrentStudents(classList)
     courses = getCurrentClasses(classList)
@@ -350,15 +448,18 @@ def refresh_students(config, classList):
                 if (IRstudent.sid == DBstudent.sid) and (IRstudent.course == DBstudent.course):
                     found = True
             if (not found) and (IRstudent.course in courses):
-                message += 'Student Added: ' + IRstudent.lname[0] + ', ' + IRstudent.fname[0] + ': ' + \
-                           IRstudent.course + '\n'
+                message += report.emit(config, 'Student Added: ' + IRstudent.lname[0] + ', ' + IRstudent.fname[0] + ': ' +
+                                                IRstudent.course + '\n', 'info', 'student_added',
+                                       course=IRstudent.course, sid=IRstudent.sid)
                 classList = addStudentRecord(IRstudent, classList)
 
 
         # Look through the old student list and see if anyone has withdrawn
         for student in studentList:
             if student.canwithdraw and not student_still_enrolled(student, enrollmentReportFromIR) and (student.course in courses):
-                message += 'Withdraw: ' + student.lname[0] + ', ' + student.fname[0] + ': ' + student.course + '\n'
+                message += report.emit(config, 'Withdraw: ' + student.lname[0] + ', ' + student.fname[0] + ': ' +
+                                                student.course + '\n', 'info', 'student_withdrawn',
+                                       course=student.course, sid=student.sid)
                 classList = deleteStudentRecord(student, classList)
 
     # Save the changes to the student database
@@ -395,14 +496,11 @@ def writeStudentDataToDisk(config, classList):
     studentList = getCurrentStudents(classList)
     studentlist_filename = config['student_list']['filename']
 
-    with open(studentlist_filename, mode='w', newline='', encoding='ISO-8859-1') as student_file:
-        student_writer = csv.writer(student_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+    rows = [['course', 'lastname', 'firstname', 'sid', 'email']]
+    for student in studentList:
+        rows.append(student.toList())
 
-        # Write header
-        student_writer.writerow(['course', 'lastname', 'firstname', 'sid', 'email'])
-
-        for student in studentList:
-            student_writer.writerow(student.toList())
+    csvcache.write_csv(config, studentlist_filename, rows, 'ISO-8859-1')
 
 
 ################################################################################
@@ -418,9 +516,7 @@ def load_student_data_from_extract(config):
     # import the daily extract from IR
     if os.path.exists(EXTRACT_FILE):
         
-        extractfile = open(EXTRACT_FILE, encoding='ISO-8859-1')
-        extractfilereader = csv.reader(extractfile)
-        extractdata = list(extractfilereader)
+        extractdata = csvcache.read_csv(config, EXTRACT_FILE, 'ISO-8859-1')
 
     # skip over the first row which is just column titles
     extractdata = extractdata[1:]
@@ -458,9 +554,7 @@ def verify_class_data(config):
     # import the class data
     if os.path.exists(CLASS_FILE_NAME):
         
-        file = open(CLASS_FILE_NAME, encoding='ISO-8859-1')
-        filereader = csv.reader(file)
-        classdata = list(filereader)
+        classdata = csvcache.read_csv(config, CLASS_FILE_NAME, 'ISO-8859-1')
 
     # skip over the first row which is just column titles
     classdata = classdata[1:]
@@ -504,9 +598,7 @@ def verify_student_data(config):
     # import the class data
     if os.path.exists(STUDENT_FILE_NAME):
         
-        file = open(STUDENT_FILE_NAME, encoding='ISO-8859-1')
-        filereader = csv.reader(file)
-        studentdata = list(filereader)
+        studentdata = csvcache.read_csv(config, STUDENT_FILE_NAME, 'ISO-8859-1')
 
     # skip over the first row which is just column titles
     studentdata = studentdata[1:]
@@ -531,14 +623,8 @@ def verify_student_data(config):
 
     # Write the validated students to disk
 
-    with open(STUDENT_FILE_NAME, mode='w', newline='', encoding='ISO-8859-1') as student_file:
-        student_writer = csv.writer(student_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-
-        # Write header
-        student_writer.writerow(['course', 'lastname', 'firstname', 'sid', 'email'])
-
-        for student in validated_students:
-            student_writer.writerow(student)
+    csvcache.write_csv(config, STUDENT_FILE_NAME, [['course', 'lastname', 'firstname', 'sid', 'email']] + validated_students,
+                       'ISO-8859-1')
 
     return error, msg
 
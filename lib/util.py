@@ -1,4 +1,5 @@
-import os, tomli, shutil, time
+import os, tomli, shutil, time, calendar, datetime, functools
+import instrument
 
 #######################################################################
 ##
@@ -19,6 +20,8 @@ def load_config(config_filename):
         config['homedir'] = os.path.expanduser('~')
         config['reports_db'] = os.path.join(config['rootdir'], config['database']['filename'])
         config['temp_db'] = os.path.join(config['homedir'], config['database']['filename'])
+        config['archive_folder'] = os.path.join(config['rootdir'], config['database'].get('archive_folder', 'archive'))
+        config['run_folder'] = os.path.join(config['rootdir'], config.get('run_folder', 'runs'))
 
         # Locate the correct folder for one drive and set up the folder to write
         #   the instructor gradebooks to for sharing
@@ -44,6 +47,9 @@ def load_config(config_filename):
 ##
 
 def create_temp_db(config):
+    # A run that is being resumed carries on with the database it left behind
+    if config.get('resume', False) and os.path.exists(config['temp_db']):
+        return
     if os.path.exists(config['reports_db']):
         shutil.copy2(config['reports_db'], config['temp_db'])
         if not os.path.exists(config['temp_db']):
@@ -211,6 +217,40 @@ def format_seconds(seconds):
     seconds %= 60
     return f"{hours}:{minutes}:{seconds}"
 
+###############################################################################
+##
+##  Converts a datetime into integer epoch seconds. Times from YuJa have no
+##    time zone attached, so the wall clock time is counted as if it were UTC.
+##    This keeps the stored values in step with the term dates in classes.csv.
+##
+
+def datetime_to_epoch(timestamp):
+    return calendar.timegm(timestamp.timetuple())
+
+
+###############################################################################
+##
+##  Converts a 'YYYY-MM-DD HH:MM:SS' timestamp from a YuJa report into epoch
+##    seconds on the same basis as datetime_to_epoch. The fields are always
+##    at the same offsets, so they are sliced out directly instead of going
+##    through strptime. Anything after the seconds (fractions) is ignored.
+##
+
+def timestamp_to_epoch(timestamp):
+    return epoch_day(timestamp[0:10]) * 86400 + int(timestamp[11:13]) * 3600 \
+           + int(timestamp[14:16]) * 60 + int(timestamp[17:19])
+
+
+# A night of reports only covers a few hundred distinct dates, so the
+#   calendar arithmetic for each one is only done once
+
+@functools.lru_cache(maxsize=None)
+def epoch_day(datestr):
+    day = datetime.date(int(datestr[0:4]), int(datestr[5:7]), int(datestr[8:10]))
+    return day.toordinal() - EPOCH_ORDINAL
+
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
 ###############################################################################
 ##
 ##  Gets a list of the videos that need to have reports downloaded
@@ -231,6 +271,16 @@ def get_videos_to_process(video_data):
     return videos
 
 
+###############################################################################
+##
+##  Returns the file that the YuJa report for a video is saved in
+##
+
+def get_report_filename(config, videoname):
+
+    return os.path.join(config['report_folder'], f"{videoname}_report.csv")
+
+
 ################################################################################
 ##
 ##  Gets a list of all the distinct video names within the video data
@@ -264,18 +314,68 @@ def get_video_playlists(video_data):
 
 ###############################################################################
 ##
-##  Gets all the view results for a particular student from a list
+##  Sorts a list of view results so each student's views can be looked up
+##    directly. Views whose userPID has a confirmed identity are filed under
+##    that student's sid, the rest under their last name and first name with
+##    the middle initial removed. Returns both dictionaries.
+##
+##  With keys from get_view_keys only the views one of those students would
+##    look up are kept, which is all a single course needs.
 ##
 
-def get_views_for_student(config, student, view_data):
+def index_views(config, view_data, identities, keys=None):
 
     db_config = config['database']
-    found_views = []
+    lname_col = db_config['lname_col']
+    fname_col = db_config['fname_col']
+    userpid_col = db_config.get('userpid_col', 9)
+
+    views_by_sid = {}
+    views_by_name = {}
+
     for view in view_data:
-        lname = view[db_config['lname_col']] 
-        fname = remove_mid_inital(view[db_config['fname_col']])
-        if (fname in student.fname) and (lname in student.lname):
-            found_views.append(view)
+        identity = identities.get(view[userpid_col])
+        if identity != None and identity[2] == 'confirmed':
+            if keys == None or identity[0] in keys[0]:
+                views_by_sid.setdefault(identity[0], []).append(view)
+        else:
+            key = (view[lname_col], remove_mid_inital(view[fname_col]))
+            if keys == None or key in keys[1]:
+                views_by_name.setdefault(key, []).append(view)
+
+    return views_by_sid, views_by_name
+
+
+# The sids and (last name, first name) pairs get_views_for_student looks up
+#   for these students
+def get_view_keys(students):
+
+    sids = set()
+    names = set()
+    for student in students:
+        sids.add(student.sid)
+        names.update((lname, fname) for lname in student.lname for fname in student.fname)
+
+    return sids, names
+
+
+###############################################################################
+##
+##  Gets all the view results for a particular student from a list indexed by
+##    index_views. A student can have more than one first or last name, so
+##    every combination of them is looked up.
+##
+
+@instrument.hotspot('get_views_for_student')
+def get_views_for_student(student, view_index):
+
+    views_by_sid, views_by_name = view_index
+
+    found_views = list(views_by_sid.get(student.sid, []))
+    for lname in dict.fromkeys(student.lname):
+        for fname in dict.fromkeys(student.fname):
+            found_views += views_by_name.get((lname, fname), [])
+
     return found_views
         
 
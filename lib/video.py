@@ -8,11 +8,13 @@
 # download_results - whether to download the results for this video or not
 # direct_link - the direct link for the video found on yuja
 
-import csv
 import os
 
 import util
-import yuja
+import backend
+import csvcache
+import report
+import logs
 
 # video_object:
 #
@@ -72,8 +74,7 @@ def load_video_data(config):
 
     # Gather the requisite data about the videos
     if os.path.exists(video_data_filename):
-        video_data_file = open(video_data_filename)
-        video_list = list(csv.reader(video_data_file))
+        video_list = csvcache.read_csv(config, video_data_filename)
         # Delete the first row of data which is just column titles
         video_list = video_list[1:]
         
@@ -82,8 +83,7 @@ def load_video_data(config):
         msg = f"\n[ ERROR ] Video database file {video_data_filename} not found. " \
               "This should be located in the same directory where the script is located.\n"
         return_msg += msg
-        if not config['suppress_console_output']:
-            print(msg)
+        logs.display(msg, 'error')
         return error, return_msg, video_data
 
     try:
@@ -126,25 +126,21 @@ def load_video_data(config):
                 msg = f"\n[ WARNING ] Direct link for video {videoname} does not contain a " \
                       "video ID number. Check the direct_link in 'videodata.csv' to make " \
                       "sure it has an item like: v=5010426.\n"
-                return_msg += msg
-                if not config['suppress_console_output']:
-                    print(msg)
+                return_msg += report.emit(config, msg, 'warning', 'missing_video_id', video=videoname)
 
             # Get the length of the video, unless we aren't going to download results anyway
             if (line[video_config['length_col']] == '') and download_results:
                 
                 # Any unspecified lengths for video files should be obtained by contacting yuja
                 if webdriver == None:
-                    webdriver = yuja.start_web_session(config)
+                    webdriver = backend.start_web_session(config)
 
-                length = yuja.get_video_length(webdriver, yuja_id)
+                length = backend.get_video_length(config, webdriver, yuja_id)
                 update_video_file = True
 
                 msg = f"\n[ NOTICE ] Video length for {videoname} was not specified. " \
                        f"Acquiring data from Yuja.\n"
-                return_msg += msg
-                if not config['suppress_console_output']:
-                    print(msg)
+                return_msg += report.emit(config, msg, 'info', 'video_length', video=videoname, length=length)
 
             elif util.is_number(line[video_config['length_col']]):
                 length = round(float(line[video_config['length_col']]))
@@ -168,12 +164,10 @@ def load_video_data(config):
         error = 1
         msg = f"\n[ ERROR ] Format error likely in the video database file, " \
                f"{video_data_filename} at video {video['name']}\n"
-        return_msg += msg
-        if not config['suppress_console_output']:
-            print(msg)
+        return_msg += report.emit(config, msg, 'error', 'video_data_format')
 
     if webdriver != None:
-        yuja.end_web_session(webdriver)
+        backend.end_web_session(config, webdriver)
 
     # If new data was acquired, write the new video data to the ouput file
     if update_video_file:
@@ -195,18 +189,18 @@ def export_video_data(config, videodata):
     video_config = config['video_data']
     video_data_filename = video_config['filename']
 
-    with open(video_data_filename, 'w', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow(['videoset', 'video_name', 'd2l_name', 'length', 'download_results', 'direct_link'])
-        for video in videodata:
-            row = []
-            row.append(video['set'])
-            row.append(video['name'])
-            row.append(video['d2lname'])
-            row.append(video['length'])
-            row.append(video['download_results'])
-            row.append(video['direct_link'])
-            writer.writerow(row)
+    rows = [['videoset', 'video_name', 'd2l_name', 'length', 'download_results', 'direct_link']]
+    for video in videodata:
+        row = []
+        row.append(video['set'])
+        row.append(video['name'])
+        row.append(video['d2lname'])
+        row.append(video['length'])
+        row.append(video['download_results'])
+        row.append(video['direct_link'])
+        rows.append(row)
+
+    csvcache.write_csv(config, video_data_filename, rows)
 
 
 ################################################################################
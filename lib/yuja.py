@@ -1,10 +1,12 @@
 import os, datetime, time, csv, json, random
-import util
+import util, pacing, instrument, report, logs
+import database as db
 
 from bs4 import BeautifulSoup
 
 from selenium import webdriver
 from selenium.webdriver.common.by import By
+from selenium.common.exceptions import WebDriverException
 
 from selenium.webdriver.chrome.service import Service
 from webdriver_manager.chrome import ChromeDriverManager
@@ -31,6 +33,17 @@ def test():
     download_new_reports(config, videodata)
     
 
+####################################################
+## 
+## The address of the YuJa site to use, set by 'yuja_url' in config.toml. It
+##   can point at a test server such as benchmarks/mock_yuja.py.
+##
+
+def get_yuja_url(config):
+
+    return config.get('yuja_url', 'https://tridenttech.yuja.com').rstrip('/')
+
+
 ####################################################
 ## 
 ## Opens up a web driver for the specified browser in the config file using selenium,
@@ -60,8 +73,11 @@ def start_web_session(config):
             options.add_argument("--headless")
         driver = webdriver.Firefox(service=firefox, options=options)
 
+    # Create the pacer from this config before any requests are made
+    get_pacer(config)
+
     # Log into the website
-    driver.get("https://tridenttech.yuja.com/Login?accesstype=YuJa%20Credentials")
+    driver.get(get_yuja_url(config) + "/Login?accesstype=YuJa%20Credentials")
     random_wait(10, 15)
 
     elem = driver.find_element(By.ID, "loginuserid")  
@@ -78,13 +94,61 @@ def start_web_session(config):
     return driver
 
 
+####################################################
+##
+## A session can be kept open for the next run by setting 'keep_web_session',
+##   as the daemon does, so that it doesn't have to log in again. A kept
+##   session that has since expired is logged into again by fetch_with_retry.
+##
+
+kept_session = None
+
+def open_web_session(config):
+
+    global kept_session
+
+    if kept_session != None:
+        driver, kept_session = kept_session, None
+        return driver
+
+    return start_web_session(config)
+
+
+def close_web_session(config, driver):
+
+    global kept_session
+
+    if config.get('keep_web_session', False):
+        kept_session = driver
+    else:
+        end_web_session(driver)
+
+
+def end_kept_web_session():
+
+    global kept_session
+
+    if kept_session != None:
+        try:
+            end_web_session(kept_session)
+        except WebDriverException:
+            pass
+        kept_session = None
+
+
 #######################################################
 ##
 ## Downloads view data from the YuJa website for the videos specified in the
-##   videodata file and saves them to the reports folder.
+##   videodata file and saves them to the reports folder. If on_report is
+##   given it is called with each video and its report file as soon as the
+##   report has been written.
+##
+## Each video is checkpointed in the database as it finishes. With the
+##   'resume' option set, the last run that did not finish is picked up again
+##   and any video it already downloaded is skipped.
 ##
 
-def download_new_reports(config, videodata):
+def download_new_reports(config, videodata, on_report=None):
     
     error = 0
     msg = ''
@@ -96,99 +160,344 @@ def download_new_reports(config, videodata):
 
     if config['download_reports'] and len(download_links) > 0:
     
-        driver = start_web_session(config)
+        run_id, completed = db.start_download_run(config, download_links, config.get('resume', False))
+
+        # Only log in once there is something left to download
+        driver = None
 
         count = 1
         total = len(download_links)
         
         for video in download_links:
 
-            results = []
-            timestart = datetime.datetime.now()
-            
-            msg += f'Downloading report: {video["name"]} from YuJa ({str(count)} of {str(total)})\n'
-            print(f'Downloading report: {video["name"]} from YuJa ({str(count)} of {str(total)})\n')
-
-            # open the website the contains the individual student view data 
-            #   and pull that information for the current course
-            data_link = "view-source: https://tridenttech.yuja.com/Dashboard/Analytics/Data/UserVideoPlaybackStatisticsJSON"
-            data_link += f"?videoPID={video['yuja_id']}&classPID=-1&userPID=0&getUserInfoFlag=0"
-            driver.get(data_link)
-
-            soup = BeautifulSoup(driver.page_source, 'html.parser')
-            data = soup.body.text;
-            views = json.loads(data)
-
-            timeend = datetime.datetime.now()
-            msg += f"Time to download: {(timeend - timestart).total_seconds()} seconds.\n"
-            print(f"Time to download: {(timeend - timestart).total_seconds()} seconds.\n")
-
-            random_wait(2, 4);
-            # Next get the data that contains the total view length for each
-            #   student regardless of how many views are posted
-            data_link = "view-source: https://tridenttech.yuja.com/Dashboard/Analytics/Data/UserVideoTotalPlayLengthJSON"
-            data_link += f"?videoPID={video['yuja_id']}&classPID=-1&userPIDs[]=-1"
-            driver.get(data_link)
-            
-            soup = BeautifulSoup(driver.page_source, "html.parser")
-            data = soup.body.text;
-            view_lengths = json.loads(data)['data']['totalPlayLengths']
-
-            # grab the usefult data from that object, note that times are
-            #   given in milliseconds which is why the division by 1000
-            for view in views['data']:
-
-                # If a view length isn't specified, then default to zero
-                if view['totalPlayLength'] == None:
-                    view['totalPlayLength'] = 0
-                    
-                # Find the total view length for all views from this student
-                pid = view['userPID']
-                combinedPlayTime = 0
-                
-                for length in view_lengths:
-                    if length['userPID'] == pid:
-                        combinedPlayTime = length['totalPlayLength']
-                        break
-                    
-                record = {
-                    'lastname': view['lastname'],
-                    'firstname': view['firstname'],
-                    'videoname': video['name'],
-                    'videolength': video['length'],
-                    'playlength': round(view['totalPlayLength'] / 1000),
-                    'totalplaytime': round(combinedPlayTime / 1000),
-                    'starttime': datetime.datetime.fromtimestamp(view['firstWatched'] / 1000),
-                    'endtime': datetime.datetime.fromtimestamp(view['lastWatched'] / 1000)
-                }
-                results.append(record)
+            if video['name'] in completed:
+                msg += report.emit(config, f'Skipping report: {video["name"]}, already downloaded ({str(count)} of {str(total)})\n',
+                                   'info', 'download_skipped', video=video['name'])
+                if on_report != None:
+                    on_report(video, util.get_report_filename(config, video['name']))
+                count += 1
+                continue
+
+            if driver == None:
+                with instrument.stage(config, 'login'):
+                    driver = open_web_session(config)
+                fetch = get_fetch_function(config, download_links, completed)
+
+            msg += report.emit(config, f'Downloading report: {video["name"]} from YuJa ({str(count)} of {str(total)})\n',
+                               'info', 'download', video=video['name'])
+
+            try:
+                driver, (views, view_lengths, download_time), attempts = fetch_with_retry(config, driver, fetch, video)
+
+            except transient_errors as e:
+                db.checkpoint_download(config, run_id, video['name'], 'failed', get_retry_settings(config)[0], repr(e))
+                error = -1
+                msg += report.emit(config, f'Could not download the report for {video["name"]}: {repr(e)}\n'
+                                           f'Run again with --resume to carry on from this video.\n',
+                                   'error', 'download_failed', video=video['name'], error=repr(e))
+                break
+
+            msg += report.emit(config, f"Time to download: {download_time} seconds.\n", 'debug', 'download_time',
+                               video=video['name'], seconds=download_time)
+
+            timestart = time.perf_counter()
+            rows = normalize_views(video, views, view_lengths)
+            msg += report.emit(config, f"Time to normalize {len(rows)} views: {time.perf_counter() - timestart:.4f} seconds.\n",
+                               'debug', 'normalize_time', video=video['name'], views=len(rows))
 
             # write the view data to a file on disk to save for futher processing
-            report_path = os.path.join(config['report_folder'], f"{video['name']}_report.csv")
+            report_path = util.get_report_filename(config, video['name'])
             with open(report_path, 'w', newline='') as f:
                 writer = csv.writer(f)
-                writer.writerow(['lastname', 'firstname', 'videoname', 'videolength', 'playlength', 'totalplaytime', 'starttime', 'endtime'])
-                for record in results:
-                    row = []
-                    row.append(record['lastname'])
-                    row.append(record['firstname'])
-                    row.append(record['videoname'])
-                    row.append(record['videolength'])
-                    row.append(record['playlength'])
-                    row.append(record['totalplaytime'])
-                    row.append(record['starttime'])
-                    row.append(record['endtime'])
-                    writer.writerow(row)
-
-            # wait before loading the data from the next file
-            random_wait(5, 10);
+                writer.writerow(['lastname', 'firstname', 'videoname', 'videolength', 'playlength', 'totalplaytime', 'starttime', 'endtime', 'userpid'])
+                writer.writerows(rows)
+
+            db.checkpoint_download(config, run_id, video['name'], 'done', attempts)
+            instrument.count(config, 'videos_downloaded')
+            instrument.count(config, 'views_downloaded', len(rows))
+
+            if on_report != None:
+                on_report(video, report_path)
+
             count += 1
 
-        end_web_session(driver)
+        if error == 0:
+            db.finish_download_run(config, run_id)
+
+        if driver != None:
+            close_web_session(config, driver)
+
+        msg += report.emit(config, get_pacer(config).summary(), 'info', 'pacing')
 
     return error, msg
 
 
+#######################################################
+##
+## Turns the JSON from YuJa into the rows of a report, in the order of the
+##   report's columns, with the viewer's userPID last. Times are given in
+##   milliseconds which is why they are divided by 1000. Each student's total
+##   play length is looked up by their userPID, so the lengths are put in a
+##   dictionary first rather than being searched for every view.
+##
+
+def normalize_views(video, views, view_lengths):
+
+    # Keep the first length listed for a student, as the search used to
+    combined_play_times = {}
+    for length in view_lengths:
+        combined_play_times.setdefault(length['userPID'], length['totalPlayLength'])
+
+    videoname = video['name']
+    videolength = video['length']
+    fromtimestamp = datetime.datetime.fromtimestamp
+
+    # If a view length isn't specified, then default to zero
+    return [(view['lastname'], view['firstname'], videoname, videolength,
+             round((view['totalPlayLength'] or 0) / 1000),
+             round(combined_play_times.get(view['userPID'], 0) / 1000),
+             fromtimestamp(view['firstWatched'] / 1000),
+             fromtimestamp(view['lastWatched'] / 1000),
+             view['userPID'])
+            for view in views['data']]
+
+
+#######################################################
+##
+## Pulls the individual view data and the total view lengths for a single
+##   video from YuJa. Returns both along with the time taken in seconds.
+##
+
+def fetch_report_data(config, driver, video):
+
+    timestart = datetime.datetime.now()
+
+    # open the website the contains the individual student view data 
+    #   and pull that information for the current course
+    data_link = "view-source: " + get_yuja_url(config) + get_playback_path(video)
+    views = get_json_page(driver, data_link)
+
+    timeend = datetime.datetime.now()
+    logs.display(f"Time to download: {(timeend - timestart).total_seconds()} seconds.", 'debug')
+
+    # Next get the data that contains the total view length for each
+    #   student regardless of how many views are posted
+    data_link = "view-source: " + get_yuja_url(config) + get_play_length_path(video)
+    view_lengths = get_json_page(driver, data_link)['data']['totalPlayLengths']
+
+    return views, view_lengths, (timeend - timestart).total_seconds()
+
+
+def get_playback_path(video):
+
+    return f"/Dashboard/Analytics/Data/UserVideoPlaybackStatisticsJSON" \
+           f"?videoPID={video['yuja_id']}&classPID=-1&userPID=0&getUserInfoFlag=0"
+
+
+def get_play_length_path(video):
+
+    return f"/Dashboard/Analytics/Data/UserVideoTotalPlayLengthJSON" \
+           f"?videoPID={video['yuja_id']}&classPID=-1&userPIDs[]=-1"
+
+
+#######################################################
+##
+## Picks how the reports are pulled from YuJa from the 'fetch_mode' setting
+##
+##   page  - load each JSON page in the browser and read it back out of the
+##           page source (default)
+##   batch - fetch the JSON for several videos at once from inside the
+##           logged in page, see fetch_report_batch
+##
+
+def get_fetch_function(config, videos, completed):
+
+    if config.get('fetch_mode', 'page') == 'batch':
+        return make_batch_fetch(config, [video for video in videos if video['name'] not in completed])
+
+    return lambda driver, video: fetch_report_data(config, driver, video)
+
+
+#######################################################
+##
+## Returns a fetch function for fetch_with_retry that pulls the reports in
+##   batches. The first video that isn't already fetched starts a new batch
+##   with the videos that follow it, and the rest of the batch is kept until
+##   those videos are asked for. A video asked for again, after its batch
+##   left it out, starts a batch of only the videos still to be fetched, so
+##   nothing already fetched is downloaded again.
+##
+
+class BatchFetchError(Exception):
+    pass
+
+def make_batch_fetch(config, videos):
+
+    batch_config = config.get('batch', {})
+    batch_size = batch_config.get('size', 20)
+
+    position = { video['name']: i for i, video in enumerate(videos) }
+    fetched = {}
+    returned = set()
+
+    def fetch(driver, video):
+        if video['name'] not in fetched:
+            start = position[video['name']]
+            missing = [other for other in videos[start:]
+                       if other['name'] not in fetched and other['name'] not in returned]
+            fetched.update(fetch_report_batch(config, driver, missing[:batch_size]))
+
+        if video['name'] not in fetched:
+            raise BatchFetchError(f'YuJa did not return the report for {video["name"]}')
+
+        returned.add(video['name'])
+        return fetched.pop(video['name'])
+
+    return fetch
+
+
+#######################################################
+##
+## Pulls the playback statistics and total play lengths for a batch of
+##   videos in a single call into the browser. The page runs the fetches
+##   itself with the session it is logged in with, at most 'concurrency' at a
+##   time, and hands back the parsed JSON and the size of each response, so
+##   nothing is navigated to or read back out of the page source. Returns a dictionary of video name to the
+##   same tuple fetch_report_data returns, leaving out any video whose
+##   requests failed so it can be retried.
+##
+## The [batch] section of config.toml can set size, concurrency and timeout
+##   (in seconds).
+##
+
+batch_fetch_js = '''
+    var urls = arguments[0], limit = arguments[1], done = arguments[arguments.length - 1];
+    var results = new Array(urls.length), next = 0;
+
+    function worker() {
+        if (next >= urls.length) return Promise.resolve();
+        var i = next++;
+        return fetch(urls[i], { credentials: 'same-origin' })
+            .then(function (r) {
+                return r.text().then(function (text) {
+                    var json = null;
+                    try { json = JSON.parse(text); } catch (e) {}
+                    return { status: r.status, size: text.length, json: json };
+                }, function () { return { status: r.status, size: 0, json: null }; });
+            }, function (e) { return { status: 0, size: 0, json: null }; })
+            .then(function (result) { results[i] = result; return worker(); });
+    }
+
+    var workers = [];
+    for (var w = 0; w < Math.min(limit, urls.length); w++) workers.push(worker());
+    Promise.all(workers).then(function () { done(results); });
+'''
+
+def fetch_report_batch(config, driver, videos):
+
+    batch_config = config.get('batch', {})
+
+    urls = []
+    for video in videos:
+        urls.append(get_playback_path(video))
+        urls.append(get_play_length_path(video))
+
+    pacer = get_pacer(config)
+    pacer.wait()
+
+    start = time.monotonic()
+    driver.set_script_timeout(batch_config.get('timeout', 300))
+    responses = driver.execute_async_script(batch_fetch_js, urls, batch_config.get('concurrency', 4))
+    latency = time.monotonic() - start
+
+    statuses = [response['status'] for response in responses]
+    pacer.record(latency, sum(response['size'] for response in responses),
+                 error=any(status != 200 for status in statuses),
+                 throttled=any(status in (429, 503) for status in statuses))
+
+    logs.display(f"Time to download {len(videos)} reports: {latency} seconds.", 'debug')
+
+    results = {}
+    for i, video in enumerate(videos):
+        views = responses[2 * i]['json']
+        lengths = responses[2 * i + 1]['json']
+        if views != None and lengths != None and 'data' in views and 'data' in lengths:
+            results[video['name']] = (views, lengths['data']['totalPlayLengths'], latency / len(videos))
+
+    return results
+
+
+#######################################################
+##
+## Calls fetch(driver, video) and retries it when it fails in a way that is
+##   likely to clear up by itself: a page that isn't valid JSON, a timeout or
+##   a browser error. The wait between attempts grows exponentially with a
+##   random jitter, and if the session has expired the browser logs in again.
+##   Returns the driver in use, the result of fetch and the number of attempts.
+##
+## The [retry] section of config.toml can set attempts, base_delay and
+##   max_delay (in seconds).
+##
+
+# Only what a bad response or a browser problem raises, anything else is a
+#   bug and is not retried
+transient_errors = (WebDriverException, json.JSONDecodeError, BatchFetchError)
+
+@instrument.hotspot('yuja_fetch')
+def fetch_with_retry(config, driver, fetch, video):
+
+    attempts, base_delay, max_delay = get_retry_settings(config)
+
+    attempt = 1
+    while True:
+        try:
+            return driver, fetch(driver, video), attempt
+
+        except transient_errors as e:
+            if attempt >= attempts:
+                raise
+
+            wait = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            logs.display(f'Attempt {attempt} for {video["name"]} failed ({type(e).__name__}), retrying in {wait:.1f} seconds.',
+                         'warning')
+            time.sleep(wait)
+
+            if session_expired(driver):
+                driver = restart_web_session(config, driver)
+
+            attempt += 1
+
+
+def get_retry_settings(config):
+
+    retry_config = config.get('retry', {})
+    return retry_config.get('attempts', 5), retry_config.get('base_delay', 5), retry_config.get('max_delay', 300)
+
+
+####################################################
+##
+## A session that has timed out is sent back to the login page. A browser
+##   that no longer responds is treated the same way.
+##
+
+def session_expired(driver):
+
+    try:
+        return 'loginuserid' in driver.page_source
+    except WebDriverException:
+        return True
+
+
+def restart_web_session(config, driver):
+
+    try:
+        end_web_session(driver)
+    except WebDriverException:
+        pass
+
+    return start_web_session(config)
+
+
 ####################################################
 ## Erases the usage data saved on Yuja's website, this is needed when the
 ##   number of views for a video gets to be very high and it starts taking
@@ -209,13 +518,15 @@ def delete_view_data_on_yuja(config, videodata):
     ##
     videos_to_process = util.get_videos_to_process(videodata)
     
-    print(f'\n\nWARNING: You have set the flag "clear_online_data" in the file' \
+    logs.display(f'\n\nWARNING: You have set the flag "clear_online_data" in the file' \
          + ' config.toml. This will delete all the results stored online for' \
          + ' the videos in the database "video_data.csv" that have a DOWNLOAD_RESULTS' \
          + ' flag set to TRUE. It will not delete any previously saved data from the' \
          + ' the main database store or have any effect on previously generated' \
-         + ' gradebooks.\n')
+         + ' gradebooks.\n', 'warning')
     
+    # The warning has to be on the screen before the question is asked
+    logs.flush()
     intent = input('Is this what you intend to do? (Y/n): ')
 
     if (intent == 'Y') and config['clear_online_data'] and (len(videos_to_process) > 0):
@@ -225,33 +536,41 @@ def delete_view_data_on_yuja(config, videodata):
         count = 1
         total = len(videos_to_process)
         
+        pacer = get_pacer(config)
+
         for video in videos_to_process:
             
             msg += f'Deleting Online Results for: {video["name"]} from YuJa ({str(count)} of {str(total)})\n'
-            print(f'Deleting Online Results for: {video["name"]} from YuJa ({str(count)} of {str(total)})\n')
+            logs.display(f'Deleting Online Results for: {video["name"]} from YuJa ({str(count)} of {str(total)})')
 
             # submit a POST request to the website responsible for removing the video results
             js = f"var xhr = new XMLHttpRequest();\n" \
-            f"xhr.open('POST', 'https://tridenttech.yuja.com/Dashboard/TMSIKUGCCT/Data/ClassVideoPlaybackStatisticsJSON', false);\n" \
+            f"xhr.open('POST', '{get_yuja_url(config)}/Dashboard/TMSIKUGCCT/Data/ClassVideoPlaybackStatisticsJSON', false);\n" \
             f"xhr.setRequestHeader('Content-type', 'application/x-www-form-urlencoded; charset=UTF-8');\n" \
             f"xhr.setRequestHeader('User-Agent', 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:109.0) Gecko/20100101 Firefox/111.0');\n" \
             f"xhr.send('videoPID={video['yuja_id']}');\n" \
             f"return xhr.response;\n"
 
+            pacer.wait()
+            start = time.monotonic()
             result = driver.execute_script(js)
-            resultObj = json.loads(result)
-            success = resultObj.get("success")
+            latency = time.monotonic() - start
+
+            # A failure can come back as an HTML error page rather than JSON
+            try:
+                success = json.loads(result).get("success")
+            except json.JSONDecodeError:
+                success = False
+            pacer.record(latency, len(result), error=not success)
             if success:
                 msg += f'Response from server: Success'
-                print('Response from server: Success')
+                logs.display('Response from server: Success')
             else:
                 msg += f'Response from server: Error ... aborting!'
-                print('Response from server: Error ...aborting!')
+                logs.display('Response from server: Error ...aborting!', 'error')
                 error = -1
                 break
 
-            random_wait(5, 10)
-
         end_web_session(driver)
 
     return error, msg
@@ -274,31 +593,82 @@ def end_web_session(driver):
 ##  as an integer in seconds
 ##
 
-def get_video_length(driver, id):
+def get_video_length(config, driver, id):
 
-    data_link = "view-source:https://tridenttech.yuja.com/P/Data/VideoListJSON?includeAllClasses=false"
+    data_link = "view-source:" + get_yuja_url(config) + "/P/Data/VideoListJSON?includeAllClasses=false"
     data_link += f"&videoID%5B%5D={id}"
-    driver.get(data_link)
-    random_wait(8, 15)
-
-    soup = BeautifulSoup(driver.page_source, 'html.parser')
-    data = soup.body.text;
 
-    video_data = json.loads(data)
+    video_data = get_json_page(driver, data_link)
     length = int(video_data["data"][0]["duration"])
 
     return length
 
 
+####################################################
+##
+## Loads one of YuJa's JSON pages in the browser and returns the parsed data.
+##   Every page is paced by the shared pacer, which is told how long the page
+##   took, how big it was and whether YuJa turned the request away.
+##
+
+def get_json_page(driver, data_link):
+
+    pacer = get_pacer()
+    pacer.wait()
+
+    data = ''
+    start = time.monotonic()
+    try:
+        driver.get(data_link)
+        latency = time.monotonic() - start
+
+        soup = BeautifulSoup(driver.page_source, 'html.parser')
+        data = soup.body.text;
+        result = json.loads(data)
+
+    except (json.JSONDecodeError, AttributeError, WebDriverException):
+        pacer.record(time.monotonic() - start, len(data), error=True, throttled=is_throttled(data))
+        raise
+
+    pacer.record(latency, len(data))
+
+    return result
+
+
+# YuJa answers with an error page rather than JSON when it is throttling
+def is_throttled(data):
+
+    data = data.lower()
+    return '429' in data or 'too many requests' in data or '503' in data or 'service unavailable' in data
+
+
+####################################################
+##
+## The pacer shared by every request made to YuJa during this run. The first
+##   call with a config creates it from the [pacing] section.
+##
+
+pacer = None
+
+def get_pacer(config=None):
+
+    global pacer
+    if pacer == None:
+        pacer = pacing.Pacer(config or {})
+
+    return pacer
+
+
 ####################################################
 ##
 ## To slow down the rate of requests made on YuJa's servers, this function pauses
-##   execution of the script for a random amount of time
+##   execution of the script for a random amount of time. It is only used while
+##   logging in now, to give each page time to load.
 ##
 
 def random_wait(a, b):
     wait = a + (b-a) * random.random()
-    print(f'Waiting: {wait} seconds.')
+    logs.display(f'Waiting: {wait} seconds.', 'debug')
     time.sleep(wait)
 
 ##################################################
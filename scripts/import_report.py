@@ -0,0 +1,55 @@
+import os, sys, subprocess
+
+# The program is one folder up from this script, wherever it is run from
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# These are only needed to talk to YuJa, so grading on its own shouldn't load them
+ONLINE_MODULES = ['selenium', 'bs4', 'webdriver_manager']
+
+# What videograder.py imports before it starts grading
+GRADING_IMPORTS = 'import videograder'
+
+TOP_COUNT = 15
+
+def main():
+    timings = get_import_times(GRADING_IMPORTS)
+
+    total = sum(self_time for self_time, cumulative, name in timings)
+    print(f'Imported {len(timings)} modules in {total / 1000:.1f} ms\n')
+
+    print('Slowest imports (cumulative):')
+    top_level = [t for t in timings if '.' not in t[2]]
+    for self_time, cumulative, name in sorted(top_level, key=lambda t: -t[1])[:TOP_COUNT]:
+        print(f'  {cumulative / 1000:8.1f} ms  {name}')
+
+    loaded = [name for self_time, cumulative, name in timings
+              if name.split('.')[0] in ONLINE_MODULES]
+
+    if len(loaded) > 0:
+        print(f'\nThe grading path imported {len(loaded)} online modules: ' + ', '.join(sorted(loaded)[:10]))
+        sys.exit(1)
+    else:
+        print('\nThe grading path did not import any of: ' + ', '.join(ONLINE_MODULES))
+
+
+# Runs the imports in a fresh interpreter with -X importtime and returns
+#   (self us, cumulative us, module name) for every module it loaded
+def get_import_times(imports):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', imports],
+                            cwd=ROOT_DIR, capture_output=True, text=True)
+    if result.returncode != 0:
+        print(result.stderr)
+        sys.exit(result.returncode)
+
+    timings = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        timings.append((int(self_time), int(cumulative), name.strip()))
+
+    return timings
+
+
+if __name__ == '__main__':
+    main()
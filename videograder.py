@@ -21,111 +21,314 @@
 ##     times, find out how to ensure to always retrieve the correct time
 ##     from the website
 
-import os, sys, datetime, traceback, logging
+import os, sys, json, datetime, traceback, argparse
 
 sys.path.append(os.path.join('.', 'lib'))
 
 import lib.util as util
 import lib.video as video
 import lib.student as student
-import lib.yuja as yuja
 import lib.grade as grade
 import lib.database as db
+import lib.pipeline as pipeline
+import lib.daemon as daemon
+import lib.report as report
+import lib.logs as logs
+import lib.stages as stages
+
+# These keep state in the module, the loaded backend and its web session, and
+#   the run's hotspots, so they are imported by the name the lib modules use
+#   to have only the one copy of each
+import backend
+import instrument
 
 
 def main(config, logger):
 
     starttime = datetime.datetime.now()
 
-    # Make sure the reports database exists or else create it
-    db.create_report_db(config)
+    # Record the timings and counts of every step of this run, and stream
+    #   what each step reports to the log and the run report
+    instrument.start_run(config)
+    report.start_report(config, logger, config['run'].name)
+    status = 'failed'
 
-    # Copy the database to a temporary location that is not affected by OneDrive
-    util.create_temp_db(config)
+    try:
+        run_steps(config, logger)
+        status = 'completed'
 
-    # Read the video data from the video database
-    logAndDisplay(logger, 'Loading video data...', end='')
-    error, msg, video_data = video.load_video_data(config)
-    displayError(logger, error, msg)
+    finally:
+        logAndDisplay(logger, config['run'].summary())
+        record_path = instrument.save_run(config, status)
+        logAndDisplay(logger, 'Run record saved to ' + record_path)
+        logAndDisplay(logger, 'Run report saved to ' + report.finish_report(config))
 
-    # Verify that the video data is all valid
-    logAndDisplay(logger, 'Validating video data...', end='')
-    error, msg, video_data = video.verify_video_data(config, video_data)
-    displayError(logger, error, msg)
+    endtime = datetime.datetime.now()
 
-    # Verify that the student data is all valid
-    logAndDisplay(logger, 'Validating student data...', end='')
-    error, msg = student.verify_student_data(config)
-    displayError(logger, error, msg)
+    elapsed = config['setuptime'] - starttime
+    logAndDisplay(logger, '\nSetup Time: ' + str(elapsed))
 
+    elapsed = endtime - config['setuptime']
+    logAndDisplay(logger, '\nProcessing Time: ' + str(elapsed))
 
-    # Verify that the class data is all valid
-    logAndDisplay(logger, 'Validating class data...', end='')
-    error, msg = student.verify_class_data(config)
-    displayError(logger, error, msg)
+    elapsed = endtime - starttime
+    logAndDisplay(logger, '\nTotal Time: ' + str(elapsed))
 
-    # Load the class and student data from the databases
-    logAndDisplay(logger, 'Loading Student and Class Data...', end='')
-    error, msg, class_list = student.create_class_list(config, video_data)
-    displayError(logger, error, msg)
 
-    # Refresh the student database
-    logAndDisplay(logger, 'Refreshing student database...', end='')
-    msg, class_list = student.refresh_students(config, class_list)
-    logAndDisplay(logger, '[ COMPLETE ]')
-    logAndDisplay(logger, msg)
+#####################################################################
+##
+## Runs each step of the program as its own stage of the run record
+##
 
-    if config['clear_online_data']:
-        # Delete old view data from Yuja website, if requested
-        logAndDisplay(logger, 'Deleting saved view data from Yuja website', end='')
-        error, msg = yuja.delete_view_data_on_yuja(config, video_data)
-        if error < 0:
-            logAndDisplay(logger, '[ ERROR ]')
-            performErrorExit(logger, msg)
-        else:
-            logAndDisplay(logger, '[ COMPLETE ]')
-            logAndDisplay(logger, msg)       
+def run_steps(config, logger):
+
+    # Get the databases, the video data and, unless the pipeline builds it
+    #   alongside the downloads, the class list ready
+    video_data, class_list = prepare_inputs(config, logger, not config.get('pipeline', False))
+
+    if config.get('pipeline', False):
+
+        # Any online data has to be cleared before the downloads start
+        with instrument.stage(config, 'clear_online_data'):
+            clear_online_data(config, logger, video_data)
+
+        config['setuptime'] = datetime.datetime.now()
+
+        # Download, load and grade the reports in overlapping steps, while the
+        #   class list and instructor gradebooks are loaded alongside
+        with instrument.stage(config, 'pipeline'):
+            logAndDisplay(logger, 'Downloading, loading and grading reports...')
+            error, msg, class_list = pipeline.run_pipeline(config, video_data,
+                                                           lambda: get_class_list(config, logger, video_data))
+            if error < 0:
+                logAndDisplay(logger, '[ ERROR ]')
+                performErrorExit(logger, msg)
+            else:
+                logAndDisplay(logger, msg)
+
+        # Move views from terms that have ended out of the nightly_reports database
+        with instrument.stage(config, 'archive_old_terms'):
+            msg = db.archive_old_terms(config, class_list)
+            if msg != '':
+                logAndDisplay(logger, msg)
 
-    # Download the new reports from Yuja  
-    logAndDisplay(logger, 'Downloading reports from Yuja website...', end='')
-    error, msg = yuja.download_new_reports(config, video_data)
-    if error < 0:
-        logAndDisplay(logger, '[ ERROR ]')
-        performErrorExit(logger, msg)
     else:
-        logAndDisplay(logger, '[ COMPLETE ]')
-        logAndDisplay(logger, msg)        
+        with instrument.stage(config, 'clear_online_data'):
+            clear_online_data(config, logger, video_data)
+
+        # Download the new reports from Yuja  
+        with instrument.stage(config, 'download_reports'):
+            logAndDisplay(logger, 'Downloading reports from Yuja website...', end='')
+            error, msg = backend.download_new_reports(config, video_data)
+            if error < 0:
+                logAndDisplay(logger, '[ ERROR ]')
+                performErrorExit(logger, msg)
+            else:
+                logAndDisplay(logger, '[ COMPLETE ]')
+                logAndDisplay(logger, msg)       
+
+        # Load all the video results into the nightly_reports database
+        with instrument.stage(config, 'load_views'):
+            if config.get('rebuild', False):
+                logAndDisplay(logger, 'Rebuilding the database from all saved reports...', end='')
+                msg = db.rebuild_views_db(config, config.get('workers'))
+            else:
+                logAndDisplay(logger, 'Loading reports into the database...', end='')
+                msg = db.load_views_into_db(config)
+            logAndDisplay(logger, '[ COMPLETE ]')
+            logAndDisplay(logger, msg)
 
-    # Load all the video results into the nightly_reports database
-    db.load_views_into_db(config)
+        # Move views from terms that have ended out of the nightly_reports database
+        with instrument.stage(config, 'archive_old_terms'):
+            msg = db.archive_old_terms(config, class_list)
+            if msg != '':
+                logAndDisplay(logger, msg)
 
-    setuptime = datetime.datetime.now()
+        config['setuptime'] = datetime.datetime.now()
 
-    # Load all the instructor gradebooks into a database
-    class_list = grade.load_instructor_gradebooks(config, class_list, video_data)
+        if config.get('stream', False):
 
-    # Compile the grades by comparing the nightly reports and instructor gradebooks
-    msg = grade.process_video_grades(config, class_list, video_data)
-    logAndDisplay(logger, msg)
+            # Load the gradebooks, grade and write the output CSV files one group
+            #   of courses at a time
+            with instrument.stage(config, 'stream_video_grades'):
+                msg = grade.stream_video_grades(config, class_list, video_data)
+                logAndDisplay(logger, msg)
+
+        else:
+
+            # Load all the instructor gradebooks into a database
+            with instrument.stage(config, 'load_instructor_gradebooks'):
+                class_list = grade.load_instructor_gradebooks(config, class_list, video_data)
+
+            # Compile the grades by comparing the nightly reports and instructor gradebooks
+            with instrument.stage(config, 'process_video_grades'):
+                msg = grade.process_video_grades(config, class_list, video_data)
+                logAndDisplay(logger, msg)
 
-    # Create the output CSV gradebook files
-    grade.create_instructor_gradebooks(config, class_list, video_data)
+    # Create the output CSV gradebook files, streaming has written them already
+    if config.get('pipeline', False) or not config.get('stream', False):
+        with instrument.stage(config, 'create_instructor_gradebooks'):
+            grade.create_instructor_gradebooks(config, class_list, video_data)
 
     # Lastly, copy the temporary database back to the original directory so OneDrive can synch it
-    util.delete_temp_db(config)
+    with instrument.stage(config, 'delete_temp_db'):
+        util.delete_temp_db(config)
+
+    # Clean up the reports that are now safely stored in the database
+    with instrument.stage(config, 'report_retention'):
+        msg = db.apply_report_retention(config)
+        if msg != '':
+            logAndDisplay(logger, msg)
 
     logAndDisplay(logger, 'Program completed successfully.')
 
-    endtime = datetime.datetime.now()
 
-    elapsed = setuptime - starttime
-    logAndDisplay(logger, '\nSetup Time: ' + str(elapsed))
+#####################################################################
+##
+## Makes sure the reports database exists, copies it to a temporary location
+##   that is not affected by OneDrive, and loads the video data and the class
+##   list. These steps are run as a graph of stages, so that the ones that
+##   don't depend on each other run at the same time (see stages.py).
+##
 
-    elapsed = endtime - setuptime
-    logAndDisplay(logger, '\nProcessing Time: ' + str(elapsed))
+def prepare_inputs(config, logger, with_class_list):
+
+    results = {}
+    stage_list = [('create_report_db', [], lambda: db.create_report_db(config)),
+                  ('create_temp_db', ['create_report_db'], lambda created: util.create_temp_db(config))]
+
+    stage_list += get_video_data_stages(config, logger, results)
+    if with_class_list:
+        stage_list += get_class_list_stages(config, logger, results)
+
+    logAndDisplay(logger, stages.run_stages(config, stage_list, results))
+
+    return results['verify_video_data'], results.get('refresh_students')
+
+
+#####################################################################
+##
+## The stages that read the video data and verify that it is all valid,
+##   none when it's kept from the last run and videodata.csv hasn't changed
+##
+
+def get_video_data_stages(config, logger, results):
+
+    filenames = [config['video_data']['filename']]
+    from_cache, video_data = daemon.lookup(config, 'video_data', filenames)
+    if from_cache:
+        logAndDisplay(logger, 'Using the video data from the last run.')
+        results['verify_video_data'] = video_data
+        return []
+
+    return [('load_video_data', [], lambda: load_video_data(config, logger)),
+            ('verify_video_data', ['load_video_data'],
+             lambda video_data: daemon.store(config, 'video_data', filenames,
+                                             verify_video_data(config, logger, video_data)))]
 
-    elapsed = endtime - starttime
-    logAndDisplay(logger, '\nTotal Time: ' + str(elapsed))
+
+def load_video_data(config, logger):
+
+    error, msg, video_data = video.load_video_data(config)
+    displayError(logger, 'Loading video data...', error, msg)
+    return video_data
+
+
+def verify_video_data(config, logger, video_data):
+
+    error, msg, video_data = video.verify_video_data(config, video_data)
+    displayError(logger, 'Validating video data...', error, msg)
+    return video_data
+
+
+#####################################################################
+##
+## The class list kept from the last run when none of the files it is built
+##   from have changed, otherwise a newly loaded one. Used by the pipeline,
+##   which loads the class list while the reports download.
+##
+
+def get_class_list(config, logger, video_data):
+
+    results = { 'verify_video_data': video_data }
+    logAndDisplay(logger, stages.run_stages(config, get_class_list_stages(config, logger, results), results))
+
+    return results['refresh_students']
+
+
+#####################################################################
+##
+## The stages that validate the student and class data, load the IR extract
+##   and build the class list from them. The student and class data and the
+##   extract are separate files, so only building the class list has to wait.
+##
+
+def get_class_list_stages(config, logger, results):
+
+    filenames = daemon.get_input_files(config)
+    from_cache, class_list = daemon.lookup(config, 'class_list', filenames)
+    if from_cache:
+        logAndDisplay(logger, 'Using the class list from the last run.')
+        results['refresh_students'] = class_list
+        return []
+
+    return [('verify_student_data', [], lambda: verify_student_data(config, logger)),
+            ('verify_class_data', [], lambda: verify_class_data(config, logger)),
+            ('load_ir_extract', [], lambda: student.load_student_data_from_extract(config)),
+            ('create_class_list', ['verify_video_data', 'verify_student_data', 'verify_class_data'],
+             lambda video_data, *verified: create_class_list(config, logger, video_data)),
+            ('refresh_students', ['create_class_list', 'load_ir_extract'],
+             lambda class_list, enrollment: daemon.store(config, 'class_list', filenames,
+                                                         refresh_students(config, logger, class_list, enrollment)))]
+
+
+# Verify that the student data is all valid
+def verify_student_data(config, logger):
+
+    error, msg = student.verify_student_data(config)
+    displayError(logger, 'Validating student data...', error, msg)
+
+
+# Verify that the class data is all valid
+def verify_class_data(config, logger):
+
+    error, msg = student.verify_class_data(config)
+    displayError(logger, 'Validating class data...', error, msg)
+
+
+# Load the class and student data from the databases
+def create_class_list(config, logger, video_data):
+
+    error, msg, class_list = student.create_class_list(config, video_data)
+    displayError(logger, 'Loading Student and Class Data...', error, msg)
+    return class_list
+
+
+# Refresh the student database
+def refresh_students(config, logger, class_list, enrollment):
+
+    msg, class_list = student.refresh_students(config, class_list, enrollment)
+    logAndDisplay(logger, 'Refreshing student database...[ COMPLETE ]')
+    logAndDisplay(logger, msg)
+    return class_list
+
+
+#####################################################################
+##
+## Deletes old view data from the Yuja website, if requested
+##
+
+def clear_online_data(config, logger, video_data):
+
+    if config['clear_online_data']:
+        logAndDisplay(logger, 'Deleting saved view data from Yuja website', end='')
+        error, msg = backend.delete_view_data_on_yuja(config, video_data)
+        if error < 0:
+            logAndDisplay(logger, '[ ERROR ]')
+            performErrorExit(logger, msg)
+        else:
+            logAndDisplay(logger, '[ COMPLETE ]')
+            logAndDisplay(logger, msg)       
 
 
 #####################################################################
@@ -145,29 +348,32 @@ def performErrorExit(logger, msg):
 
 #####################################################################
 ##
-## Prints error information to the console
+## Prints error information to the console, on one line with the label of
+##   the step as the steps can run at the same time
 ##
 
-def displayError(logger, error, msg):
+def displayError(logger, label, error, msg):
     if error < 0:
-        logAndDisplay(logger, '[ ERROR ]')
+        logAndDisplay(logger, label + '[ ERROR ]')
         performErrorExit(logger, msg)
     elif error > 0:
-        logAndDisplay(logger, '[ WARNING ]')
+        logAndDisplay(logger, label + '[ WARNING ]')
         logAndDisplay(logger, msg)
     else:
-        logAndDisplay(logger, '[ COMPLETE ]')
+        logAndDisplay(logger, label + '[ COMPLETE ]')
 
 
 ####################################################################
 ##
 ## Write output to both the main console and to the log file so that the
-##   output is saved
+##   output is saved. A message that has already gone out through the run
+##   report comes back empty, and is not written again.
 ##
 
 def logAndDisplay(logger, msg, end='\n'):
-     logger.info(msg)
-     print(msg, end=end)
+     if msg == '':
+         return
+     logger.info(msg, extra={ 'end': end })
 
 
 ####################################################################
@@ -176,17 +382,78 @@ def logAndDisplay(logger, msg, end='\n'):
 
 if __name__ == "__main__":
 
-    config = util.load_config('config.toml')
+    parser = argparse.ArgumentParser(description='Grades video views from YuJa and writes the instructor gradebooks.')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='reload every saved report, including compressed ones, using a pool of processes')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes to use (defaults to the number of CPU cores)')
+    parser.add_argument('--grade-workers', type=int, default=None,
+                        help='grade the courses in this many worker processes')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='grade each playlist as soon as its reports have downloaded')
+    parser.add_argument('--stream', action='store_true',
+                        help='grade and write out one group of courses at a time to keep memory down, '
+                             'in this process so --grade-workers is ignored (not with --pipeline)')
+    parser.add_argument('--resume', action='store_true',
+                        help='carry on from the last download run that did not finish')
+    parser.add_argument('--profile', nargs='?', const='cprofile', choices=['cprofile', 'sample'],
+                        help='profile each stage with cProfile, or sample the running code with little overhead')
+    parser.add_argument('--memory', action='store_true',
+                        help='measure the peak memory of each stage, which slows the run down')
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep running, grading on the schedule in config.toml or when asked to')
+    parser.add_argument('--quiet', action='store_true',
+                        help='only show warnings and errors on the console, everything still goes to the log')
+    parser.add_argument('--send', choices=['run', 'status', 'stop'],
+                        help='send a command to a running daemon')
+    args = parser.parse_args()
+
+    # The pipeline loads each report as it downloads, it doesn't rebuild, and
+    #   grades each playlist as it is loaded rather than streaming the courses
+    if args.rebuild and args.pipeline:
+        parser.error('--rebuild can not be used with --pipeline')
+    if args.stream and args.pipeline:
+        parser.error('--stream can not be used with --pipeline')
 
-    LOGFILENAME = config['logfile']
+    config = util.load_config('config.toml')
 
-    # Start the log recording
-    logging.basicConfig(filename=LOGFILENAME,level=logging.DEBUG)
-    logging.FileHandler(LOGFILENAME, mode='w')
-    logger = logging.getLogger()
+    if args.send != None:
+        print(json.dumps(daemon.send_command(args.send, config.get('daemon', {}).get('port', daemon.DEFAULT_PORT)), indent=2))
+        sys.exit(0)
+
+    config['rebuild'] = args.rebuild
+    config['workers'] = args.workers
+    config['pipeline'] = args.pipeline
+    if args.grade_workers != None:
+        config['grade_workers'] = args.grade_workers
+    config['resume'] = args.resume
+    config['stream'] = args.stream
+    config['quiet'] = args.quiet
+    if args.profile != None:
+        config.setdefault('instrument', {})['profile'] = args.profile
+    if args.memory:
+        config.setdefault('instrument', {})['memory'] = True
+
+    # Start the log recording, written out by a background thread
+    logger = logs.setup_logging(config)
         
+    # The settings given on the command line are used for every run the
+    #   daemon makes
+    def run_daemon_once(run_config):
+        run_config.update({ key: config[key] for key in ['rebuild', 'workers', 'pipeline', 'resume', 'stream', 'quiet'] })
+        for key in ['grade_workers', 'instrument']:
+            if key in config:
+                run_config[key] = config[key]
+        main(run_config, logger)
+
     try:
-        main(config, logger)
+        if args.daemon:
+            try:
+                daemon.Daemon('config.toml', run_daemon_once).serve()
+            finally:
+                backend.end_kept_web_session(config)
+        else:
+            main(config, logger)
 
     except (KeyboardInterrupt, SystemExit):
         None
@@ -199,3 +466,6 @@ if __name__ == "__main__":
         for line in errormsg:
             logAndDisplay(logger, '\t--- ' + line)
 
+
+    finally:
+        logs.stop_logging()